@@ -3,6 +3,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const connectionStatus = document.getElementById('connection-status');
     const fileStatus = document.getElementById('file-status');
     const filesList = document.getElementById('files');
+    const downloadArchiveButton = document.getElementById('download-archive-button');
     
     // Desktop upload elements
     const uploadFormDesktop = document.getElementById('upload-form-desktop');
@@ -17,26 +18,53 @@ document.addEventListener('DOMContentLoaded', () => {
     const sendButton = document.getElementById('send-button');
     const clearChatButton = document.getElementById('clear-chat-button');
     
+    // Uploads and downloads in progress, from either side
+    const transferList = new SnapSendTransfers.TransferList(document.getElementById('transfers'));
+    
     // Set to track known files to avoid duplicate notifications
     const knownFiles = new Set();
     
-    // Start polling for new files
-    startPollingForFiles();
+    // Files ticked for "Download Selected"; kept while the list is re-rendered
+    const selectedFiles = new Set();
     
-    // Generate QR code with the current URL
-    generateQRCode();
+    // Download the ticked files, or all of them, as one ZIP built by the server
+    downloadArchiveButton.addEventListener('click', () => {
+        const query = Array.from(selectedFiles, name => `name=${encodeURIComponent(name)}`).join('&');
+        window.location.href = `/api/files/archive${query ? '?' + query : ''}`;
+    });
     
     // Get device name (used as sender name)
     const deviceName = "Desktop";
     
-    // Last message timestamp
-    let lastMessageTimestamp = 0;
+    // Message sync state: the server cursor we are up to and its ETag
+    const MAX_MESSAGES = 100;
+    let messageCursor = null;
+    let messagesEtag = null;
+    let messagesLoading = false;
+    let messagesReloadPending = false;
     
-    // Load messages
-    loadMessages();
+    // Token of our pairing session, which the QR code passes to the phone
+    let pairingToken = null;
     
-    // Set up polling for new messages (every 2 seconds)
-    setInterval(loadMessages, 2000);
+    // Timers of the polling fallback for when events can't be pushed
+    let pollTimers = [];
+    
+    // Start our own pairing session (or keep the one from before a reload)
+    // first, so the files, messages and events below are only those of the
+    // phones that scan our QR code
+    startPairing().then(() => {
+        // Show received files
+        startPollingForFiles();
+        
+        // Generate QR code with the current URL
+        generateQRCode();
+        
+        // Load messages
+        loadMessages();
+        
+        // Get updates pushed from the server, or poll if that isn't possible
+        connectEvents();
+    });
     
     // Handle message form submission
     messageForm.addEventListener('submit', function(e) {
@@ -150,7 +178,7 @@ document.addEventListener('DOMContentLoaded', () => {
             
             uploadStatusDesktop.textContent = `Preparing to upload ${files.length} file(s) to mobile...`;
             
-            // Upload files one by one
+            // Small files go up together in batches, see upload_client.js
             uploadFilesToMobile(Array.from(files));
         });
         
@@ -162,99 +190,104 @@ document.addEventListener('DOMContentLoaded', () => {
             console.log('Desktop progress bar reset');
         }
         
-        function uploadFilesToMobile(files, index = 0) {
-            if (index >= files.length) {
-                uploadStatusDesktop.textContent = 'All files uploaded successfully!';
-                progressBarDesktop.style.width = '100%';
-                return;
-            }
-            
-            const file = files[index];
-            uploadFileToMobile(file)
-                .then(() => {
-                    // Update progress
-                    const progress = ((index + 1) / files.length) * 100;
-                    progressBarDesktop.style.width = `${progress}%`;
-                    
-                    // Upload next file
-                    uploadFilesToMobile(files, index + 1);
+        function uploadFilesToMobile(files) {
+            let current = null;
+            SnapSendUpload.uploadFiles(files, 'shared', fraction => {
+                progressBarDesktop.style.width = `${fraction * 100}%`;
+            }, description => {
+                current = description;
+                uploadStatusDesktop.textContent = `Uploading ${description} to mobile...`;
+            })
+                .then(data => {
+                    console.log('Upload to mobile successful:', data);
+                    uploadStatusDesktop.textContent = 'All files uploaded successfully!';
+                    progressBarDesktop.style.width = '100%';
                 })
                 .catch(error => {
-                    uploadStatusDesktop.textContent = `Error uploading ${file.name}: ${error.message}`;
-                    console.error(error);
+                    uploadStatusDesktop.textContent = `Error uploading ${current}: ${error.message}`;
+                    console.error('Upload to mobile error:', error);
                 });
         }
-        
-        function uploadFileToMobile(file) {
-            return new Promise((resolve, reject) => {
-                uploadStatusDesktop.textContent = `Uploading ${file.name} to mobile...`;
-                
-                // Read the file
-                const reader = new FileReader();
-                
-                reader.onload = function(e) {
-                    const fileData = e.target.result;
-                    
-                    // For small files (less than 10MB), upload directly
-                    if (file.size < 10 * 1024 * 1024) {
-                        // Convert ArrayBuffer to Base64
-                        const base64Data = arrayBufferToBase64(fileData);
-                        
-                        // Create JSON payload
-                        const payload = {
-                            fileName: file.name,
-                            fileType: file.type,
-                            fileSize: file.size,
-                            fileData: base64Data
-                        };
-                        
-                        // Send via HTTP POST
-                        fetch('/upload-to-mobile', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify(payload)
-                        })
-                        .then(response => {
-                            if (!response.ok) {
-                                throw new Error(`Server returned ${response.status}`);
-                            }
-                            return response.json();
-                        })
-                        .then(data => {
-                            console.log('Upload to mobile successful:', data);
-                            resolve();
-                        })
-                        .catch(error => {
-                            console.error('Upload to mobile error:', error);
-                            reject(error);
-                        });
-                    } else {
-                        // File too large for this demo
-                        uploadStatusDesktop.textContent = `File ${file.name} is too large (max 10MB)`;
-                        reject(new Error('File too large (max 10MB)'));
-                    }
-                };
-                
-                reader.onerror = function() {
-                    reject(new Error('Could not read the file'));
-                };
-                
-                reader.readAsArrayBuffer(file);
-            });
-        }
     }
     
     function startPollingForFiles() {
         // Update the status
         connectionStatus.textContent = 'Server running. Scan QR code with your mobile device.';
         
-        // Fetch files immediately and then start polling
+        // Fetch files immediately; updates come from connectEvents()
         fetchFileList();
+    }
+    
+    // Poll messages and transfers every 2 seconds and files every 3 seconds
+    function startPolling() {
+        if (pollTimers.length > 0) return;
+        pollTimers = [
+            setInterval(loadMessages, 2000),
+            setInterval(() => transferList.refresh(), 2000),
+            setInterval(fetchFileList, 3000)
+        ];
+    }
+    
+    function stopPolling() {
+        pollTimers.forEach(timer => clearInterval(timer));
+        pollTimers = [];
+    }
+    
+    // Subscribe to server-sent events, falling back to polling while unavailable
+    function connectEvents() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        
+        const events = new EventSource('/api/events');
+        
+        events.addEventListener('open', () => {
+            stopPolling();
+            // Catch up on anything missed while disconnected
+            loadMessages();
+            fetchFileList();
+            transferList.refresh();
+        });
+        
+        events.addEventListener('message', e => {
+            const data = JSON.parse(e.data);
+            // Apply directly only if it is the next change after our cursor
+            if (messageCursor !== null && data.cursor === messageCursor + 1) {
+                updateMessages({ messages: [data.message], cursor: data.cursor, reset: false });
+            } else {
+                loadMessages();
+            }
+        });
         
-        // Poll for file updates every 3 seconds
-        setInterval(fetchFileList, 3000);
+        events.addEventListener('messages-cleared', e => {
+            const data = JSON.parse(e.data);
+            if (messageCursor !== null && data.cursor > messageCursor) {
+                updateMessages({ messages: [], cursor: data.cursor, reset: true });
+            } else {
+                loadMessages();
+            }
+        });
+        
+        const onFileChange = e => {
+            if (JSON.parse(e.data).area === 'received') {
+                fetchFileList();
+            }
+        };
+        events.addEventListener('file-added', onFileChange);
+        events.addEventListener('file-expired', onFileChange);
+        
+        events.addEventListener('transfer', e => {
+            transferList.update(JSON.parse(e.data));
+        });
+        
+        events.addEventListener('error', () => {
+            startPolling();
+            if (events.readyState === EventSource.CLOSED) {
+                // The server refused the stream (e.g. too many open); try again later
+                setTimeout(connectEvents, 30000);
+            }
+        });
     }
     
     function fetchFileList() {
@@ -296,12 +329,63 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    function startPairing() {
+        return fetch('/api/pairing', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: '{}'
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Network response was not ok');
+            }
+            return response.json();
+        })
+        .then(data => {
+            pairingToken = data.token;
+        })
+        .catch(error => {
+            // Carry on in the session shared by everyone without one
+            console.error('Error starting pairing session:', error);
+        });
+    }
+    
+    // The mobile page, joining our pairing session
+    function mobilePage() {
+        return pairingToken ? `mobile.html?pairing=${encodeURIComponent(pairingToken)}` : 'mobile.html';
+    }
+    
     function generateQRCode() {
-        // Get current URL and modify for upload page
+        // A phone can't reach this machine's loopback address; point the
+        // QR code at its LAN address instead when the page was opened so
+        const host = window.location.hostname;
+        if (host === 'localhost' || host.startsWith('127.') || host === '[::1]') {
+            fetch('/api/addresses')
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Network response was not ok');
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    const address = data.addresses[0];
+                    showQRCode(address ? `http://${address}:${data.port}/${mobilePage()}` : pageUrl(mobilePage()));
+                })
+                .catch(error => {
+                    console.error('Error fetching addresses:', error);
+                    showQRCode(pageUrl(mobilePage()));
+                });
+        } else {
+            showQRCode(pageUrl(mobilePage()));
+        }
+    }
+
+    function pageUrl(page) {
         const currentUrl = window.location.href;
-        const baseUrl = currentUrl.substring(0, currentUrl.lastIndexOf('/') + 1);
-        const uploadUrl = `${baseUrl}mobile.html`;
-        
+        return currentUrl.substring(0, currentUrl.lastIndexOf('/') + 1) + page;
+    }
+
+    function showQRCode(uploadUrl) {
         // For display purposes
         connectionStatus.textContent = `Server running at ${uploadUrl}`;
         
@@ -321,6 +405,16 @@ document.addEventListener('DOMContentLoaded', () => {
         // Clear the list
         filesList.innerHTML = '';
         
+        // Forget ticked files that have expired
+        const names = new Set(files.map(file => file.name));
+        selectedFiles.forEach(name => {
+            if (!names.has(name)) {
+                selectedFiles.delete(name);
+            }
+        });
+        downloadArchiveButton.disabled = files.length === 0;
+        updateDownloadArchiveButton();
+        
         // If no files, show a message
         if (files.length === 0) {
             const emptyMessage = document.createElement('p');
@@ -341,6 +435,20 @@ document.addEventListener('DOMContentLoaded', () => {
         const li = document.createElement('li');
         li.dataset.fileId = file.name; // 用于更新倒计时
         
+        // Create checkbox to include the file in "Download Selected"
+        const checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.className = 'file-select';
+        checkbox.checked = selectedFiles.has(file.name);
+        checkbox.addEventListener('change', () => {
+            if (checkbox.checked) {
+                selectedFiles.add(file.name);
+            } else {
+                selectedFiles.delete(file.name);
+            }
+            updateDownloadArchiveButton();
+        });
+        
         // Create file info container
         const fileInfoContainer = document.createElement('div');
         fileInfoContainer.className = 'file-info';
@@ -367,6 +475,18 @@ document.addEventListener('DOMContentLoaded', () => {
         fileInfoContainer.appendChild(fileDate);
         fileInfoContainer.appendChild(fileExpires);
         
+        // Preview of image files, made by the server
+        let thumbnail = null;
+        if (file.thumbnail) {
+            thumbnail = document.createElement('img');
+            thumbnail.className = 'file-thumbnail';
+            thumbnail.src = file.thumbnail;
+            thumbnail.alt = '';
+            thumbnail.loading = 'lazy';
+            // Leave the row without a preview if none can be made
+            thumbnail.addEventListener('error', () => thumbnail.remove());
+        }
+        
         // Create download link
         const downloadLink = document.createElement('a');
         downloadLink.href = `/received_files/${file.name}`;
@@ -374,6 +494,10 @@ document.addEventListener('DOMContentLoaded', () => {
         downloadLink.download = file.name;
         
         // Add elements to the list item
+        li.appendChild(checkbox);
+        if (thumbnail) {
+            li.appendChild(thumbnail);
+        }
         li.appendChild(fileInfoContainer);
         li.appendChild(downloadLink);
         
@@ -381,6 +505,12 @@ document.addEventListener('DOMContentLoaded', () => {
         filesList.appendChild(li);
     }
     
+    function updateDownloadArchiveButton() {
+        downloadArchiveButton.textContent = selectedFiles.size > 0
+            ? `Download Selected (${selectedFiles.size})`
+            : 'Download All';
+    }
+    
     // 更新所有倒计时
     function updateAllCountdowns() {
         const countdowns = document.querySelectorAll('.file-expires');
@@ -417,19 +547,6 @@ document.addEventListener('DOMContentLoaded', () => {
     // 每秒更新一次倒计时
     setInterval(updateAllCountdowns, 1000);
     
-    // Helper function to convert ArrayBuffer to Base64
-    function arrayBufferToBase64(buffer) {
-        let binary = '';
-        const bytes = new Uint8Array(buffer);
-        const len = bytes.byteLength;
-        
-        for (let i = 0; i < len; i++) {
-            binary += String.fromCharCode(bytes[i]);
-        }
-        
-        return window.btoa(binary);
-    }
-    
     function formatFileSize(bytes) {
         if (bytes < 1024) return bytes + ' bytes';
         else if (bytes < 1048576) return (bytes / 1024).toFixed(1) + ' KB';
@@ -437,52 +554,101 @@ document.addEventListener('DOMContentLoaded', () => {
         else return (bytes / 1073741824).toFixed(1) + ' GB';
     }
     
-    // Load messages
+    // Load messages newer than our cursor; a 304 means nothing changed
     function loadMessages() {
-        fetch('/api/messages')
+        if (messagesLoading) {
+            messagesReloadPending = true;
+            return;
+        }
+        messagesLoading = true;
+        
+        const headers = {};
+        if (messagesEtag) {
+            headers['If-None-Match'] = messagesEtag;
+        }
+        
+        fetch(`/api/messages?since=${messageCursor === null ? 0 : messageCursor}`, {
+            headers: headers,
+            cache: 'no-store'
+        })
         .then(response => {
+            if (response.status === 304) {
+                return null;
+            }
+            if (response.status === 410) {
+                // Our pairing session ended while the page slept; start a new one
+                window.location.reload();
+                return null;
+            }
             if (!response.ok) {
                 throw new Error('Failed to load messages');
             }
+            messagesEtag = response.headers.get('ETag');
             return response.json();
         })
-        .then(messages => {
-            updateMessages(messages);
+        .then(update => {
+            if (update) {
+                updateMessages(update);
+            }
         })
         .catch(error => {
             console.error('Error loading messages:', error);
+        })
+        .finally(() => {
+            messagesLoading = false;
+            if (messagesReloadPending) {
+                messagesReloadPending = false;
+                loadMessages();
+            }
         });
     }
     
-    // Update messages in the UI
-    function updateMessages(messages) {
+    // Apply an incremental message update to the UI
+    function updateMessages(update) {
         if (!messagesContainer) return;
         
-        // Find the latest message timestamp
-        let latestTimestamp = lastMessageTimestamp;
-        let hasNewMessages = false;
+        const firstLoad = messageCursor === null;
         
-        messages.forEach(message => {
-            if (message.timestamp > lastMessageTimestamp) {
-                hasNewMessages = true;
+        // Ignore a response overtaken by a newer update (e.g. a pushed event)
+        if (!firstLoad && !update.reset && update.cursor <= messageCursor) {
+            return;
+        }
+        
+        const previousCursor = messageCursor;
+        messageCursor = update.cursor;
+        let messages = update.messages;
+        
+        // A reset means our view is stale (e.g. messages were cleared), redraw everything
+        if (firstLoad || update.reset) {
+            messagesContainer.innerHTML = '';
+        } else {
+            messages = messages.filter(message => message.id > previousCursor);
+            if (messages.length === 0) {
+                return;
             }
-            if (message.timestamp > latestTimestamp) {
-                latestTimestamp = message.timestamp;
+        }
+        
+        if (messages.length > 0) {
+            const emptyMessage = messagesContainer.querySelector('.empty-chat');
+            if (emptyMessage) {
+                emptyMessage.remove();
             }
-        });
+        }
         
-        lastMessageTimestamp = latestTimestamp;
+        // Append the new messages
+        messages.forEach(message => {
+            const messageElement = createMessageElement(message);
+            messagesContainer.appendChild(messageElement);
+        });
         
-        // If no new messages and container already has messages, do nothing
-        if (!hasNewMessages && messagesContainer.querySelector('.message')) {
-            return;
+        // The server only keeps the latest messages, so drop older ones here too
+        const rendered = messagesContainer.querySelectorAll('.message');
+        for (let i = 0; i < rendered.length - MAX_MESSAGES; i++) {
+            rendered[i].remove();
         }
         
-        // Clear container
-        messagesContainer.innerHTML = '';
-        
         // Check if there are messages
-        if (messages.length === 0) {
+        if (!messagesContainer.querySelector('.message')) {
             const emptyMessage = document.createElement('div');
             emptyMessage.className = 'empty-chat';
             emptyMessage.textContent = 'No text messages yet. Start by sending a message!';
@@ -490,12 +656,6 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
         
-        // Add messages to the container
-        messages.forEach(message => {
-            const messageElement = createMessageElement(message);
-            messagesContainer.appendChild(messageElement);
-        });
-        
         // Scroll to bottom
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
     }
@@ -528,6 +688,32 @@ document.addEventListener('DOMContentLoaded', () => {
         messageDiv.appendChild(messageInfo);
         messageDiv.appendChild(contentDiv);
         
+        // Long messages come cut short; the whole text is fetched on request
+        if (message.truncated) {
+            const moreButton = document.createElement('button');
+            moreButton.className = 'message-more';
+            moreButton.textContent = `Show all ${message.length} characters`;
+            moreButton.addEventListener('click', () => {
+                moreButton.disabled = true;
+                fetch(message.url)
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error('Failed to load message');
+                        }
+                        return response.json();
+                    })
+                    .then(full => {
+                        contentDiv.textContent = full.content;
+                        moreButton.remove();
+                    })
+                    .catch(error => {
+                        console.error('Error loading message:', error);
+                        moreButton.disabled = false;
+                    });
+            });
+            messageDiv.appendChild(moreButton);
+        }
+        
         return messageDiv;
     }
     
@@ -9,6 +9,18 @@ document.addEventListener('DOMContentLoaded', () => {
     // Shared files elements
     const sharedFilesList = document.getElementById('shared-files');
     const refreshButton = document.getElementById('refresh-button');
+    const downloadArchiveButton = document.getElementById('download-archive-button');
+    
+    // Files ticked for "Download Selected"; kept while the list is re-rendered
+    const selectedFiles = new Set();
+    
+    // Download the ticked files, or all of them, as one ZIP built by the server
+    if (downloadArchiveButton) {
+        downloadArchiveButton.addEventListener('click', () => {
+            const query = Array.from(selectedFiles, name => `name=${encodeURIComponent(name)}`).join('&');
+            window.location.href = `/api/shared-files/archive${query ? '?' + query : ''}`;
+        });
+    }
     
     // Chat elements
     const messagesContainer = document.getElementById('messages-container');
@@ -17,8 +29,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const sendButton = document.getElementById('send-button');
     const clearChatButton = document.getElementById('clear-chat-button');
     
-    // Initial fetch of shared files
-    fetchSharedFiles();
+    // Uploads and downloads in progress, from either side
+    const transferList = new SnapSendTransfers.TransferList(document.getElementById('transfers'));
     
     // Refresh button for shared files
     if (refreshButton) {
@@ -30,14 +42,131 @@ document.addEventListener('DOMContentLoaded', () => {
     // Get device name (used as sender name)
     const deviceName = "Mobile";
     
-    // Last message timestamp
-    let lastMessageTimestamp = 0;
+    // Message sync state: the server cursor we are up to and its ETag
+    const MAX_MESSAGES = 100;
+    let messageCursor = null;
+    let messagesEtag = null;
+    let messagesLoading = false;
+    let messagesReloadPending = false;
     
-    // Load messages
-    loadMessages();
+    // Timers of the polling fallback for when events can't be pushed
+    let pollTimers = [];
     
-    // Set up polling for new messages (every 2 seconds)
-    setInterval(loadMessages, 2000);
+    // Join the pairing session of the desktop whose QR code opened this page
+    // first, so the files, messages and events below are only those of it
+    joinPairing().then(joined => {
+        if (!joined) return;
+        
+        // Initial fetch of shared files
+        fetchSharedFiles();
+        
+        // Load messages
+        loadMessages();
+        
+        // Get updates pushed from the server, or poll if that isn't possible
+        connectEvents();
+    });
+    
+    // Resolves to false if the session has ended; without a token in the
+    // URL, the one joined before (or the one for everyone) is used
+    function joinPairing() {
+        const token = new URLSearchParams(window.location.search).get('pairing');
+        if (!token) {
+            return Promise.resolve(true);
+        }
+        return fetch('/api/pairing', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({token: token})
+        })
+        .then(response => {
+            if (response.status === 404) {
+                showPairingEnded();
+                return false;
+            }
+            return true;
+        })
+        .catch(error => {
+            console.error('Error joining pairing session:', error);
+            return true;
+        });
+    }
+    
+    function showPairingEnded() {
+        uploadStatus.textContent = 'This pairing has ended. Scan the QR code on the desktop again.';
+    }
+    
+    // Poll messages and transfers every 2 seconds and files every 5 seconds
+    function startPolling() {
+        if (pollTimers.length > 0) return;
+        pollTimers = [
+            setInterval(loadMessages, 2000),
+            setInterval(() => transferList.refresh(), 2000),
+            setInterval(fetchSharedFiles, 5000)
+        ];
+    }
+    
+    function stopPolling() {
+        pollTimers.forEach(timer => clearInterval(timer));
+        pollTimers = [];
+    }
+    
+    // Subscribe to server-sent events, falling back to polling while unavailable
+    function connectEvents() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        
+        const events = new EventSource('/api/events');
+        
+        events.addEventListener('open', () => {
+            stopPolling();
+            // Catch up on anything missed while disconnected
+            loadMessages();
+            fetchSharedFiles();
+            transferList.refresh();
+        });
+        
+        events.addEventListener('message', e => {
+            const data = JSON.parse(e.data);
+            // Apply directly only if it is the next change after our cursor
+            if (messageCursor !== null && data.cursor === messageCursor + 1) {
+                updateMessages({ messages: [data.message], cursor: data.cursor, reset: false });
+            } else {
+                loadMessages();
+            }
+        });
+        
+        events.addEventListener('messages-cleared', e => {
+            const data = JSON.parse(e.data);
+            if (messageCursor !== null && data.cursor > messageCursor) {
+                updateMessages({ messages: [], cursor: data.cursor, reset: true });
+            } else {
+                loadMessages();
+            }
+        });
+        
+        const onFileChange = e => {
+            if (JSON.parse(e.data).area === 'shared') {
+                fetchSharedFiles();
+            }
+        };
+        events.addEventListener('file-added', onFileChange);
+        events.addEventListener('file-expired', onFileChange);
+        
+        events.addEventListener('transfer', e => {
+            transferList.update(JSON.parse(e.data));
+        });
+        
+        events.addEventListener('error', () => {
+            startPolling();
+            if (events.readyState === EventSource.CLOSED) {
+                // The server refused the stream (e.g. too many open); try again later
+                setTimeout(connectEvents, 30000);
+            }
+        });
+    }
     
     // Function to fetch shared files from desktop
     function fetchSharedFiles() {
@@ -65,6 +194,18 @@ document.addEventListener('DOMContentLoaded', () => {
         
         sharedFilesList.innerHTML = '';
         
+        // Forget ticked files that have expired
+        const names = new Set(files.map(file => file.name));
+        selectedFiles.forEach(name => {
+            if (!names.has(name)) {
+                selectedFiles.delete(name);
+            }
+        });
+        if (downloadArchiveButton) {
+            downloadArchiveButton.disabled = files.length === 0;
+        }
+        updateDownloadArchiveButton();
+        
         if (files.length === 0) {
             const emptyMessage = document.createElement('li');
             emptyMessage.textContent = 'No files shared from desktop yet';
@@ -85,6 +226,20 @@ document.addEventListener('DOMContentLoaded', () => {
         const li = document.createElement('li');
         li.dataset.fileId = file.name; // 用于更新倒计时
         
+        // Create checkbox to include the file in "Download Selected"
+        const checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.className = 'file-select';
+        checkbox.checked = selectedFiles.has(file.name);
+        checkbox.addEventListener('change', () => {
+            if (checkbox.checked) {
+                selectedFiles.add(file.name);
+            } else {
+                selectedFiles.delete(file.name);
+            }
+            updateDownloadArchiveButton();
+        });
+        
         // Create file info container
         const fileInfoContainer = document.createElement('div');
         fileInfoContainer.className = 'file-info';
@@ -111,6 +266,18 @@ document.addEventListener('DOMContentLoaded', () => {
         fileInfoContainer.appendChild(fileDate);
         fileInfoContainer.appendChild(fileExpires);
         
+        // Preview of image files, made by the server
+        let thumbnail = null;
+        if (file.thumbnail) {
+            thumbnail = document.createElement('img');
+            thumbnail.className = 'file-thumbnail';
+            thumbnail.src = file.thumbnail;
+            thumbnail.alt = '';
+            thumbnail.loading = 'lazy';
+            // Leave the row without a preview if none can be made
+            thumbnail.addEventListener('error', () => thumbnail.remove());
+        }
+        
         // Create download link
         const downloadLink = document.createElement('a');
         downloadLink.href = `/shared_files/${file.name}`;
@@ -118,6 +285,10 @@ document.addEventListener('DOMContentLoaded', () => {
         downloadLink.download = file.name;
         
         // Add elements to the list item
+        li.appendChild(checkbox);
+        if (thumbnail) {
+            li.appendChild(thumbnail);
+        }
         li.appendChild(fileInfoContainer);
         li.appendChild(downloadLink);
         
@@ -125,6 +296,13 @@ document.addEventListener('DOMContentLoaded', () => {
         sharedFilesList.appendChild(li);
     }
     
+    function updateDownloadArchiveButton() {
+        if (!downloadArchiveButton) return;
+        downloadArchiveButton.textContent = selectedFiles.size > 0
+            ? `Download Selected (${selectedFiles.size})`
+            : 'Download All';
+    }
+    
     // 更新所有倒计时
     function updateAllCountdowns() {
         const countdowns = document.querySelectorAll('.file-expires');
@@ -207,106 +385,29 @@ document.addEventListener('DOMContentLoaded', () => {
         
         uploadStatus.textContent = `Preparing to upload ${files.length} file(s)...`;
         
-        // Upload files one by one
+        // Small files go up together in batches, see upload_client.js
         uploadFiles(Array.from(files));
     });
     
-    function uploadFiles(files, index = 0) {
-        if (index >= files.length) {
-            uploadStatus.textContent = 'All files uploaded successfully!';
-            progressBar.style.width = '100%';
-            return;
-        }
-        
-        const file = files[index];
-        uploadFile(file)
-            .then(() => {
-                // Update progress
-                const progress = ((index + 1) / files.length) * 100;
-                progressBar.style.width = `${progress}%`;
-                
-                // Upload next file
-                uploadFiles(files, index + 1);
+    function uploadFiles(files) {
+        let current = null;
+        SnapSendUpload.uploadFiles(files, 'received', fraction => {
+            progressBar.style.width = `${fraction * 100}%`;
+        }, description => {
+            current = description;
+            uploadStatus.textContent = `Uploading ${description}...`;
+        })
+            .then(data => {
+                console.log('Upload successful:', data);
+                uploadStatus.textContent = 'All files uploaded successfully!';
+                progressBar.style.width = '100%';
             })
             .catch(error => {
-                uploadStatus.textContent = `Error uploading ${file.name}: ${error.message}`;
-                console.error(error);
+                uploadStatus.textContent = `Error uploading ${current}: ${error.message}`;
+                console.error('Upload error:', error);
             });
     }
     
-    function uploadFile(file) {
-        return new Promise((resolve, reject) => {
-            uploadStatus.textContent = `Uploading ${file.name}...`;
-            
-            // Read the file
-            const reader = new FileReader();
-            
-            reader.onload = function(e) {
-                const fileData = e.target.result;
-                
-                // For small files (less than 10MB), upload directly
-                if (file.size < 10 * 1024 * 1024) {
-                    // Convert ArrayBuffer to Base64
-                    const base64Data = arrayBufferToBase64(fileData);
-                    
-                    // Create JSON payload
-                    const payload = {
-                        fileName: file.name,
-                        fileType: file.type,
-                        fileSize: file.size,
-                        fileData: base64Data
-                    };
-                    
-                    // Send via HTTP POST
-                    fetch('/upload', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify(payload)
-                    })
-                    .then(response => {
-                        if (!response.ok) {
-                            throw new Error(`Server returned ${response.status}`);
-                        }
-                        return response.json();
-                    })
-                    .then(data => {
-                        console.log('Upload successful:', data);
-                        resolve();
-                    })
-                    .catch(error => {
-                        console.error('Upload error:', error);
-                        reject(error);
-                    });
-                } else {
-                    // File too large for this demo
-                    uploadStatus.textContent = `File ${file.name} is too large (max 10MB)`;
-                    reject(new Error('File too large (max 10MB)'));
-                }
-            };
-            
-            reader.onerror = function() {
-                reject(new Error('Could not read the file'));
-            };
-            
-            reader.readAsArrayBuffer(file);
-        });
-    }
-    
-    // Helper function to convert ArrayBuffer to Base64
-    function arrayBufferToBase64(buffer) {
-        let binary = '';
-        const bytes = new Uint8Array(buffer);
-        const len = bytes.byteLength;
-        
-        for (let i = 0; i < len; i++) {
-            binary += String.fromCharCode(bytes[i]);
-        }
-        
-        return window.btoa(binary);
-    }
-    
     // 格式化文件大小
     function formatFileSize(bytes) {
         if (bytes < 1024) return bytes + ' bytes';
@@ -315,9 +416,6 @@ document.addEventListener('DOMContentLoaded', () => {
         else return (bytes / 1073741824).toFixed(1) + ' GB';
     }
     
-    // Set up auto-refresh for shared files
-    setInterval(fetchSharedFiles, 5000);
-    
     // Handle message form submission
     if (messageForm) {
         messageForm.addEventListener('submit', function(e) {
@@ -361,52 +459,100 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
-    // Load messages
+    // Load messages newer than our cursor; a 304 means nothing changed
     function loadMessages() {
-        fetch('/api/messages')
+        if (messagesLoading) {
+            messagesReloadPending = true;
+            return;
+        }
+        messagesLoading = true;
+        
+        const headers = {};
+        if (messagesEtag) {
+            headers['If-None-Match'] = messagesEtag;
+        }
+        
+        fetch(`/api/messages?since=${messageCursor === null ? 0 : messageCursor}`, {
+            headers: headers,
+            cache: 'no-store'
+        })
         .then(response => {
+            if (response.status === 304) {
+                return null;
+            }
+            if (response.status === 410) {
+                showPairingEnded();
+                return null;
+            }
             if (!response.ok) {
                 throw new Error('Failed to load messages');
             }
+            messagesEtag = response.headers.get('ETag');
             return response.json();
         })
-        .then(messages => {
-            updateMessages(messages);
+        .then(update => {
+            if (update) {
+                updateMessages(update);
+            }
         })
         .catch(error => {
             console.error('Error loading messages:', error);
+        })
+        .finally(() => {
+            messagesLoading = false;
+            if (messagesReloadPending) {
+                messagesReloadPending = false;
+                loadMessages();
+            }
         });
     }
     
-    // Update messages in the UI
-    function updateMessages(messages) {
+    // Apply an incremental message update to the UI
+    function updateMessages(update) {
         if (!messagesContainer) return;
         
-        // Find the latest message timestamp
-        let latestTimestamp = lastMessageTimestamp;
-        let hasNewMessages = false;
+        const firstLoad = messageCursor === null;
         
-        messages.forEach(message => {
-            if (message.timestamp > lastMessageTimestamp) {
-                hasNewMessages = true;
+        // Ignore a response overtaken by a newer update (e.g. a pushed event)
+        if (!firstLoad && !update.reset && update.cursor <= messageCursor) {
+            return;
+        }
+        
+        const previousCursor = messageCursor;
+        messageCursor = update.cursor;
+        let messages = update.messages;
+        
+        // A reset means our view is stale (e.g. messages were cleared), redraw everything
+        if (firstLoad || update.reset) {
+            messagesContainer.innerHTML = '';
+        } else {
+            messages = messages.filter(message => message.id > previousCursor);
+            if (messages.length === 0) {
+                return;
             }
-            if (message.timestamp > latestTimestamp) {
-                latestTimestamp = message.timestamp;
+        }
+        
+        if (messages.length > 0) {
+            const emptyMessage = messagesContainer.querySelector('.empty-chat');
+            if (emptyMessage) {
+                emptyMessage.remove();
             }
-        });
+        }
         
-        lastMessageTimestamp = latestTimestamp;
+        // Append the new messages
+        messages.forEach(message => {
+            const messageElement = createMessageElement(message);
+            messagesContainer.appendChild(messageElement);
+        });
         
-        // If no new messages and container already has messages, do nothing
-        if (!hasNewMessages && messagesContainer.querySelector('.message')) {
-            return;
+        // The server only keeps the latest messages, so drop older ones here too
+        const rendered = messagesContainer.querySelectorAll('.message');
+        for (let i = 0; i < rendered.length - MAX_MESSAGES; i++) {
+            rendered[i].remove();
         }
         
-        // Clear container
-        messagesContainer.innerHTML = '';
-        
         // Check if there are messages
-        if (messages.length === 0) {
+        if (!messagesContainer.querySelector('.message')) {
             const emptyMessage = document.createElement('div');
             emptyMessage.className = 'empty-chat';
             emptyMessage.textContent = 'No text messages yet. Start by sending a message!';
@@ -414,12 +560,6 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
         
-        // Add messages to the container
-        messages.forEach(message => {
-            const messageElement = createMessageElement(message);
-            messagesContainer.appendChild(messageElement);
-        });
-        
         // Scroll to bottom
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
     }
@@ -452,6 +592,32 @@ document.addEventListener('DOMContentLoaded', () => {
         messageDiv.appendChild(messageInfo);
         messageDiv.appendChild(contentDiv);
         
+        // Long messages come cut short; the whole text is fetched on request
+        if (message.truncated) {
+            const moreButton = document.createElement('button');
+            moreButton.className = 'message-more';
+            moreButton.textContent = `Show all ${message.length} characters`;
+            moreButton.addEventListener('click', () => {
+                moreButton.disabled = true;
+                fetch(message.url)
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error('Failed to load message');
+                        }
+                        return response.json();
+                    })
+                    .then(full => {
+                        contentDiv.textContent = full.content;
+                        moreButton.remove();
+                    })
+                    .catch(error => {
+                        console.error('Error loading message:', error);
+                        moreButton.disabled = false;
+                    });
+            });
+            messageDiv.appendChild(moreButton);
+        }
+        
         return messageDiv;
     }
     
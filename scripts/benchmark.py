@@ -0,0 +1,1588 @@
+#!/usr/bin/env python3
+"""Load tests and benchmarks for snap_send_server.py.
+
+Every scenario starts a fresh server on loopback in a temporary working
+directory and prints its results as JSON, so runs from different versions
+can be compared.
+
+Usage:
+    python3 scripts/benchmark.py upload --sizes 1 100 1024
+    python3 scripts/benchmark.py download --sizes 100 1024
+    python3 scripts/benchmark.py polling --pollers 1 8 32
+    python3 scripts/benchmark.py listing --counts 10 100 1000 5000
+    python3 scripts/benchmark.py concurrency --downloads 4 --pollers 4
+    python3 scripts/benchmark.py messages
+    python3 scripts/benchmark.py parallel-upload --parallel 1 4 --stream-rate 8
+    python3 scripts/benchmark.py first-load --page mobile.html --link-rate 250 --rtt 50
+    python3 scripts/benchmark.py keep-alive --pollers 16 --duration 10
+    python3 scripts/benchmark.py dedup --file-size 50 --copies 5
+    python3 scripts/benchmark.py batch --files 200 --file-size 100 --rtt 20
+    python3 scripts/benchmark.py archive --files 20 --file-size 50
+    python3 scripts/benchmark.py compression --file-size 20 --link-rate 2
+    python3 scripts/benchmark.py startup --runs 10 [--as-module]
+    python3 scripts/benchmark.py storage --files 8 --file-size 32
+    python3 scripts/benchmark.py workers --workers 1 2 4 --clients 8
+    python3 scripts/benchmark.py pairings --others 0 10 50 --files 50
+    python3 scripts/benchmark.py fairness --rates 0 20 --download-streams 3 1 --upload-streams 1
+    python3 scripts/benchmark.py history --counts 1000 10000 --long-every 20
+
+Add --output results.json (before the scenario name) to also write the
+results, with the git revision and platform, to a file. --server PATH runs
+another copy of snap_send_server.py, e.g. one from an older revision.
+"""
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import zipfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(REPO_ROOT, 'snap_send_server.py')
+
+MB = 1024 * 1024
+
+# Files the web interface is made of
+STATIC_FILES = ('desktop.html', 'mobile.html', '404.html', 'style.css', 'qrcode.min.js',
+                'upload_client.js', 'transfer_list.js', 'desktop_main.js', 'mobile_main.js')
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def run_server(server_args=(), setup=None):
+    """Start the server in a temp directory and yield (port, workdir, pid)"""
+    workdir = tempfile.mkdtemp(prefix='snap_send_bench_')
+    for directory in ('received_files', 'shared_files'):
+        os.makedirs(os.path.join(workdir, directory))
+    if setup:
+        setup(workdir)
+
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, SERVER, '--port', str(port), '--no-browser',
+                             *server_args],
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('server did not start')
+                time.sleep(0.02)
+        yield port, workdir, proc.pid
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a process in MB (Linux only, else None)"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(samples):
+    """Summarize latencies (seconds) as milliseconds"""
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+    return {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 50)),
+        'p90_ms': ms(percentile(samples, 90)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'max_ms': ms(max(samples) if samples else None),
+    }
+
+
+def write_file(path, size):
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            f.write(block)
+        f.write(block[:size % MB])
+
+
+def slow_download(port, path, read_rate, timeout):
+    """Download path reading at most read_rate bytes/s, like a phone on Wi-Fi"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        total = 0
+        start = time.perf_counter()
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            total += len(chunk)
+            if read_rate:
+                ahead = total / read_rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return total
+    finally:
+        conn.close()
+
+
+def timed_get(port, path, timeout, headers=None):
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        conn.getresponse().read()
+    finally:
+        conn.close()
+    return time.perf_counter() - start
+
+
+def stream_upload(port, path, source, size, timeout, headers=None):
+    """POST size bytes from the open file source as a raw request body"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.putrequest('POST', path)
+        conn.putheader('Content-Type', 'application/octet-stream')
+        conn.putheader('Content-Length', str(size))
+        for name, value in (headers or {}).items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        while True:
+            block = source.read(MB)
+            if not block:
+                break
+            conn.send(block)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def legacy_upload(port, name, data, timeout):
+    """POST data the way the original pages did: base64 inside a JSON body"""
+    body = json.dumps({'fileName': name,
+                       'fileData': base64.b64encode(data).decode('ascii')}).encode('utf-8')
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('POST', '/upload', body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def scenario_upload(args):
+    """Upload throughput and server peak RSS per file size and endpoint"""
+    sourcedir = tempfile.mkdtemp(prefix='snap_send_bench_src_')
+    results = {}
+    try:
+        for size_mb in args.sizes:
+            source = os.path.join(sourcedir, 'upload-%d.bin' % size_mb)
+            write_file(source, size_mb * MB)
+            for endpoint in args.endpoints:
+                if endpoint == 'legacy' and size_mb > args.legacy_max_size:
+                    continue
+                # A fresh server per run so the peak RSS belongs to this upload alone
+                with run_server() as (port, workdir, pid):
+                    baseline_rss = peak_rss_mb(pid)
+                    name = 'upload-%d.bin' % size_mb
+                    start = time.perf_counter()
+                    if endpoint == 'stream':
+                        with open(source, 'rb') as f:
+                            status = stream_upload(port, '/upload/stream?name=' + name, f,
+                                                   size_mb * MB, args.timeout)
+                    else:
+                        with open(source, 'rb') as f:
+                            status = legacy_upload(port, name, f.read(), args.timeout)
+                    elapsed = time.perf_counter() - start
+                    stored = os.path.getsize(os.path.join(workdir, 'received_files', name))
+                    results.setdefault(endpoint, {})['%d MB' % size_mb] = {
+                        'status': status,
+                        'stored_ok': stored == size_mb * MB,
+                        'wall_s': round(elapsed, 3),
+                        'throughput_mb_s': round(size_mb / elapsed, 2),
+                        'server_idle_rss_mb': baseline_rss,
+                        'server_peak_rss_mb': peak_rss_mb(pid),
+                    }
+            os.unlink(source)
+    finally:
+        shutil.rmtree(sourcedir, ignore_errors=True)
+
+    return {
+        'scenario': 'upload',
+        'sizes_mb': args.sizes,
+        'results': results,
+    }
+
+
+def scenario_download(args):
+    """Download throughput from /shared_files/ per file size"""
+    def setup(workdir):
+        for size_mb in args.sizes:
+            write_file(os.path.join(workdir, 'shared_files', 'download-%d.bin' % size_mb),
+                       size_mb * MB)
+
+    results = {}
+    with run_server(setup=setup) as (port, _, pid):
+        for size_mb in args.sizes:
+            runs = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                total = slow_download(port, '/shared_files/download-%d.bin' % size_mb, 0,
+                                      args.timeout)
+                runs.append((total, time.perf_counter() - start))
+            best = min(elapsed for _, elapsed in runs)
+            results['%d MB' % size_mb] = {
+                'complete': all(total == size_mb * MB for total, _ in runs),
+                'best_wall_s': round(best, 3),
+                'throughput_mb_s': round(size_mb / best, 2),
+            }
+        peak = peak_rss_mb(pid)
+
+    return {
+        'scenario': 'download',
+        'repeat': args.repeat,
+        'server_peak_rss_mb': peak,
+        'results': results,
+    }
+
+
+def post_message(port, content, timeout, headers=None):
+    status, _ = post_json(port, '/api/send-message', {'sender': 'Desktop', 'content': content},
+                          timeout, headers)
+    return status
+
+
+def upload_small_files(port, start, count, timeout, headers=None):
+    for i in range(start, start + count):
+        with io.BytesIO(b'x' * 1024) as f:
+            stream_upload(port, '/upload/stream?name=file-%05d.txt' % i, f, 1024, timeout, headers)
+
+
+def start_pairing(port, timeout):
+    """Start a pairing session as the desktop page does; returns the
+    headers that make a request part of it"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('POST', '/api/pairing', body='{}', headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return {'Cookie': response.getheader('Set-Cookie').split(';')[0]}
+    finally:
+        conn.close()
+
+
+def scenario_polling(args):
+    """/api/messages and /api/files latency with N clients polling at once"""
+    results = {}
+    with run_server() as (port, _, _):
+        for i in range(args.messages):
+            post_message(port, 'message %d ' % i + 'x' * 100, args.timeout)
+        upload_small_files(port, 0, args.files, args.timeout)
+
+        for pollers in args.pollers:
+            level = {}
+            for path in ('/api/messages', '/api/files'):
+                latencies = []
+                errors = [0]
+                stop = threading.Event()
+
+                def poller():
+                    while not stop.is_set():
+                        try:
+                            latencies.append(timed_get(port, path, args.timeout))
+                        except OSError:
+                            errors[0] += 1
+                        if args.poll_interval:
+                            stop.wait(args.poll_interval)
+
+                threads = [threading.Thread(target=poller) for _ in range(pollers)]
+                for t in threads:
+                    t.start()
+                time.sleep(args.duration)
+                stop.set()
+                for t in threads:
+                    t.join()
+                summary = latency_summary(latencies)
+                summary['requests_per_s'] = round(len(latencies) / args.duration, 1)
+                summary['errors'] = errors[0]
+                level[path] = summary
+            results[str(pollers)] = level
+
+    return {
+        'scenario': 'polling',
+        'messages': args.messages,
+        'files': args.files,
+        'poll_interval_s': args.poll_interval,
+        'duration_s': args.duration,
+        'results': results,
+    }
+
+
+def scenario_listing(args):
+    """/api/files latency as received_files grows"""
+    results = {}
+    with run_server() as (port, _, _):
+        uploaded = 0
+        for count in sorted(args.counts):
+            upload_small_files(port, uploaded, count - uploaded, args.timeout)
+            uploaded = count
+            latencies = [timed_get(port, '/api/files', args.timeout) for _ in range(args.samples)]
+            results[str(count)] = latency_summary(latencies)
+
+    return {
+        'scenario': 'listing',
+        'samples': args.samples,
+        'results': results,
+    }
+
+
+def scenario_pairings(args):
+    """/api/files and /api/messages latency of one pairing session as other
+    sessions fill up, against the same load all in the default session"""
+    results = {}
+    with run_server() as (port, _, _):
+        own = start_pairing(port, args.timeout)
+        upload_small_files(port, 0, args.files, args.timeout, own)
+        for i in range(args.messages):
+            post_message(port, 'message %d ' % i + 'x' * 100, args.timeout, own)
+
+        others = 0
+        shared_files = 0
+        for count in sorted(args.others):
+            for _ in range(count - others):
+                other = start_pairing(port, args.timeout)
+                upload_small_files(port, 0, args.files, args.timeout, other)
+                for i in range(args.messages):
+                    post_message(port, 'message %d ' % i + 'x' * 100, args.timeout, other)
+                # What the same pair did when everyone shared one space
+                upload_small_files(port, shared_files, args.files, args.timeout)
+                for i in range(args.messages):
+                    post_message(port, 'message %d ' % i + 'x' * 100, args.timeout)
+                shared_files += args.files
+            others = count
+
+            level = {}
+            for session, headers in (('pairing', own), ('default', None)):
+                for path in ('/api/files', '/api/messages'):
+                    latencies = [timed_get(port, path, args.timeout, headers)
+                                 for _ in range(args.samples)]
+                    level[f'{session} {path}'] = latency_summary(latencies)
+            results[str(count)] = level
+
+    return {
+        'scenario': 'pairings',
+        'files': args.files,
+        'messages': args.messages,
+        'samples': args.samples,
+        'results': results,
+    }
+
+
+def download_until(port, source, path, deadline, timeout):
+    """Download path from the source address again and again until the
+    deadline; returns the bytes read"""
+    total = 0
+    while time.perf_counter() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout,
+                                          source_address=(source, 0))
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            while time.perf_counter() < deadline:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                total += len(chunk)
+        finally:
+            conn.close()
+    return total
+
+
+def upload_until(port, source, path, deadline, timeout):
+    """Upload 8 MB bodies of random bytes from the source address until
+    the deadline, cutting the last one off there; returns the bytes sent"""
+    block = os.urandom(64 * 1024)
+    size = 8 * MB
+    total = 0
+    while time.perf_counter() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout,
+                                          source_address=(source, 0))
+        try:
+            conn.putrequest('POST', path)
+            conn.putheader('Content-Type', 'application/octet-stream')
+            conn.putheader('Content-Length', str(size))
+            conn.endheaders()
+            sent = 0
+            while sent < size and time.perf_counter() < deadline:
+                conn.send(block)
+                sent += len(block)
+            if sent == size:
+                response = conn.getresponse()
+                response.read()
+                # Turned away by the server's upload limits
+                if response.status != 200:
+                    sent = 0
+            total += sent
+        finally:
+            conn.close()
+    return total
+
+
+def scenario_fairness(args):
+    """Several clients downloading and uploading at once, each from its own
+    loopback address, with and without --max-rate"""
+    def setup(workdir):
+        write_file(os.path.join(workdir, 'shared_files', 'big.bin'), args.file_size * MB)
+
+    clients = [('download', streams) for streams in args.download_streams]
+    clients += [('upload', streams) for streams in args.upload_streams]
+    results = {}
+    for rate in args.rates:
+        server_args = ['--max-rate', str(rate)] if rate else []
+        with run_server(server_args, setup) as (port, _, _):
+            moved = [[] for _ in clients]
+            latencies = []
+            deadline = time.perf_counter() + args.duration
+            stop = threading.Event()
+
+            def transfer(index, direction, stream):
+                # 127.0.0.1 is left to the pollers
+                source = '127.0.0.%d' % (index + 2)
+                if direction == 'download':
+                    moved[index].append(download_until(port, source, '/shared_files/big.bin',
+                                                       deadline, args.timeout))
+                else:
+                    moved[index].append(upload_until(port, source, '/upload/stream?name=up-%d-%d.bin'
+                                                     % (index, stream), deadline, args.timeout))
+
+            def poller():
+                while not stop.is_set():
+                    for path in ('/api/messages', '/api/files'):
+                        latencies.append(timed_get(port, path, args.timeout))
+                    stop.wait(args.poll_interval)
+
+            threads = [threading.Thread(target=transfer, args=(index, direction, stream))
+                       for index, (direction, streams) in enumerate(clients)
+                       for stream in range(streams)]
+            pollers = [threading.Thread(target=poller) for _ in range(args.pollers)]
+            for t in threads + pollers:
+                t.start()
+            # What the scheduler gave each client halfway through
+            time.sleep(args.duration / 2)
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+            conn.request('GET', '/api/bandwidth')
+            allocations = json.loads(conn.getresponse().read())['clients']
+            conn.close()
+            for t in threads:
+                t.join()
+            stop.set()
+            for t in pollers:
+                t.join()
+
+            rates = [sum(counts) / args.duration / MB for counts in moved]
+            # Jain's index: 1 when every client got the same, 1/n when one got everything
+            fairness = sum(rates) ** 2 / (len(rates) * sum(r * r for r in rates)) if any(rates) else None
+            shares = [allocations.get('127.0.0.%d' % (index + 2)) for index in range(len(clients))]
+            results[str(rate) if rate else 'unlimited'] = {
+                'clients': [{
+                    'direction': direction,
+                    'streams': streams,
+                    'mb_s': round(client_rate, 2),
+                    'allocated_mb_s': None if share is None else round(share / MB, 2),
+                } for (direction, streams), client_rate, share in zip(clients, rates, shares)],
+                'total_mb_s': round(sum(rates), 2),
+                'jain_fairness': None if fairness is None else round(fairness, 3),
+                'poll_latency': latency_summary(latencies),
+            }
+
+    return {
+        'scenario': 'fairness',
+        'file_size_mb': args.file_size,
+        'duration_s': args.duration,
+        'results': results,
+    }
+
+
+class Link:
+    """A shared link of fixed bandwidth: readers sleep until their bytes fit"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.free_at = time.perf_counter()
+
+    def transfer(self, size):
+        with self.lock:
+            self.free_at = max(self.free_at, time.perf_counter()) + size / self.rate
+            done = self.free_at
+        time.sleep(max(0, done - time.perf_counter()))
+
+
+def fetch_over_link(port, path, headers, link, rtt):
+    """GET path as a browser on a slow link would; returns (status, headers, body)"""
+    time.sleep(rtt)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        link.transfer(len(body) + 200)  # roughly the size of the response headers
+        return response.status, dict(response.getheaders()), body
+    finally:
+        conn.close()
+
+
+def page_assets(html):
+    return re.findall(r'<(?:script[^>]*src|link[^>]*href)="([^"/:]+)"', html)
+
+
+def scenario_first_load(args):
+    """Bytes and time to load a page and its scripts over a slow link"""
+    def setup(workdir):
+        # Older servers serve the interface from their working directory
+        for name in STATIC_FILES:
+            shutil.copy(os.path.join(REPO_ROOT, name), workdir)
+
+    def load(port, encoding, cache):
+        headers = {'Accept-Encoding': encoding} if encoding else {}
+        link = Link(args.link_rate * 1024)
+        start = time.perf_counter()
+        stats = {'requests': 0, 'bytes': 0}
+
+        def get(path):
+            request_headers = dict(headers)
+            cached = cache.get(path)
+            if cached and 'immutable' in cached.get('Cache-Control', ''):
+                return cached['body']
+            if cached and cached.get('ETag'):
+                request_headers['If-None-Match'] = cached['ETag']
+            if cached and cached.get('Last-Modified'):
+                request_headers['If-Modified-Since'] = cached['Last-Modified']
+            status, response_headers, body = fetch_over_link(port, '/' + path, request_headers,
+                                                             link, args.rtt / 1000)
+            stats['requests'] += 1
+            stats['bytes'] += len(body)
+            if status == 304:
+                return cached['body']
+            response_headers['body'] = body
+            cache[path] = response_headers
+            return body
+
+        html = get(args.page)
+        if cache[args.page].get('Content-Encoding') == 'gzip':
+            html = gzip.decompress(html)
+        # Browsers fetch the page's scripts and stylesheet in parallel
+        threads = [threading.Thread(target=get, args=(asset,))
+                   for asset in page_assets(html.decode('utf-8'))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats['time_to_scripts_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return stats
+
+    results = {}
+    with run_server(setup=setup) as (port, _, _):
+        results['uncompressed'] = load(port, None, {})
+        cache = {}
+        results['first_visit'] = load(port, 'gzip, deflate, br', cache)
+        results['repeat_visit'] = load(port, 'gzip, deflate, br', cache)
+
+    return {
+        'scenario': 'first-load',
+        'page': args.page,
+        'link_rate_kb_s': args.link_rate,
+        'rtt_ms': args.rtt,
+        'results': results,
+    }
+
+
+class CountingConnection(http.client.HTTPConnection):
+    """HTTPConnection that counts the TCP connections it opens"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        super().connect()
+
+
+def scenario_keep_alive(args):
+    """Polling clients that reuse their connection the way browsers do"""
+    def setup(workdir):
+        for i in range(args.files):
+            with open(os.path.join(workdir, 'received_files', 'file-%03d.txt' % i), 'w') as f:
+                f.write('x' * 1024)
+
+    with run_server(setup=setup) as (port, _, _):
+        for i in range(20):
+            post_message(port, 'message %d' % i, args.timeout)
+
+        latencies = []
+        connects = []
+        errors = [0]
+        stop = threading.Event()
+
+        def poller():
+            conn = CountingConnection('127.0.0.1', port, timeout=args.timeout)
+            paths = ('/api/messages', '/api/files')
+            i = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    conn.request('GET', paths[i % 2])
+                    conn.getresponse().read()
+                    latencies.append(time.perf_counter() - start)
+                except (OSError, http.client.HTTPException):
+                    errors[0] += 1
+                    conn.close()
+                i += 1
+                stop.wait(args.poll_interval)
+            conn.close()
+            connects.append(conn.connects)
+
+        threads = [threading.Thread(target=poller) for _ in range(args.pollers)]
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+    summary = latency_summary(latencies)
+    summary['errors'] = errors[0]
+    return {
+        'scenario': 'keep-alive',
+        'pollers': args.pollers,
+        'poll_interval_s': args.poll_interval,
+        'duration_s': args.duration,
+        'requests': len(latencies),
+        'connections': sum(connects),
+        'connections_per_minute': round(sum(connects) * 60 / args.duration, 1),
+        'latency': summary,
+    }
+
+
+def disk_usage_mb(workdir):
+    """Space taken by the files under workdir, counting hard links once"""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return round(total / MB, 1)
+
+
+def scenario_dedup(args):
+    """The same file sent several times: disk use and time per send"""
+    data = os.urandom(args.file_size * MB)
+    digest = hashlib.sha256(data).hexdigest()
+
+    with run_server() as (port, workdir, _):
+        uploads = []
+        links = []
+        for i in range(args.copies):
+            start = time.perf_counter()
+            status, _ = post_json(port, '/api/blobs/%s/link' % digest,
+                                  {'name': 'copy-%d.bin' % i, 'target': 'received'}, args.timeout)
+            if status == 200:
+                links.append(time.perf_counter() - start)
+                continue
+            # Unknown content (or a server without the link endpoint): upload it
+            with io.BytesIO(data) as f:
+                stream_upload(port, '/upload/stream?name=copy-%d.bin' % i, f, len(data), args.timeout)
+            uploads.append(time.perf_counter() - start)
+        usage = disk_usage_mb(workdir)
+
+    return {
+        'scenario': 'dedup',
+        'file_size_mb': args.file_size,
+        'copies': args.copies,
+        'uploads': len(uploads),
+        'upload_latency': latency_summary(uploads),
+        'linked': len(links),
+        'link_latency': latency_summary(links),
+        'disk_usage_mb': usage,
+    }
+
+
+def multipart_body(files, boundary):
+    """Encode [(name, data)] as a multipart/form-data body"""
+    parts = []
+    for name, data in files:
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="files"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode())
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode())
+    return b''.join(parts)
+
+
+def scenario_batch(args):
+    """Many small files: one streamed request per file vs multipart batches.
+
+    Requests on one keep-alive connection over loopback; each request also
+    costs a round trip on a real network, added as --rtt per request."""
+    files = [('batch-%05d.bin' % i, os.urandom(args.file_size * 1024)) for i in range(args.files)]
+    results = {}
+    with run_server() as (port, workdir, _):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+        start = time.perf_counter()
+        for name, data in files:
+            conn.request('POST', '/upload/stream?name=' + name, body=data,
+                         headers={'Content-Type': 'application/octet-stream'})
+            conn.getresponse().read()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        results['per-file'] = {'requests': len(files), 'wall_s': round(elapsed, 3),
+                               'wall_with_rtt_s': round(elapsed + len(files) * args.rtt / 1000, 3)}
+
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+        start = time.perf_counter()
+        requests = 0
+        stored = 0
+        for offset in range(0, len(files), args.batch_files):
+            boundary = 'bench%d' % offset
+            body = multipart_body(files[offset:offset + args.batch_files], boundary)
+            conn.request('POST', '/upload-to-mobile/batch', body=body,
+                         headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+            response = conn.getresponse()
+            payload = response.read()
+            if response.status == 200:
+                stored += len(json.loads(payload)['files'])
+            requests += 1
+        elapsed = time.perf_counter() - start
+        conn.close()
+        results['batch'] = {'requests': requests, 'stored': stored, 'wall_s': round(elapsed, 3),
+                            'wall_with_rtt_s': round(elapsed + requests * args.rtt / 1000, 3)}
+
+    return {
+        'scenario': 'batch',
+        'files': args.files,
+        'file_size_kb': args.file_size,
+        'rtt_ms': args.rtt,
+        'results': results,
+    }
+
+
+def scenario_archive(args):
+    """ZIP download of every shared file: throughput, size and server memory.
+
+    Half the files are random bytes named .jpg (stored as-is), half are
+    text (deflated)."""
+    sizes = {}
+
+    def setup(workdir):
+        words = b'snap send transfers files between a phone and a desktop '
+        for i in range(args.files):
+            if i % 2:
+                path = os.path.join(workdir, 'shared_files', 'photo-%03d.jpg' % i)
+                write_file(path, args.file_size * MB)
+            else:
+                path = os.path.join(workdir, 'shared_files', 'notes-%03d.txt' % i)
+                with open(path, 'wb') as f:
+                    for _ in range(args.file_size):
+                        f.write((words * (MB // len(words) + 1))[:MB])
+            sizes[os.path.basename(path)] = args.file_size * MB
+
+    with run_server(setup=setup) as (port, _, pid):
+        idle_rss = peak_rss_mb(pid)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+        start = time.perf_counter()
+        conn.request('GET', '/api/shared-files/archive')
+        response = conn.getresponse()
+        archive = response.read()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        peak = peak_rss_mb(pid)
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        complete = zf.testzip() is None and {i.filename: i.file_size for i in zf.infolist()} == sizes
+
+    total = sum(sizes.values())
+    return {
+        'scenario': 'archive',
+        'files': args.files,
+        'file_size_mb': args.file_size,
+        'status': response.status,
+        'complete': complete,
+        'content_mb': round(total / MB, 1),
+        'archive_mb': round(len(archive) / MB, 1),
+        'wall_s': round(elapsed, 3),
+        'throughput_mb_s': round(total / MB / elapsed, 2),
+        'server_idle_rss_mb': idle_rss,
+        'server_peak_rss_mb': peak,
+    }
+
+
+def scenario_concurrency(args):
+    """N slow downloads from /shared_files/ plus pollers of /api/messages"""
+    def setup(workdir):
+        write_file(os.path.join(workdir, 'shared_files', 'big.bin'), args.file_size * MB)
+
+    results = {}
+    for mode in args.modes:
+        server_args = ['--mode', mode, '--threads', str(args.threads)]
+        with run_server(server_args, setup) as (port, _, _):
+            latencies = []
+            timeouts = [0]
+            downloaded = []
+            stop = threading.Event()
+
+            def downloader():
+                try:
+                    downloaded.append(slow_download(port, '/shared_files/big.bin',
+                                                    args.read_rate * MB, args.timeout))
+                except OSError:
+                    downloaded.append(0)
+
+            def poller():
+                while not stop.is_set():
+                    try:
+                        latencies.append(timed_get(port, '/api/messages', args.timeout))
+                    except OSError:
+                        timeouts[0] += 1
+                    stop.wait(args.poll_interval)
+
+            threads = [threading.Thread(target=downloader) for _ in range(args.downloads)]
+            pollers = [threading.Thread(target=poller) for _ in range(args.pollers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            # Let the downloads occupy the server before polling starts
+            time.sleep(0.2)
+            for t in pollers:
+                t.start()
+            for t in threads:
+                t.join()
+            stop.set()
+            for t in pollers:
+                t.join()
+
+            results[mode] = {
+                'downloads_wall_s': round(time.perf_counter() - start, 3),
+                'downloaded_mb': round(sum(downloaded) / MB, 1),
+                'poll_latency': latency_summary(latencies),
+                'poll_timeouts': timeouts[0],
+            }
+
+    return {
+        'scenario': 'concurrency',
+        'downloads': args.downloads,
+        'pollers': args.pollers,
+        'file_size_mb': args.file_size,
+        'read_rate_mb_s': args.read_rate,
+        'results': results,
+    }
+
+
+class JsonFileMessages:
+    """The original messages.json handling: parse the file on every read,
+    rewrite all of it on every append. Kept here as the baseline."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'w') as f:
+            json.dump({"messages": []}, f)
+
+    def add(self, sender, content):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        data["messages"].append({"sender": sender, "content": content,
+                                 "timestamp": time.time(), "time": time.strftime("%H:%M:%S")})
+        data["messages"] = data["messages"][-100:]
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def list(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)["messages"]
+
+
+def time_per_op(func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    return (time.perf_counter() - start) / iterations
+
+
+def scenario_messages(args):
+    """Per-request cost of appending and reading messages, old vs new store"""
+    sys.path.insert(0, REPO_ROOT)
+    import snap_send_server
+
+    content = 'x' * args.message_size
+    workdir = tempfile.mkdtemp(prefix='snap_send_bench_')
+    try:
+        legacy = JsonFileMessages(os.path.join(workdir, 'legacy.json'))
+        store = snap_send_server.MessageStore(os.path.join(workdir, 'messages.json'),
+                                              os.path.join(workdir, 'messages.journal'))
+        store.load()
+
+        results = {}
+        for name, impl in (('json_file', legacy), ('message_store', store)):
+            # Fill the 100 message window first so both work on a full list
+            for i in range(100):
+                impl.add('Desktop', content)
+            append = time_per_op(lambda i: impl.add('Desktop', content), args.iterations)
+            read = time_per_op(lambda i: impl.list(), args.iterations)
+            results[name] = {'append_us': round(append * 1e6, 2), 'read_us': round(read * 1e6, 2)}
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'scenario': 'messages',
+        'iterations': args.iterations,
+        'message_size': args.message_size,
+        'results': results,
+    }
+
+
+def get_json(port, path, timeout):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        body = conn.getresponse().read()
+        return len(body), json.loads(body)
+    finally:
+        conn.close()
+
+
+def scenario_history(args):
+    """Size of the message list with long messages in it, and the latency
+    of paging back and searching as the --history-days history grows"""
+    results = {}
+    with run_server(['--history-days', '7']) as (port, _, _):
+        posted = []
+        for count in sorted(args.counts):
+            for i in range(len(posted), count):
+                if i == 0:
+                    # The one message the rare word is in, as far back as it gets
+                    content = 'the zebra is in the first message'
+                elif args.long_every and i % args.long_every == 0:
+                    content = ('pasted log line %d ' % i) * (args.long_size * 1024 // 20)
+                else:
+                    content = 'message %d about nothing much' % i
+                post_message(port, content, args.timeout)
+                posted.append(content)
+
+            list_bytes, listed = get_json(port, '/api/messages', args.timeout)
+            # The same list with every message whole, as before previews
+            full_bytes = len(json.dumps([dict(message, content=content) for message, content
+                                         in zip(listed, posted[-len(listed):])]))
+            ids = [message['id'] for message in listed]
+            last_id = ids[-1]
+            level = {'list_kb': round(list_bytes / 1024, 1), 'list_kb_full_text': round(full_bytes / 1024, 1)}
+            for name, path in (
+                    ('page_back', lambda i: '/api/messages?before=%d&limit=50' % (1 + (i * 7919) % last_id)),
+                    ('search_rare', lambda i: '/api/messages/search?q=zebra'),
+                    ('search_common', lambda i: '/api/messages/search?q=message&limit=50')):
+                level[name] = latency_summary([timed_get(port, path(i), args.timeout)
+                                               for i in range(args.samples)])
+            results[str(count)] = level
+
+    return {
+        'scenario': 'history',
+        'long_every': args.long_every,
+        'long_size_kb': args.long_size,
+        'samples': args.samples,
+        'results': results,
+    }
+
+
+def throttled_request(port, method, path, data, send_rate, timeout, headers=None):
+    """Send data sending at most send_rate bytes/s, like one TCP flow on Wi-Fi"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.putrequest(method, path)
+        conn.putheader('Content-Type', 'application/octet-stream')
+        conn.putheader('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        view = memoryview(data)
+        start = time.perf_counter()
+        for offset in range(0, len(data), 64 * 1024):
+            conn.send(view[offset:offset + 64 * 1024])
+            if send_rate:
+                ahead = (offset + 64 * 1024) / send_rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.getheader('Retry-After')
+    finally:
+        conn.close()
+
+
+def post_json(port, path, body, timeout, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('POST', path, body=json.dumps(body) if body is not None else None,
+                     headers={'Content-Type': 'application/json', **(headers or {})})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        conn.close()
+
+
+def scenario_parallel_upload(args):
+    """Upload one file through the chunk session API with 1..N chunks in flight"""
+    data = os.urandom(args.file_size * MB)
+    chunk_size = args.chunk_size * MB
+
+    results = {}
+    with run_server() as (port, _, _):
+        for parallel in args.parallel:
+            status, session = post_json(port, '/api/uploads', {
+                'name': 'parallel-%d.bin' % parallel, 'size': len(data),
+                'target': 'received', 'chunkSize': chunk_size}, args.timeout)
+            if status != 201:
+                raise RuntimeError('could not start upload session: %s' % session)
+
+            pending = list(range(session['chunkCount']))
+            lock = threading.Lock()
+            busy = [0]
+
+            def worker():
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        index = pending.pop(0)
+                    chunk = data[index * chunk_size:(index + 1) * chunk_size]
+                    while True:
+                        status, retry_after = throttled_request(
+                            port, 'PUT', '/api/uploads/%s/chunks/%d' % (session['id'], index),
+                            chunk, args.stream_rate * MB, args.timeout)
+                        if status in (429, 503) and retry_after:
+                            busy[0] += 1
+                            time.sleep(float(retry_after))
+                            continue
+                        if status != 200:
+                            raise RuntimeError('chunk %d failed with %d' % (index, status))
+                        break
+
+            threads = [threading.Thread(target=worker) for _ in range(parallel)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            status, _ = post_json(port, '/api/uploads/%s/complete' % session['id'], None,
+                                  args.timeout)
+            elapsed = time.perf_counter() - start
+            if status != 200:
+                raise RuntimeError('upload did not complete')
+
+            results[str(parallel)] = {
+                'wall_s': round(elapsed, 3),
+                'throughput_mb_s': round(len(data) / MB / elapsed, 2),
+                'busy_retries': busy[0],
+            }
+
+    return {
+        'scenario': 'parallel-upload',
+        'file_size_mb': args.file_size,
+        'chunk_size_mb': args.chunk_size,
+        'stream_rate_mb_s': args.stream_rate,
+        'results': results,
+    }
+
+
+def csv_like(size):
+    """About size bytes of CSV rows, compressing about as well as real exports and logs"""
+    rows = []
+    total = 0
+    i = 0
+    while total < size:
+        row = ('%d,2026-10-18T%02d:%02d:%02d,sensor-%d,%.3f,%d\n' % (
+            i, i // 3600 % 24, i // 60 % 60, i % 60, i % 37,
+            (i * 2654435761 % 100000) / 1000, i * 40503 % 9973)).encode()
+        rows.append(row)
+        total += len(row)
+        i += 1
+    return b''.join(rows)[:size]
+
+
+def scenario_compression(args):
+    """Upload time of a text file over a throttled link, as-is and gzipped.
+
+    The gzip run includes the time to compress it at zlib's default level,
+    which is what CompressionStream('gzip') in the browser uses."""
+    data = csv_like(args.file_size * MB)
+    start = time.perf_counter()
+    compressed = gzip.compress(data, compresslevel=6)
+    compress_s = time.perf_counter() - start
+
+    results = {}
+    with run_server() as (port, workdir, _):
+        for encoding, body, prepare_s in (('identity', data, 0), ('gzip', compressed, compress_s)):
+            name = 'compression-%s.csv' % encoding
+            start = time.perf_counter()
+            status, _ = throttled_request(port, 'POST', '/upload/stream?name=' + name, body,
+                                          args.link_rate * MB, args.timeout,
+                                          {'Content-Encoding': encoding})
+            elapsed = time.perf_counter() - start
+            if status != 200:
+                raise RuntimeError('%s upload failed with %d' % (encoding, status))
+            with open(os.path.join(workdir, 'received_files', name), 'rb') as f:
+                if hashlib.sha256(f.read()).digest() != hashlib.sha256(data).digest():
+                    raise RuntimeError('%s upload was stored wrongly' % encoding)
+            results[encoding] = {
+                'bytes_sent': len(body),
+                'compress_s': round(prepare_s, 3),
+                'upload_s': round(elapsed, 3),
+                'wall_s': round(prepare_s + elapsed, 3),
+            }
+
+    return {
+        'scenario': 'compression',
+        'file_size_mb': args.file_size,
+        'link_rate_mb_s': args.link_rate,
+        'compression_ratio': round(len(data) / len(compressed), 2),
+        'speedup': round(results['identity']['wall_s'] / results['gzip']['wall_s'], 2),
+        'results': results,
+    }
+
+
+def scenario_startup(args):
+    """Time from starting the server to its printed URL and first response.
+
+    The server is started without --port, as users do, so the default port
+    selection is part of what is measured. With --as-module it is started
+    with python -m, which reuses the bytecode Python caches for it."""
+    banner = []
+    first_response = []
+    for _ in range(args.runs):
+        workdir = tempfile.mkdtemp(prefix='snap_send_bench_')
+        start = time.perf_counter()
+        if args.as_module:
+            command = [sys.executable, '-m', os.path.splitext(os.path.basename(SERVER))[0]]
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(SERVER)))
+        else:
+            command = [sys.executable, SERVER]
+            env = None
+        proc = subprocess.Popen(command + ['--no-browser'], cwd=workdir, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            # The first line printed is the URL, port included
+            line = proc.stdout.readline()
+            banner.append((time.perf_counter() - start) * 1000)
+            match = re.search(r':(\d+)/', line)
+            if not match:
+                raise RuntimeError('no URL in %r' % line)
+            port = int(match.group(1))
+            while True:
+                try:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+                    conn.request('GET', '/')
+                    conn.getresponse().read()
+                    conn.close()
+                    break
+                except OSError:
+                    if time.perf_counter() - start > args.timeout:
+                        raise RuntimeError('server did not answer')
+                    time.sleep(0.001)
+            first_response.append((time.perf_counter() - start) * 1000)
+        finally:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def summary(samples):
+        return {'median_ms': round(percentile(samples, 50), 1),
+                'min_ms': round(min(samples), 1), 'max_ms': round(max(samples), 1)}
+
+    return {
+        'scenario': 'startup',
+        'runs': args.runs,
+        'as_module': args.as_module,
+        'url_printed': summary(banner),
+        'first_response': summary(first_response),
+    }
+
+
+def scenario_storage(args):
+    """Upload and download throughput per --storage backend"""
+    payload = os.urandom(args.file_size * MB)
+    results = {}
+    for kind in args.storages:
+        server_args = ['--storage', kind]
+        spool = None
+        if kind == 'spool':
+            spool = tempfile.mkdtemp(prefix='snap_send_spool_',
+                                     dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            server_args += ['--spool-dir', spool]
+        elif kind == 'memory':
+            server_args += ['--memory-limit', str(args.files * args.file_size + 64)]
+        try:
+            with run_server(server_args) as (port, _, pid):
+                start = time.perf_counter()
+                for i in range(args.files):
+                    # A distinct first byte per file, so none is deduplicated
+                    source = io.BytesIO(bytes([i % 256]) + payload[1:])
+                    status = stream_upload(port, '/upload-to-mobile/stream?name=file-%d.bin' % i,
+                                           source, len(payload), args.timeout)
+                    if status != 200:
+                        raise RuntimeError('upload failed with %d' % status)
+                upload_wall = time.perf_counter() - start
+
+                start = time.perf_counter()
+                downloaded = 0
+                for _ in range(args.repeat):
+                    for i in range(args.files):
+                        downloaded += slow_download(port, '/shared_files/file-%d.bin' % i, 0, args.timeout)
+                download_wall = time.perf_counter() - start
+                peak = peak_rss_mb(pid)
+        finally:
+            if spool:
+                shutil.rmtree(spool, ignore_errors=True)
+
+        results[kind] = {
+            'complete': downloaded == args.repeat * args.files * len(payload),
+            'upload_mb_s': round(args.files * args.file_size / upload_wall, 1),
+            'download_mb_s': round(downloaded / MB / download_wall, 1),
+            'server_peak_rss_mb': peak,
+        }
+
+    return {
+        'scenario': 'storage',
+        'files': args.files,
+        'file_size_mb': args.file_size,
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+
+# Requests a benchmark client sends on one connection before opening another,
+# so the kernel spreads the clients over the --workers processes
+REQUESTS_PER_CONNECTION = 20
+
+
+def request_load(port, kind, duration, upload_kb, timeout):
+    """Send requests of one kind back to back for duration seconds, run in
+    a client process of its own; returns (latencies, errors)"""
+    if kind == 'upload':
+        body = json.dumps({'fileName': 'load-%d.bin' % os.getpid(),
+                           'fileData': base64.b64encode(os.urandom(upload_kb * 1024)).decode('ascii')})
+        method, path, headers = 'POST', '/upload', {'Content-Type': 'application/json'}
+    else:
+        body = None
+        method, path, headers = 'GET', '/api/messages' if kind == 'messages' else '/api/files', {}
+
+    latencies = []
+    errors = 0
+    conn = None
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if conn is None or len(latencies) % REQUESTS_PER_CONNECTION == 0:
+            if conn is not None:
+                conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except OSError:
+            errors += 1
+            conn.close()
+            conn = None
+            continue
+        latencies.append(time.perf_counter() - start)
+    if conn is not None:
+        conn.close()
+    return latencies, errors
+
+
+def scenario_workers(args):
+    """Requests per second with 1 to N --workers processes"""
+    results = {}
+    for workers in args.workers:
+        with run_server(['--workers', str(workers)]) as (port, _, _):
+            for i in range(args.messages):
+                post_message(port, 'message %d ' % i + 'x' * 100, args.timeout)
+            upload_small_files(port, 0, args.files, args.timeout)
+            # Wait for every worker to have started and caught up
+            time.sleep(1)
+
+            level = {}
+            for kind in args.kinds:
+                with concurrent.futures.ProcessPoolExecutor(args.clients) as pool:
+                    futures = [pool.submit(request_load, port, kind, args.duration, args.upload_size,
+                                           args.timeout) for _ in range(args.clients)]
+                    outcomes = [future.result() for future in futures]
+                latencies = [latency for samples, _ in outcomes for latency in samples]
+                summary = latency_summary(latencies)
+                summary['requests_per_s'] = round(len(latencies) / args.duration, 1)
+                summary['errors'] = sum(errors for _, errors in outcomes)
+                level[kind] = summary
+
+            # Whichever worker answers, the lists must be the same: message
+            # ids and file names, as expiresIn moves with the clock
+            views = {'/api/messages': set(), '/api/files': set()}
+            for _ in range(20):
+                for path, seen in views.items():
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+                    conn.request('GET', path)
+                    items = json.loads(conn.getresponse().read())
+                    conn.close()
+                    key = 'id' if path == '/api/messages' else 'name'
+                    seen.add(tuple(sorted(item[key] for item in items)))
+            level['consistent'] = all(len(seen) == 1 for seen in views.values())
+            results[str(workers)] = level
+
+    return {
+        'scenario': 'workers',
+        'clients': args.clients,
+        'duration_s': args.duration,
+        'upload_kb': args.upload_size,
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--server', help='server script to benchmark (default: this checkout)')
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    p = sub.add_parser('upload', help='upload throughput and server peak RSS by file size')
+    p.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 1024], help='file sizes in MB')
+    p.add_argument('--endpoints', nargs='+', default=['stream', 'legacy'],
+                   choices=('stream', 'legacy'),
+                   help='stream: raw body to /upload/stream, legacy: base64 JSON to /upload')
+    p.add_argument('--legacy-max-size', type=int, default=100,
+                   help='skip legacy uploads above this size in MB (the client holds it all in memory)')
+    p.add_argument('--timeout', type=float, default=300)
+    p.set_defaults(func=scenario_upload)
+
+    p = sub.add_parser('download', help='download throughput from /shared_files/ by file size')
+    p.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 1024], help='file sizes in MB')
+    p.add_argument('--repeat', type=int, default=3, help='downloads per size, the best one counts')
+    p.add_argument('--timeout', type=float, default=300)
+    p.set_defaults(func=scenario_download)
+
+    p = sub.add_parser('polling', help='/api/messages and /api/files latency with N pollers')
+    p.add_argument('--pollers', type=int, nargs='+', default=[1, 8, 32])
+    p.add_argument('--messages', type=int, default=100, help='messages posted before polling')
+    p.add_argument('--files', type=int, default=50, help='files uploaded before polling')
+    p.add_argument('--poll-interval', type=float, default=0.1,
+                   help='pause between one client\'s requests in seconds (0 = back to back)')
+    p.add_argument('--duration', type=float, default=5, help='seconds per poller count and endpoint')
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_polling)
+
+    p = sub.add_parser('listing', help='/api/files latency as the number of files grows')
+    p.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    p.add_argument('--samples', type=int, default=50, help='list requests timed per count')
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_listing)
+
+    p = sub.add_parser('concurrency', help='slow downloads plus message polling clients')
+    p.add_argument('--downloads', type=int, default=4)
+    p.add_argument('--pollers', type=int, default=4)
+    p.add_argument('--file-size', type=int, default=32, help='shared file size in MB')
+    p.add_argument('--read-rate', type=float, default=16, help='per-download read rate in MB/s')
+    p.add_argument('--poll-interval', type=float, default=0.25)
+    p.add_argument('--threads', type=int, default=32)
+    p.add_argument('--timeout', type=float, default=30)
+    p.add_argument('--modes', nargs='+', default=['single', 'threaded'],
+                   choices=('single', 'threaded'))
+    p.set_defaults(func=scenario_concurrency)
+
+    p = sub.add_parser('messages', help='message store append and read cost')
+    p.add_argument('--iterations', type=int, default=2000)
+    p.add_argument('--message-size', type=int, default=200, help='message length in characters')
+    p.set_defaults(func=scenario_messages)
+
+    p = sub.add_parser('parallel-upload', help='chunked upload throughput by parallel streams')
+    p.add_argument('--parallel', type=int, nargs='+', default=[1, 2, 4, 8],
+                   help='chunks in flight for each run')
+    p.add_argument('--file-size', type=int, default=64, help='uploaded file size in MB')
+    p.add_argument('--chunk-size', type=int, default=4, help='chunk size in MB')
+    p.add_argument('--stream-rate', type=float, default=0,
+                   help='per-connection send rate in MB/s (0 = unthrottled)')
+    p.add_argument('--timeout', type=float, default=60)
+    p.set_defaults(func=scenario_parallel_upload)
+
+    p = sub.add_parser('keep-alive', help='connection setups and latency of polling clients')
+    p.add_argument('--pollers', type=int, default=16)
+    p.add_argument('--poll-interval', type=float, default=0.5,
+                   help='pause between one client\'s requests in seconds')
+    p.add_argument('--files', type=int, default=50, help='files in received_files')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_keep_alive)
+
+    p = sub.add_parser('dedup', help='disk use and send time for repeated identical files')
+    p.add_argument('--file-size', type=int, default=50, help='file size in MB')
+    p.add_argument('--copies', type=int, default=5, help='times the same file is sent')
+    p.add_argument('--timeout', type=float, default=120)
+    p.set_defaults(func=scenario_dedup)
+
+    p = sub.add_parser('batch', help='many small uploads: one request per file vs multipart batches')
+    p.add_argument('--files', type=int, default=200)
+    p.add_argument('--file-size', type=int, default=100, help='file size in KB')
+    p.add_argument('--batch-files', type=int, default=100, help='files per batch request')
+    p.add_argument('--rtt', type=float, default=20, help='round trip time per request in ms')
+    p.add_argument('--timeout', type=float, default=60)
+    p.set_defaults(func=scenario_batch)
+
+    p = sub.add_parser('archive', help='ZIP download of all shared files')
+    p.add_argument('--files', type=int, default=20)
+    p.add_argument('--file-size', type=int, default=50, help='file size in MB')
+    p.add_argument('--timeout', type=float, default=300)
+    p.set_defaults(func=scenario_archive)
+
+    p = sub.add_parser('compression', help='text upload over a throttled link, as-is vs gzipped')
+    p.add_argument('--file-size', type=int, default=20, help='file size in MB')
+    p.add_argument('--link-rate', type=float, default=2, help='link bandwidth in MB/s')
+    p.add_argument('--timeout', type=float, default=120)
+    p.set_defaults(func=scenario_compression)
+
+    p = sub.add_parser('storage', help='upload and download throughput per storage backend')
+    p.add_argument('--storages', nargs='+', default=['directory', 'spool', 'memory'],
+                   choices=('directory', 'spool', 'memory'))
+    p.add_argument('--files', type=int, default=8)
+    p.add_argument('--file-size', type=int, default=32, help='file size in MB')
+    p.add_argument('--repeat', type=int, default=3, help='times each file is downloaded')
+    p.add_argument('--timeout', type=float, default=120)
+    p.set_defaults(func=scenario_storage)
+
+    p = sub.add_parser('workers', help='requests per second by number of --workers processes')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--clients', type=int, default=8, help='client processes sending requests')
+    p.add_argument('--kinds', nargs='+', default=['messages', 'files', 'upload'],
+                   choices=('messages', 'files', 'upload'),
+                   help='GET /api/messages, GET /api/files, or base64 JSON POSTs to /upload')
+    p.add_argument('--messages', type=int, default=100, help='messages posted before measuring')
+    p.add_argument('--files', type=int, default=100, help='files uploaded before measuring')
+    p.add_argument('--upload-size', type=int, default=64, help='size of each upload in KB')
+    p.add_argument('--duration', type=float, default=5, help='seconds per request kind')
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_workers)
+
+    p = sub.add_parser('pairings', help='list latency of one pairing session by number of others')
+    p.add_argument('--others', type=int, nargs='+', default=[0, 10, 50],
+                   help='other pairing sessions, each with the same files and messages')
+    p.add_argument('--files', type=int, default=50, help='files uploaded in each session')
+    p.add_argument('--messages', type=int, default=20, help='messages posted in each session')
+    p.add_argument('--samples', type=int, default=200)
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_pairings)
+
+    p = sub.add_parser('fairness', help='throughput per client and poll latency by --max-rate')
+    p.add_argument('--rates', type=float, nargs='+', default=[0, 20],
+                   help='--max-rate in MB/s for each run, 0 for none')
+    p.add_argument('--download-streams', type=int, nargs='*', default=[3, 1],
+                   help='one downloading client per number, with that many parallel downloads')
+    p.add_argument('--upload-streams', type=int, nargs='*', default=[1],
+                   help='one uploading client per number, with that many parallel uploads')
+    p.add_argument('--file-size', type=int, default=256, help='size of the shared file in MB')
+    p.add_argument('--duration', type=float, default=10, help='seconds every run lasts')
+    p.add_argument('--pollers', type=int, default=2)
+    p.add_argument('--poll-interval', type=float, default=0.1)
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_fairness)
+
+    p = sub.add_parser('history', help='message list size and paging/search latency by history size')
+    p.add_argument('--counts', type=int, nargs='+', default=[1000, 10000],
+                   help='messages posted before each measurement')
+    p.add_argument('--long-every', type=int, default=20, help='every Nth message is a long paste (0 for none)')
+    p.add_argument('--long-size', type=int, default=20, help='size of the long messages in KB')
+    p.add_argument('--samples', type=int, default=200)
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_history)
+
+    p = sub.add_parser('startup', help='time until the server prints its URL and answers')
+    p.add_argument('--runs', type=int, default=10)
+    p.add_argument('--as-module', action='store_true')
+    p.add_argument('--timeout', type=float, default=30)
+    p.set_defaults(func=scenario_startup)
+
+    p = sub.add_parser('first-load', help='page load bytes and time over a slow link')
+    p.add_argument('--page', default='mobile.html', choices=('mobile.html', 'desktop.html'))
+    p.add_argument('--link-rate', type=float, default=250, help='link bandwidth in KB/s')
+    p.add_argument('--rtt', type=float, default=50, help='round trip time per request in ms')
+    p.set_defaults(func=scenario_first_load)
+
+    args = parser.parse_args(argv)
+    if args.server:
+        global SERVER
+        SERVER = os.path.abspath(args.server)
+    result = args.func(args)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        result['environment'] = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -52,9 +52,10 @@ if ! command -v python3 &> /dev/null; then
   exit 1
 fi
 
-# Start the server
+# Start the server; as a module, Python reuses its compiled bytecode
+# instead of compiling the script on every start
 echo "Starting Snap Send server..."
-python3 snap_send_server.py "$@"
+python3 -m snap_send_server "$@"
 EOF
 
 # Make the script executable
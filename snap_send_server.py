@@ -2,572 +2,5658 @@
 import http.server
 import socketserver
 import socket
-import webbrowser
 import os
+import stat
 import threading
+import collections
+import heapq
+import hashlib
+import secrets
+import queue
+import selectors
 import json
 import base64
-import random
 import time
 import datetime
-from urllib.parse import urlparse, parse_qs, unquote
+import email.message
+import email.utils
+import tempfile
+import zipfile
+import io
+import shutil
+import argparse
+import gzip
+import zlib
+import errno
+import struct
+import signal
+import sqlite3
+import bisect
+import contextlib
+import concurrent.futures
+import atexit
+import sys
+import logging
+import logging.handlers
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+# Server events and errors; per-request lines are logged at INFO
+logger = logging.getLogger('snap_send')
+
+# One JSON object per request, only written when --access-log is given
+access_logger = logging.getLogger('snap_send.access')
+access_logger.propagate = False
+access_logger.setLevel(logging.CRITICAL)
+
+# Brotli is optional; without it static assets are offered gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Pillow is optional; without it file listings come without thumbnails. Only
+# the package is imported here: its image modules load with the first
+# thumbnail made, as they take longer to import than the rest of startup
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+# fcntl is POSIX only; elsewhere the LAN address is found the slower way
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # File expiration time (seconds)
 FILE_EXPIRY_TIME = 300  # 5 minutes
 
-# Messages file path
-MESSAGES_FILE = "messages.json"
+# Content-addressed store the transferred files are hard links into
+BLOB_DIRECTORY = '.blobs'
+
+# Default root of --storage spool: memory-backed /dev/shm where there is one
+DEFAULT_SPOOL_DIRECTORY = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                       'snap-send')
+
+# Default cap on the bytes of file content --storage memory holds (MB)
+DEFAULT_MEMORY_STORAGE_MB = 512
+
+# Cached thumbnails of the image files, named by the identity of their source
+THUMBNAIL_DIRECTORY = '.thumbnails'
+
+# Longest edge of a thumbnail (pixels) and its JPEG quality
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+
+# Threads generating thumbnails; decoding is CPU-bound, so only a few
+THUMBNAIL_WORKERS = 2
+
+# Seconds a thumbnail request waits for one still being generated
+THUMBNAIL_WAIT = 10
+
+# File types thumbnails are made for
+THUMBNAIL_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'})
+
+# Transfer directories by the area name used in events
+FILE_AREAS = {'received': 'received_files', 'shared': 'shared_files'}
+FILE_AREAS_BY_DIRECTORY = {directory: area for area, directory in FILE_AREAS.items()}
+
+# Directory holding the transfer directories of each pairing session, by token
+PAIRING_DIRECTORY = 'pairings'
+
+# Cookie naming the pairing session of a browser
+PAIRING_COOKIE = 'snap_send_pairing'
+
+# Random bytes in a pairing session token
+PAIRING_TOKEN_BYTES = 12
+
+# How often sessions are checked for having gone idle (seconds)
+PAIRING_CHECK_INTERVAL = 30
+
+# How often, with --workers, a process tells the others a session is still in use (seconds)
+PAIRING_ACTIVITY_INTERVAL = 30
+
+# Paths whose answer depends on the pairing session, refused once it has ended
+PAIRING_PATHS = ('/api/messages', '/api/send-message', '/api/clear-messages', '/api/events',
+                 '/api/transfers', '/api/bandwidth', '/api/files', '/api/shared-files', '/api/uploads',
+                 '/api/blobs/', '/received_files/', '/shared_files/', '/upload')
+
+# Seconds between keep-alive comments on idle event streams
+EVENT_HEARTBEAT_INTERVAL = 15
+
+# Events buffered per /api/events stream before it is dropped as too slow
+EVENT_QUEUE_SIZE = 256
+
+# Minimum time between progress events for one transfer (seconds); quicker transfers send none
+TRANSFER_PROGRESS_INTERVAL = 0.5
+
+# A transfer without progress for this long is reported as stalled (seconds)
+TRANSFER_STALLED_AFTER = 5
+
+# Chunk size for resumable uploads, suggested by the client within these bounds (bytes)
+DEFAULT_UPLOAD_SESSION_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_UPLOAD_SESSION_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SESSION_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Unfinished chunked uploads are discarded after this long without a chunk (seconds)
+UPLOAD_SESSION_TIMEOUT = 30 * 60
+
+# Upload bodies written at the same time across all clients
+MAX_UPLOAD_WRITERS = 16
+
+# Upload bytes one client may have in flight at once (e.g. parallel chunks)
+MAX_CLIENT_INFLIGHT_BYTES = 32 * 1024 * 1024
+
+# How often the bandwidth scheduler shares the rate limits out again (seconds)
+BANDWIDTH_INTERVAL = 0.5
+
+# Size of the pieces downloads are sent in while a rate limit applies, so
+# paced bytes go out smoothly rather than in DOWNLOAD_CHUNK_SIZE bursts
+BANDWIDTH_PIECE_SIZE = 64 * 1024
+
+# A rate-limited transfer may get ahead of its rate by this many seconds' worth
+BANDWIDTH_BURST_TIME = 0.1
+
+# Share of --max-rate transfers keep however much the API responses take
+BANDWIDTH_BULK_FLOOR = 0.1
+
+# Lowest rate a transfer is given, even one that has been idle (bytes/s)
+BANDWIDTH_MIN_RATE = 64 * 1024
+
+# How long to keep reading (and discarding) a rejected upload body so the
+# client gets to see the rejection instead of a connection reset (seconds)
+REJECTED_BODY_DRAIN_TIMEOUT = 5
+
+# Size of the pieces a streamed upload is copied to disk in (bytes)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Files stored as-is in ZIP downloads, since deflate can't shrink them
+COMPRESSED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif',
+    '.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi', '.3gp',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.br',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.apk', '.jar',
+})
+
+# zlib level for the other files in ZIP downloads; 1 keeps up with a LAN
+ARCHIVE_COMPRESS_LEVEL = 1
+
+# Largest piece of a download handed to sendfile() in one call (bytes)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Port tried first when --port isn't given; if it is taken the system picks one
+DEFAULT_PORT = 8000
+
+# Default number of worker threads in threaded mode
+DEFAULT_WORKER_THREADS = 32
+
+# Database through which the --workers processes share their changes
+WORKERS_DATABASE = "snap-send-workers.db"
+
+# How often each worker process looks for the others' changes between requests (seconds)
+WORKER_SYNC_INTERVAL = 0.05
+
+# How long changes other than messages stay in the log for workers to catch up (seconds)
+WORKER_SYNC_RETENTION = 60
+
+# How often the supervisor deletes the changes no worker needs any more (seconds)
+WORKER_PRUNE_INTERVAL = 10
+
+# A worker process failing sooner than this after it started can't start at all (seconds)
+WORKER_MIN_LIFETIME = 5
+
+# Change kinds applied through the log by the worker that made them too
+WORKER_ORDERED_KINDS = ('message', 'messages-cleared')
+
+# Connections waiting to be accepted before new ones are refused
+LISTEN_BACKLOG = 128
+
+# Idle keep-alive connections are closed after this long (seconds)
+KEEP_ALIVE_TIMEOUT = 15
+
+# Requests served on one connection before it is closed
+KEEP_ALIVE_MAX_REQUESTS = 100
+
+# Idle keep-alive connections held at once; the longest idle are closed beyond this
+MAX_IDLE_CONNECTIONS = 128
+
+# Request body left unread by a handler that is skipped to reuse the connection (bytes)
+MAX_SKIP_BODY_BYTES = 64 * 1024
+
+# Web interface files, loaded into memory at startup
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_PAGES = ('desktop.html', 'mobile.html', '404.html')
+STATIC_ASSETS = ('style.css', 'qrcode.min.js', 'upload_client.js', 'transfer_list.js',
+                 'desktop_main.js', 'mobile_main.js')
+STATIC_CONTENT_TYPES = {
+    '.html': 'text/html; charset=UTF-8',
+    '.js': 'application/javascript; charset=UTF-8',
+    '.css': 'text/css; charset=UTF-8',
+}
+
+# Placeholders in the static files replaced with the server's own values, so
+# the pages don't keep copies of tables that could drift from these
+STATIC_PLACEHOLDERS = {
+    b'/* COMPRESSED_EXTENSIONS */[]': json.dumps(sorted(COMPRESSED_EXTENSIONS)).encode('utf-8'),
+}
+
+# Static files smaller than this are only sent uncompressed (bytes)
+MIN_COMPRESS_SIZE = 512
+
+# Request latency histogram bucket bounds (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upload and download duration histogram bucket bounds (seconds)
+TRANSFER_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# Current throughput is averaged over this many whole seconds
+THROUGHPUT_WINDOW = 5
+
+# Routes reported in metrics; any other path is counted as "other"
+METRIC_ROUTES = frozenset({
+    '/', '/static', '/api/pairing', '/api/messages', '/api/messages/search', '/api/messages/<id>',
+    '/api/events', '/api/clear-messages', '/api/send-message',
+    '/api/files', '/api/shared-files', '/api/files/archive', '/api/shared-files/archive',
+    '/api/files/thumbnail', '/api/shared-files/thumbnail',
+    '/api/metrics', '/api/transfers', '/api/bandwidth', '/api/addresses',
+    '/api/uploads', '/api/uploads/<id>', '/api/uploads/<id>/chunks/<n>',
+    '/api/uploads/<id>/complete', '/api/blobs/<sha256>', '/api/blobs/<sha256>/link',
+    '/received_files/<name>', '/shared_files/<name>', '/upload', '/upload-to-mobile',
+    '/upload/stream', '/upload-to-mobile/stream', '/upload/batch', '/upload-to-mobile/batch',
+})
+
+# Snapshot of the message list, compacted from the journal
+MESSAGES_FILE = "messages.json"
+
+# Append-only log of message changes since the last snapshot
+MESSAGES_JOURNAL_FILE = "messages.journal"
+
+# Number of messages kept
+MAX_MESSAGES = 100
+
+# Journal entries written before it is compacted into the snapshot
+JOURNAL_COMPACT_THRESHOLD = 500
+
+# Every message of the last --history-days, with a full-text index
+HISTORY_DATABASE = "messages-history.db"
+
+# How often messages past --history-days are deleted, at most (seconds)
+HISTORY_PRUNE_INTERVAL = 60 * 60
+
+# The full-text index is of character trigrams, so it can only narrow a search
+# by words at least this long; shorter ones are looked for in every message
+FULL_TEXT_MIN_TERM = 3
+
+# Longer messages are listed as a preview of this many characters
+MESSAGE_PREVIEW_LENGTH = 1000
+
+# Messages per page of /api/messages?before= and of search results, by default and at most
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 500
+
+
+class MessageStore:
+    """The last MAX_MESSAGES chat messages, held in memory.
+
+    Reads never touch the disk. Every change is appended to the journal as
+    one JSON line, and once JOURNAL_COMPACT_THRESHOLD entries have piled up
+    the current list is written to the snapshot file and the journal is
+    truncated. Each journal entry carries a sequence number that the
+    snapshot records, so a crash between the two steps can't replay an
+    entry twice.
+
+    The sequence number doubles as the sync cursor: an added message takes
+    it as its id, and since every change bumps it, clients can ask for
+    changes after the last cursor they saw and use it as an ETag.
+
+    With --workers the changes go to the log of WorkerSync instead of the
+    journal, and every process applies them from there with apply_shared().
+
+    The store of a pairing session (token set, no paths) is kept in memory
+    only and lives as long as the pairing. With --history-days every
+    message also goes to MessageHistory, which older pages and search
+    reach past the ones held here."""
+
+    def __init__(self, snapshot_path=MESSAGES_FILE, journal_path=MESSAGES_JOURNAL_FILE,
+                 max_messages=MAX_MESSAGES, token=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.token = token
+        self.lock = threading.Lock()
+        self.messages = collections.deque(maxlen=max_messages)
+        self.seq = 0
+        self.cleared_seq = 0
+        self.journal = None
+        self.journal_entries = 0
+
+    def load(self):
+        """Recover from the snapshot and journal, then start a fresh journal"""
+        with self.lock:
+            self.messages.clear()
+            self.seq = 0
+            self.cleared_seq = 0
+
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    data = json.load(f)
+                self.messages.extend(data["messages"])
+                self.seq = data.get("seq", 0)
+                self.cleared_seq = data.get("cleared_seq", 0)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Error reading messages file, resetting: {e}")
+
+            replayed = 0
+            try:
+                with open(self.journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A torn final line from a crash mid-write
+                            break
+                        if entry["seq"] <= self.seq:
+                            continue
+                        self.apply(entry)
+                        self.seq = entry["seq"]
+                        replayed += 1
+            except FileNotFoundError:
+                pass
+
+            if replayed:
+                logger.info(f"Recovered {replayed} message change(s) from {self.journal_path}")
+
+            # Those made while --workers ran, up to when they stopped
+            leftover = worker_sync.leftover_messages(self.seq)
+            for entry in leftover:
+                self.apply(entry)
+                self.seq = entry["seq"]
+            if leftover:
+                logger.info(f"Recovered {len(leftover)} message change(s) from {worker_sync.path}")
+
+            # Messages from before ids existed get ids ahead of the recovered ones
+            for message in self.messages:
+                if "id" not in message:
+                    self.seq += 1
+                    message["id"] = self.seq
+            # Ids go on from the history's, which may hold cleared ones
+            self.seq = max(self.seq, history.last_id(self.token))
+            self.compact()
+            worker_sync.remove()
+
+    def resume(self, messages):
+        """Start a pairing session's store from its latest messages in the
+        history, taking ids on from the last one"""
+        with self.lock:
+            self.messages.extend(messages)
+            self.seq = history.last_id(self.token)
+
+    def apply(self, entry):
+        if entry["op"] == "add":
+            self.messages.append(entry["message"])
+        elif entry["op"] == "clear":
+            self.messages.clear()
+            self.cleared_seq = entry["seq"]
+
+    def apply_shared(self, entry):
+        """Apply an entry from the workers' log unless it is already in;
+        returns whether it was applied"""
+        with self.lock:
+            if entry["seq"] <= self.seq:
+                return False
+            self.apply(entry)
+            self.seq = entry["seq"]
+            return True
+
+    def entries(self):
+        """Journal entries that rebuild the current list"""
+        with self.lock:
+            entries = [{"seq": self.cleared_seq, "op": "clear"}] if self.cleared_seq else []
+            entries += [{"seq": message["id"], "op": "add", "message": message}
+                        for message in self.messages]
+            return entries
+
+    def record(self, entry):
+        """Apply entry and append it to the journal; caller holds the lock"""
+        self.seq += 1
+        entry["seq"] = self.seq
+        if entry["op"] == "add":
+            entry["message"]["id"] = self.seq
+        self.apply(entry)
+        if self.journal_path is None:
+            return
+
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        self.journal_entries += 1
+
+        if self.journal_entries >= JOURNAL_COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        """Write the snapshot and truncate the journal; caller holds the lock"""
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({"seq": self.seq, "cleared_seq": self.cleared_seq,
+                       "messages": list(self.messages)}, f)
+        os.replace(temp_path, self.snapshot_path)
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'w')
+        self.journal_entries = 0
+
+    def add(self, sender, content):
+        message = {
+            "sender": sender,
+            "content": content,
+            "timestamp": time.time(),
+            "time": datetime.datetime.now().strftime("%H:%M:%S")
+        }
+        if worker_sync.active:
+            message["id"] = worker_sync.append('message', self.tagged(message))
+            worker_sync.catch_up(force=True)
+            return message
+        with self.lock:
+            self.record({"op": "add", "message": message})
+        return message
+
+    def list(self):
+        with self.lock:
+            return list(self.messages)
+
+    def changes_since(self, since):
+        """Return (messages, cursor, reset) for a client whose cursor is since.
+
+        reset is True when the client's view can't be patched incrementally
+        (messages were cleared after since, or since is from an older store),
+        in which case messages holds the full list to render afresh."""
+        with self.lock:
+            cursor = self.seq
+            if since is None or since < self.cleared_seq or since > self.seq:
+                return list(self.messages), cursor, since is not None
+
+            newer = []
+            for message in reversed(self.messages):
+                if message["id"] <= since:
+                    break
+                newer.append(message)
+            newer.reverse()
+            return newer, cursor, False
+
+    def cursor(self):
+        with self.lock:
+            return self.seq
+
+    def get(self, message_id):
+        with self.lock:
+            for message in self.messages:
+                if message["id"] == message_id:
+                    return message
+        return None
+
+    def page(self, before, limit):
+        """Up to limit messages with ids below before (None for the
+        latest), oldest first"""
+        with self.lock:
+            older = [message for message in self.messages if before is None or message["id"] < before]
+        return older[-limit:]
+
+    def search(self, terms, before, limit):
+        """Up to limit messages with ids below before that contain all
+        of terms (lowercase), newest first"""
+        found = []
+        with self.lock:
+            for message in reversed(self.messages):
+                if len(found) == limit:
+                    break
+                if before is not None and message["id"] >= before:
+                    continue
+                content = message["content"].lower()
+                if all(term in content for term in terms):
+                    found.append(message)
+        return found
+
+    def clear(self):
+        if worker_sync.active:
+            seq = worker_sync.append('messages-cleared', self.tagged({}))
+            worker_sync.catch_up(force=True)
+            return seq
+        with self.lock:
+            self.record({"op": "clear"})
+            return self.seq
+
+    def tagged(self, data):
+        """data for the workers' log, naming the pairing it belongs to"""
+        return data if self.token is None else dict(data, pairing=self.token)
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+# Messages of the default pairing session; loaded in main()
+message_store = MessageStore()
+
+
+class MessageHistory:
+    """Every message of the last --history-days, in a SQLite database with
+    a full-text index, for paging back past the MAX_MESSAGES a
+    MessageStore holds and for searching.
+
+    A message body is stored once per distinct text, by SHA-256, so a long
+    text pasted again takes no more room; the FTS5 table bodies_fts indexes
+    the trigrams of the bodies, kept up to date by triggers. Search matches
+    words anywhere in a message, ignoring case, as MessageStore.search
+    does: the index narrows it down to the bodies with every word of
+    FULL_TEXT_MIN_TERM or more characters somewhere, and contains() checks
+    each of those for all the words. Messages past the retention are left
+    out of every query and deleted, with the bodies no message refers to
+    any more, at most every HISTORY_PRUNE_INTERVAL as messages are added.
+    Where the sqlite3 module has no FTS5 trigram tokenizer, search reads
+    through all the bodies with contains().
+
+    Each thread has its own connection. With --workers every process
+    writes the messages it adds itself, which WAL mode lets them do side
+    by side, and the ids the log gives them are unique in their pairing."""
+
+    def __init__(self, path=HISTORY_DATABASE):
+        self.path = path
+        # Seconds messages are kept; None when there is no history
+        self.retention = None
+        self.local = threading.local()
+        self.full_text = False
+        self.pruned = 0
+
+    @property
+    def enabled(self):
+        return self.retention is not None
+
+    def connect(self):
+        """This thread's connection; SQLite connections can't be shared"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            # Python's lower(), not SQLite's, which leaves all but ASCII alone
+            connection.create_function('contains', 2, lambda content, term: term in content.lower(),
+                                       deterministic=True)
+            self.local.connection = connection
+        return connection
+
+    def open(self, retention):
+        """Create or open the database, keeping messages for retention seconds"""
+        self.retention = retention
+        self.local = threading.local()
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS bodies (id INTEGER PRIMARY KEY, sha256 TEXT NOT NULL UNIQUE,
+                                               content TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS messages (row INTEGER PRIMARY KEY, pairing TEXT NOT NULL,
+                                                 id INTEGER NOT NULL, sender TEXT NOT NULL,
+                                                 timestamp REAL NOT NULL, time TEXT NOT NULL,
+                                                 body INTEGER NOT NULL REFERENCES bodies (id),
+                                                 UNIQUE (pairing, id));
+            CREATE INDEX IF NOT EXISTS messages_body ON messages (body);
+            CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+        ''')
+        index = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'bodies_fts'").fetchone()
+        if index is not None and 'trigram' not in index[0]:
+            # Indexed by words by an earlier version, which only found whole words
+            connection.executescript('''
+                DROP TRIGGER IF EXISTS bodies_indexed;
+                DROP TRIGGER IF EXISTS bodies_unindexed;
+                DROP TABLE bodies_fts;
+            ''')
+        indexed = connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                                     "AND name = 'bodies_indexed'").fetchone()[0]
+        try:
+            connection.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS bodies_fts USING fts5 (content, content='bodies',
+                                                                           content_rowid='id',
+                                                                           tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS bodies_indexed AFTER INSERT ON bodies BEGIN
+                    INSERT INTO bodies_fts (rowid, content) VALUES (new.id, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS bodies_unindexed AFTER DELETE ON bodies BEGIN
+                    INSERT INTO bodies_fts (bodies_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END;
+            ''')
+            # Bodies stored while there was no FTS5 aren't in the index
+            if not indexed:
+                connection.execute("INSERT INTO bodies_fts (bodies_fts) VALUES ('rebuild')")
+                connection.commit()
+            self.full_text = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"No full-text index for message search ({e}); searching without it")
+            # Triggers of an earlier run would fail every insert
+            connection.executescript('''
+                DROP TRIGGER IF EXISTS bodies_indexed;
+                DROP TRIGGER IF EXISTS bodies_unindexed;
+            ''')
+            self.full_text = False
+        self.prune()
+
+    def after_fork(self):
+        """Drop the connection inherited from the supervisor process"""
+        self.local = threading.local()
+
+    def add(self, token, message):
+        if not self.enabled:
+            return
+        content = message['content']
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        connection = self.connect()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO bodies (sha256, content) VALUES (?, ?)',
+                               (digest, content))
+            connection.execute('INSERT OR IGNORE INTO messages (pairing, id, sender, timestamp, time, body) '
+                               'SELECT ?, ?, ?, ?, ?, id FROM bodies WHERE sha256 = ?',
+                               (token or '', message['id'], message['sender'], message['timestamp'],
+                                message['time'], digest))
+        if time.monotonic() - self.pruned >= HISTORY_PRUNE_INTERVAL:
+            self.prune()
+
+    def clear(self, token):
+        """Delete the messages of a pairing session"""
+        if not self.enabled:
+            return
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM messages WHERE pairing = ?', (token or '',))
+            self.remove_orphans(connection)
+
+    def prune(self):
+        """Delete the messages older than the retention"""
+        self.pruned = time.monotonic()
+        connection = self.connect()
+        with connection:
+            deleted = connection.execute('DELETE FROM messages WHERE timestamp < ?',
+                                         (time.time() - self.retention,)).rowcount
+            self.remove_orphans(connection)
+        if deleted:
+            logger.info(f"Deleted {deleted} message(s) older than the history keeps")
+
+    def remove_orphans(self, connection):
+        connection.execute('DELETE FROM bodies WHERE NOT EXISTS '
+                           '(SELECT 1 FROM messages WHERE messages.body = bodies.id)')
+
+    def last_id(self, token=None):
+        """The highest message id of a pairing session, 0 if none"""
+        if not self.enabled:
+            return 0
+        row = self.connect().execute('SELECT max(id) FROM messages WHERE pairing = ?',
+                                     (token or '',)).fetchone()
+        return row[0] or 0
+
+    def highest_id(self):
+        """The highest message id of any pairing session, 0 if none"""
+        if not self.enabled:
+            return 0
+        return self.connect().execute('SELECT max(id) FROM messages').fetchone()[0] or 0
+
+    def select(self, where, parameters, limit):
+        """Messages matching where, newest first; the retention applies"""
+        rows = self.connect().execute(
+            'SELECT messages.id, sender, timestamp, time, bodies.content FROM messages '
+            'JOIN bodies ON bodies.id = messages.body '
+            f'WHERE {where} AND timestamp >= ? ORDER BY messages.id DESC LIMIT ?',
+            (*parameters, time.time() - self.retention, limit)).fetchall()
+        return [{'sender': sender, 'content': content, 'timestamp': timestamp, 'time': clock, 'id': message_id}
+                for message_id, sender, timestamp, clock, content in rows]
+
+    def get(self, token, message_id):
+        if not self.enabled:
+            return None
+        found = self.select('pairing = ? AND messages.id = ?', (token or '', message_id), 1)
+        return found[0] if found else None
+
+    def page(self, token, before, limit):
+        """Up to limit messages with ids below before (None for the
+        latest), oldest first"""
+        if not self.enabled:
+            return []
+        found = self.select('pairing = ? AND messages.id < ?',
+                            (token or '', before if before is not None else 2 ** 63 - 1), limit)
+        found.reverse()
+        return found
+
+    def latest(self, token, count):
+        return self.page(token, None, count)
+
+    def search(self, token, terms, before, limit):
+        """Up to limit messages with ids below before that contain all of
+        terms (lowercase), newest first"""
+        if not self.enabled:
+            return []
+        where = 'pairing = ? AND messages.id < ?'
+        parameters = [token or '', before if before is not None else 2 ** 63 - 1]
+        indexed_terms = [term for term in terms if len(term) >= FULL_TEXT_MIN_TERM]
+        if self.full_text and indexed_terms:
+            # The index finds the bodies, rather than being asked about each
+            # message in turn; each term is quoted, so no input is taken as
+            # query syntax
+            where += ' AND body IN (SELECT rowid FROM bodies_fts WHERE bodies_fts MATCH ?)'
+            parameters.append(' '.join('"%s"' % term.replace('"', '""') for term in indexed_terms))
+        for term in terms:
+            where += ' AND contains(bodies.content, ?)'
+            parameters.append(term)
+        return self.select(where, parameters, limit)
+
+
+# Off unless --history-days is given
+history = MessageHistory()
+
+# A message as list responses and events carry it: long ones cut short
+
+
+def message_preview(message, terms=()):
+    """message, or for one longer than MESSAGE_PREVIEW_LENGTH a copy with
+    that much of it, around the first of terms found if given, and a link
+    to the whole text"""
+    content = message['content']
+    if len(content) <= MESSAGE_PREVIEW_LENGTH:
+        return message
+    lowered = content.lower()
+    found = [position for position in (lowered.find(term) for term in terms) if position >= 0]
+    start = max(0, min(found) - MESSAGE_PREVIEW_LENGTH // 4) if found else 0
+    start = min(start, len(content) - MESSAGE_PREVIEW_LENGTH)
+    end = start + MESSAGE_PREVIEW_LENGTH
+    preview = content[start:end]
+    if start:
+        preview = '…' + preview
+    if end < len(content):
+        preview += '…'
+    return dict(message, content=preview, truncated=True, length=len(content),
+                url=f"/api/messages/{message['id']}")
+
+# Add a new message to a pairing session
+
+
+def add_message(pairing, sender, content):
+    try:
+        message = pairing.messages.add(sender, content)
+    except Exception as e:
+        logger.error(f"Error adding message: {e}")
+        return None
+
+    try:
+        history.add(pairing.token, message)
+    except sqlite3.Error as e:
+        logger.error(f"Error adding a message to the history: {e}")
+
+    pairing.events.publish('message', {'message': message_preview(message), 'cursor': message['id']})
+    return message
+
+# Clear all messages of a pairing session
+
+
+def clear_messages(pairing):
+    try:
+        cursor = pairing.messages.clear()
+        history.clear(pairing.token)
+    except Exception as e:
+        logger.error(f"Error clearing messages: {e}")
+        return False
+
+    pairing.events.publish('messages-cleared', {'cursor': cursor})
+    return True
+
+# Older messages and search results of a pairing session, from the ones in
+# memory and the history together (it lacks those from before it was on)
+
+
+def message_page(pairing, before, limit):
+    """Up to limit messages with ids below before (None for the latest),
+    oldest first, and whether there are older ones"""
+    found = {message['id']: message for message in pairing.messages.page(before, limit + 1)}
+    found.update((message['id'], message) for message in history.page(pairing.token, before, limit + 1))
+    ids = sorted(found)
+    return [found[message_id] for message_id in ids[-limit:]], len(ids) > limit
+
+
+def search_messages(pairing, terms, before, limit):
+    """Up to limit messages with ids below before containing all of terms,
+    newest first, and whether there are more"""
+    found = {message['id']: message for message in pairing.messages.search(terms, before, limit + 1)}
+    found.update((message['id'], message)
+                 for message in history.search(pairing.token, terms, before, limit + 1))
+    ids = sorted(found, reverse=True)
+    return [found[message_id] for message_id in ids[:limit]], len(ids) > limit
+
+
+def find_message(pairing, message_id):
+    return pairing.messages.get(message_id) or history.get(pairing.token, message_id)
+
+# Events pushed to /api/events subscribers
+
+
+class EventBroker:
+    """Fans server events out to the connected /api/events streams.
+
+    Each subscriber gets a bounded queue. A subscriber that falls too far
+    behind is dropped rather than buffering without limit; its stream then
+    ends and the browser reconnects and resyncs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self, limit):
+        """Return a new subscriber queue, or None if limit streams are open"""
+        with self.lock:
+            if len(self.subscribers) >= limit:
+                return None
+            subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        payload = json.dumps(data)
+        with self.lock:
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.put_nowait((event, payload))
+                except queue.Full:
+                    self.subscribers.discard(subscriber)
+
+
+# Events of the default pairing session
+event_broker = EventBroker()
+
+# The area name of a transfer directory, whichever pairing session it belongs to
+
+
+def file_area(directory):
+    return FILE_AREAS_BY_DIRECTORY[directory.rpartition('/')[2]]
+
+# In-progress uploads and downloads, for /api/transfers and 'transfer' events
+
+
+class Transfer:
+    """Progress of one upload or download: bytes so far, rate and ETA.
+
+    advance() is called from the thread moving the data (several threads
+    for the parallel chunks of one upload). The rate is a moving average
+    sampled every TRANSFER_PROGRESS_INTERVAL, which is also how often a
+    'transfer' event is published. A transfer that is over before the
+    first sample publishes nothing; the file list event covers it.
+    advance() also meters the bytes through the bandwidth scheduler, which
+    holds the calling thread while the transfer is over its rate."""
+
+    def __init__(self, registry, transfer_id, direction, directory, name, size, client, transferred=0):
+        self.registry = registry
+        self.id = transfer_id
+        self.direction = direction
+        self.area = file_area(directory)
+        self.name = name
+        self.size = size
+        self.client = client
+        self.transferred = transferred
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.sample_time = time.monotonic()
+        self.sample_bytes = transferred
+        self.last_progress = self.sample_time
+        self.rate = None
+        self.published = False
+
+    def advance(self, count):
+        now = time.monotonic()
+        with self.lock:
+            self.transferred += count
+            self.last_progress = now
+            elapsed = now - self.sample_time
+            sampled = elapsed >= TRANSFER_PROGRESS_INTERVAL
+            if sampled:
+                rate = (self.transferred - self.sample_bytes) / elapsed
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+                self.sample_time = now
+                self.sample_bytes = self.transferred
+                self.published = True
+        if sampled:
+            self.registry.publish(self.describe())
+        # Holds the thread while the transfer is over its rate limit
+        bandwidth.meter(self, count)
+
+    def credit(self, count):
+        """Count bytes another worker process moved for this transfer,
+        leaving the rate to the bytes moved here"""
+        with self.lock:
+            self.transferred += count
+            self.sample_bytes += count
+
+    def counted(self, chunks):
+        """Pass chunks through, advancing by the size of each"""
+        for chunk in chunks:
+            self.advance(len(chunk))
+            yield chunk
+
+    def describe(self, state=None):
+        now = time.monotonic()
+        with self.lock:
+            transferred = self.transferred
+            rate = self.rate
+            if state is None:
+                state = 'stalled' if now - self.last_progress > TRANSFER_STALLED_AFTER else 'active'
+        if state == 'stalled':
+            rate = 0
+        eta = None
+        if state == 'active' and rate and self.size is not None:
+            eta = round(max(0, self.size - transferred) / rate, 1)
+        return {
+            'id': self.id,
+            'direction': self.direction,
+            'area': self.area,
+            'name': self.name,
+            'size': self.size,
+            'transferred': transferred,
+            'rate': None if rate is None else round(rate),
+            'eta': eta,
+            'state': state,
+            'started': self.started,
+        }
+
+
+class TransferRegistry:
+    """The transfers in progress of one pairing session by id, along with
+    the last event of those other worker processes run (see WorkerSync)"""
+
+    def __init__(self, token, events):
+        self.token = token
+        self.events = events
+        self.lock = threading.Lock()
+        self.transfers = {}
+        # Transfer id -> (last description, time.monotonic() it arrived)
+        self.remote = {}
+
+    def start(self, direction, directory, name, size, client, transfer_id=None, transferred=0):
+        """Register a new transfer, or return the one already under transfer_id"""
+        transfer = Transfer(self, transfer_id or secrets.token_hex(8), direction, directory, name,
+                            size, client, transferred)
+        with self.lock:
+            return self.transfers.setdefault(transfer.id, transfer)
+
+    def get(self, transfer_id):
+        with self.lock:
+            return self.transfers.get(transfer_id)
+
+    def finish(self, transfer_id, state='done'):
+        """Remove a transfer; state is 'done' or 'failed'"""
+        with self.lock:
+            transfer = self.transfers.pop(transfer_id, None)
+        if transfer is None:
+            return
+        bandwidth.release(transfer)
+        if transfer.published:
+            self.publish(transfer.describe(state))
+
+    def discard(self, transfer_id):
+        """Drop a transfer another worker finished, without an event"""
+        with self.lock:
+            self.transfers.pop(transfer_id, None)
+
+    def publish(self, description):
+        self.events.publish('transfer', description)
+        worker_sync.announce('transfer', {'pairing': self.token, 'transfer': description})
+
+    def apply_remote(self, description):
+        """Track a transfer from another worker's event and pass the event on"""
+        with self.lock:
+            if description['state'] in ('done', 'failed'):
+                self.remote.pop(description['id'], None)
+            else:
+                self.remote[description['id']] = (description, time.monotonic())
+        self.events.publish('transfer', description)
+
+    @contextlib.contextmanager
+    def track(self, direction, directory, name, size, client):
+        """Register a transfer, also with the metrics, for the duration of
+        the block; it counts as failed if the block raises"""
+        transfer = self.start(direction, directory, name, size, client)
+        state = 'failed'
+        try:
+            with metrics.transfer(direction):
+                yield transfer
+            state = 'done'
+        finally:
+            self.finish(transfer.id, state)
+
+    def listing(self):
+        now = time.monotonic()
+        with self.lock:
+            active = list(self.transfers.values())
+            # A worker that died mid-transfer never reports the end
+            for transfer_id, (_, received) in list(self.remote.items()):
+                if now - received > UPLOAD_SESSION_TIMEOUT:
+                    del self.remote[transfer_id]
+            remote = [(description, received) for description, received in self.remote.values()
+                      if description['id'] not in self.transfers]
+        described = [transfer.describe() for transfer in active]
+        for description, received in remote:
+            if now - received > TRANSFER_STALLED_AFTER:
+                description = dict(description, state='stalled', rate=0, eta=None)
+            described.append(description)
+        return sorted(described, key=lambda t: t['started'])
+
+
+# Transfers of the default pairing session
+transfers = TransferRegistry(None, event_broker)
+
+
+def is_sha256(value):
+    return isinstance(value, str) and len(value) == 64 and \
+        all(c in '0123456789abcdef' for c in value.lower())
+
+
+class ChecksumMismatch(ValueError):
+    """An upload's bytes don't match the SHA-256 the client announced"""
+
+
+class InvalidEncoding(ValueError):
+    """A request body isn't valid in its Content-Encoding"""
+
+
+class ChunkLengthMismatch(ValueError):
+    """A chunk of a resumable upload, once decoded, isn't the chunk's length"""
+
+
+class StorageFull(OSError):
+    """The storage has no room for an upload, even after evicting files"""
+
+
+# The directory holding the transfer directory's BLOB_DIRECTORY: that of its
+# pairing session, or the root for the default one. Blobs are never shared
+# between sessions, so no session can find out or link what another holds
+
+
+def blob_scope(directory):
+    return os.path.dirname(directory)
+
+
+class BlobStore:
+    """Content-addressed storage behind received_files and shared_files.
+
+    Every finished upload is kept once as BLOB_DIRECTORY/<sha256> next to
+    its transfer directory, so each pairing session has its own blobs, and
+    the names in the transfer directories are hard links to it. Sending the
+    same bytes again within the session, under any name or in either
+    direction, costs a link rather than a copy, and a client that knows the
+    hash can skip the upload entirely (link_name). The link count is the
+    reference count: a blob whose only link is its own entry is no longer
+    named anywhere, and collect() deletes it. The names stay ordinary files,
+    so the folders can still be opened directly.
+
+    Hard links share their modification time, which expiry runs on, so
+    linking refreshes it: all names of a blob expire FILE_EXPIRY_TIME after
+    the most recent upload of that content. Where the filesystem has no
+    hard links, uploads are stored as plain files."""
+
+    def __init__(self):
+        self.enabled = True
+
+    def path(self, directory, digest):
+        """The blob for a file of the transfer directory directory"""
+        return os.path.join(blob_scope(directory), BLOB_DIRECTORY, digest.lower())
+
+    def lookup(self, digest, directory):
+        """Size of the blob with this hex SHA-256 stored for directory's
+        session, or None"""
+        if not is_sha256(digest):
+            return None
+        try:
+            return os.stat(self.path(directory, digest)).st_size
+        except OSError:
+            return None
+
+    def place(self, temp_path, digest, target_path):
+        """Move a finished upload from temp_path to target_path, keeping its
+        bytes only if no blob with the same digest exists yet.
+        Returns True if the upload was deduplicated."""
+        deduplicated = False
+        if self.enabled:
+            try:
+                deduplicated = self.link_to_blob(temp_path, digest)
+            except OSError as e:
+                logger.warning(f"Hard links not available, storing files without deduplication: {e}")
+                self.enabled = False
+        self.replace(temp_path, target_path)
+        return deduplicated
+
+    def link_to_blob(self, temp_path, digest):
+        blob_path = self.path(os.path.dirname(temp_path), digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            # New content: the upload itself becomes the blob
+            os.link(temp_path, blob_path)
+            return False
+        except FileExistsError:
+            pass
+
+        # Seen before: swap the uploaded copy for another link to the blob
+        link_path = temp_path + '.link'
+        try:
+            os.link(blob_path, link_path)
+        except FileNotFoundError:
+            # Collected in the meantime; keep the upload as it is
+            return False
+        os.replace(link_path, temp_path)
+        os.utime(temp_path)
+        return True
+
+    def link_name(self, digest, target_path):
+        """Create target_path from the stored blob, without an upload.
+        Returns the file size, or None if there is no such blob."""
+        if not self.enabled or not is_sha256(digest):
+            return None
+        directory = os.path.dirname(target_path)
+        link_path = os.path.join(directory, f'.link-{secrets.token_hex(8)}')
+        try:
+            os.link(self.path(directory, digest), link_path)
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(link_path)
+            size = os.stat(link_path).st_size
+            self.replace(link_path, target_path)
+        except BaseException:
+            try:
+                os.remove(link_path)
+            except OSError:
+                pass
+            raise
+        return size
+
+    def replace(self, temp_path, target_path):
+        try:
+            if os.path.samefile(temp_path, target_path):
+                # The same bytes again under the same name; rename() would
+                # leave both links in place
+                os.remove(temp_path)
+                return
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, target_path)
+
+    def collect(self, directory):
+        """Delete the blobs in directory no name links to any more"""
+        try:
+            digests = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for digest in digests:
+            blob_path = os.path.join(directory, digest)
+            try:
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+            except OSError:
+                pass
+
+
+class FileInfo(collections.namedtuple('FileInfo', 'size mtime_ns inode shared')):
+    """What the file index and downloads need to know of a stored file.
+
+    inode is a (device, number) pair identifying the content, the same for
+    all names of a blob; shared is whether other names have it too."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, stats):
+        # Besides the name itself, the blob's own entry links to it
+        return cls(stats.st_size, stats.st_mtime_ns, (stats.st_dev, stats.st_ino), stats.st_nlink > 2)
+
+    @property
+    def mtime(self):
+        return self.mtime_ns / 1e9
+
+
+class DiskContent:
+    """An open file in DiskStorage, sent with sendfile()"""
+
+    def __init__(self, file, info):
+        self.file = file
+        self.info = info
+
+    def send(self, wfile, offset, count):
+        return wfile.sendfile(self.file, offset, count)
+
+    def chunks(self, size):
+        self.file.seek(0)
+        return iter(lambda: self.file.read(size), b'')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DiskPart:
+    """The sparse temp file a chunked upload is assembled in"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def create(self, size):
+        with open(self.path, 'wb') as f:
+            # Sparse file of the final size, so chunks can land in any order
+            f.truncate(size)
+        return self
+
+    def write_at(self, data, offset):
+        """Write data at offset. Chunks of the same upload are written
+        concurrently through one descriptor with positional writes, so no
+        seek position is shared."""
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            fd = self.fd
+        write_at(fd, data, offset)
+
+    def digest(self):
+        """SHA-256 of the assembled file.
+
+        Chunks arrive out of order, so unlike a streamed upload the file
+        can't be hashed as it is written; this is one sequential read of
+        data that is usually still in the page cache."""
+        digest = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DiskStorage:
+    """Transfer files kept as ordinary files in the transfer directories
+    under root, deduplicated by a BlobStore there.
+
+    The default root is the working directory, the layout Snap Send has
+    always used; a spool directory such as /dev/shm keeps them in memory
+    while still going through the page cache and sendfile(). Unfinished
+    chunked uploads are kept alongside, so they survive a restart."""
+
+    persistent = True
+
+    def __init__(self, root='.'):
+        self.root = root
+        self.blobs = BlobStore()
+        self.thumbnail_directory = os.path.join(root, THUMBNAIL_DIRECTORY)
+
+    def path(self, directory, name=None):
+        if name is None:
+            return os.path.join(self.root, directory)
+        return os.path.join(self.root, directory, name)
+
+    def prepare(self, directories=FILE_AREAS.values()):
+        for directory in directories:
+            os.makedirs(self.path(directory), exist_ok=True)
+
+    def names(self, directory):
+        return os.listdir(self.path(directory))
+
+    def discard(self, directory):
+        """Delete directory and every file under it"""
+        shutil.rmtree(self.path(directory), ignore_errors=True)
+
+    def stat(self, directory, name):
+        """FileInfo of a stored file, or None"""
+        try:
+            stats = os.stat(self.path(directory, name))
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(stats.st_mode):
+            return None
+        return FileInfo.from_stat(stats)
+
+    def open(self, directory, name):
+        """The content of a stored file for sending; raises OSError if
+        there is none"""
+        file = open(self.path(directory, name), 'rb')
+        try:
+            stats = os.fstat(file.fileno())
+            if not stat.S_ISREG(stats.st_mode):
+                raise FileNotFoundError(name)
+        except BaseException:
+            file.close()
+            raise
+        return DiskContent(file, FileInfo.from_stat(stats))
+
+    def remove(self, directory, name, mtime_ns):
+        """Delete a file unless it was replaced since (its mtime_ns has
+        changed). Returns whether it was deleted."""
+        path = self.path(directory, name)
+        try:
+            if os.stat(path).st_mtime_ns != mtime_ns:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self, chunks, directory, name, expected_sha256=None, size=None):
+        """Write the byte strings from chunks to directory/name.
+
+        They go to a hidden temporary file that is renamed into place once
+        complete, so memory use stays constant regardless of file size and
+        nobody sees a half written file. The bytes are hashed on the way
+        through and handed to the blob store, which keeps only one copy of
+        identical files. Returns the number of bytes written."""
+        os.makedirs(self.path(directory), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path(directory), prefix='.', suffix='.part')
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            if expected_sha256 is not None and digest.hexdigest() != expected_sha256.lower():
+                raise ChecksumMismatch(f"Checksum mismatch for {name}")
+            self.blobs.place(temp_path, digest.hexdigest(), self.path(directory, name))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return size
+
+    def part_path(self, directory, part_id):
+        # Hidden in the target directory, so the final rename never crosses file systems
+        return self.path(directory, f'.upload-{part_id}.part')
+
+    def create_part(self, directory, part_id, size):
+        return DiskPart(self.part_path(directory, part_id)).create(size)
+
+    def open_part(self, directory, part_id):
+        """The part of an upload started before, by a previous run or
+        another worker process, or None"""
+        path = self.part_path(directory, part_id)
+        return DiskPart(path) if os.path.exists(path) else None
+
+    def commit(self, part, digest, directory, name):
+        """Move a finished part into place; returns True if deduplicated"""
+        part.close()
+        return self.blobs.place(part.path, digest, self.path(directory, name))
+
+    def link(self, digest, directory, name):
+        return self.blobs.link_name(digest, self.path(directory, name))
+
+    def lookup(self, digest, directory):
+        return self.blobs.lookup(digest, self.path(directory))
+
+    def collect(self):
+        try:
+            tokens = self.names(PAIRING_DIRECTORY)
+        except FileNotFoundError:
+            tokens = []
+        self.blobs.collect(self.path(BLOB_DIRECTORY))
+        for token in tokens:
+            self.blobs.collect(self.path(f'{PAIRING_DIRECTORY}/{token}', BLOB_DIRECTORY))
+
+
+class MemoryBlob:
+    """The bytes of one distinct file in MemoryStorage, and its names"""
+
+    def __init__(self, data, key, serial):
+        self.data = data
+        # (blob_scope(directory), sha256) it is stored under
+        self.key = key
+        self.serial = serial
+        self.mtime_ns = time.time_ns()
+        self.names = set()
+
+
+class MemoryContent:
+    """A file in MemoryStorage, sent as memoryview slices of its bytes"""
+
+    def __init__(self, data, info):
+        self.view = memoryview(data)
+        self.info = info
+
+    def send(self, wfile, offset, count):
+        piece = self.view[offset:offset + count]
+        wfile.write(piece)
+        return len(piece)
+
+    def chunks(self, size):
+        for offset in range(0, len(self.view), size):
+            yield self.view[offset:offset + size]
+
+    def close(self):
+        self.view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryPart:
+    """A chunked upload being assembled in a buffer of its final size"""
+
+    def __init__(self, storage, size):
+        self.storage = storage
+        self.data = bytearray(size)
+
+    def write_at(self, data, offset):
+        # Same length in and out, so the buffer is never resized
+        self.data[offset:offset + len(data)] = data
+
+    def digest(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def close(self):
+        pass
+
+    def discard(self):
+        if self.data is not None:
+            self.storage.release(len(self.data))
+            self.data = None
+
+
+class MemoryStorage:
+    """Transfer files held in memory only, up to capacity bytes.
+
+    Identical files of a pairing session are kept once, as with the blob
+    store on disk, and all names of the content share its modification time. Bytes of uploads in
+    progress are reserved as they arrive; when a reservation doesn't fit,
+    the least recently uploaded or downloaded files are evicted, and only
+    if the uploads in progress alone exceed the capacity is it refused
+    with StorageFull. Downloads are sent from memoryview slices of the
+    stored bytes, without copies; one still running keeps its file's bytes
+    alive after an eviction. Nothing survives a restart, so unfinished
+    chunked uploads can't be resumed after one."""
+
+    persistent = False
+    thumbnail_directory = None
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # (blob_scope(directory), sha256) -> MemoryBlob
+        self.blobs = {}
+        # (directory, name) -> MemoryBlob, least recently used first
+        self.files = collections.OrderedDict()
+        self.stored = 0
+        self.reserved = 0
+        self.serial = 0
+
+    def prepare(self, directories=FILE_AREAS.values()):
+        pass
+
+    def names(self, directory):
+        with self.lock:
+            return [name for file_directory, name in self.files if file_directory == directory]
+
+    def discard(self, directory):
+        with self.lock:
+            for key in [key for key in self.files if key[0].startswith(directory + '/')]:
+                self.unlink(key)
+
+    def info(self, blob):
+        return FileInfo(len(blob.data), blob.mtime_ns, (0, blob.serial), len(blob.names) > 1)
+
+    def stat(self, directory, name):
+        with self.lock:
+            blob = self.files.get((directory, name))
+            return self.info(blob) if blob is not None else None
+
+    def open(self, directory, name):
+        with self.lock:
+            blob = self.files.get((directory, name))
+            if blob is None:
+                raise FileNotFoundError(name)
+            self.files.move_to_end((directory, name))
+            return MemoryContent(blob.data, self.info(blob))
+
+    def remove(self, directory, name, mtime_ns):
+        with self.lock:
+            blob = self.files.get((directory, name))
+            if blob is None or blob.mtime_ns != mtime_ns:
+                return False
+            self.unlink((directory, name))
+            return True
+
+    def unlink(self, key):
+        """Drop a name, and its bytes if no other name has them; call with
+        the lock held"""
+        blob = self.files.pop(key, None)
+        if blob is None:
+            return
+        blob.names.discard(key)
+        if not blob.names:
+            del self.blobs[blob.key]
+            self.stored -= len(blob.data)
+
+    def bind(self, key, blob):
+        """Give blob the name key, most recently used, and refresh the
+        modification time of all its names; call with the lock held"""
+        if self.files.get(key) is not blob:
+            self.unlink(key)
+            self.files[key] = blob
+            blob.names.add(key)
+        self.files.move_to_end(key)
+        blob.mtime_ns = time.time_ns()
+
+    def reserve(self, size):
+        """Set aside size bytes for an upload, evicting files as needed"""
+        evicted = []
+        with self.lock:
+            if self.reserved + size > self.capacity:
+                raise StorageFull(f"No room for {size} more bytes in the {self.capacity} bytes of memory storage")
+            # Every stored byte has a name, so this ends by the check above
+            while self.stored + self.reserved + size > self.capacity:
+                key = next(iter(self.files))
+                self.unlink(key)
+                evicted.append(key)
+            self.reserved += size
+        for directory, name in evicted:
+            logger.info(f"Evicted {directory}/{name} to make room in memory storage")
+            pairing = pairings.for_directory(directory)
+            if pairing is not None:
+                pairing.files.remove(directory, name)
+
+    def release(self, size):
+        with self.lock:
+            self.reserved -= size
+
+    def store(self, data, digest, directory, name):
+        """Name reserved bytes; returns True if identical bytes were
+        already stored, and data is dropped"""
+        with self.lock:
+            self.reserved -= len(data)
+            blob_key = (blob_scope(directory), digest)
+            blob = self.blobs.get(blob_key)
+            deduplicated = blob is not None
+            if blob is None:
+                self.serial += 1
+                blob = MemoryBlob(data, blob_key, self.serial)
+                self.blobs[blob_key] = blob
+                self.stored += len(data)
+            self.bind((directory, name), blob)
+        return deduplicated
+
+    def save(self, chunks, directory, name, expected_sha256=None, size=None):
+        """Collect the byte strings from chunks as directory/name.
+        Returns the number of bytes stored.
+
+        size, if known, is reserved up front, so an upload that can't fit
+        is refused before any file is evicted for it; otherwise the bytes
+        are reserved as they arrive."""
+        reserved = size or 0
+        self.reserve(reserved)
+        data = bytearray()
+        digest = hashlib.sha256()
+        try:
+            for chunk in chunks:
+                if len(data) + len(chunk) > reserved:
+                    self.reserve(len(data) + len(chunk) - reserved)
+                    reserved = len(data) + len(chunk)
+                data += chunk
+                digest.update(chunk)
+            if expected_sha256 is not None and digest.hexdigest() != expected_sha256.lower():
+                raise ChecksumMismatch(f"Checksum mismatch for {name}")
+        except BaseException:
+            self.release(reserved)
+            raise
+        # Shorter than announced
+        self.release(reserved - len(data))
+        self.store(data, digest.hexdigest(), directory, name)
+        return len(data)
+
+    def create_part(self, directory, part_id, size):
+        self.reserve(size)
+        try:
+            return MemoryPart(self, size)
+        except MemoryError:
+            self.release(size)
+            raise StorageFull(f"Could not allocate {size} bytes") from None
+
+    def open_part(self, directory, part_id):
+        return None
+
+    def commit(self, part, digest, directory, name):
+        data, part.data = part.data, None
+        return self.store(data, digest, directory, name)
+
+    def link(self, digest, directory, name):
+        """Give stored bytes another name; returns their size, or None if
+        there are none with this digest"""
+        if not is_sha256(digest):
+            return None
+        key = (directory, name)
+        with self.lock:
+            blob = self.blobs.get((blob_scope(directory), digest.lower()))
+            if blob is None:
+                return None
+            self.bind(key, blob)
+            return len(blob.data)
+
+    def lookup(self, digest, directory):
+        if not is_sha256(digest):
+            return None
+        with self.lock:
+            blob = self.blobs.get((blob_scope(directory), digest.lower()))
+            return len(blob.data) if blob is not None else None
+
+    def collect(self):
+        # Bytes are freed as soon as their last name goes
+        pass
+
+
+# Where transfer files are kept; replaced in main() as --storage selects
+storage = DiskStorage()
+
+
+class ThumbnailCache:
+    """Small JPEG previews of the image files, made once and kept on disk.
+
+    Thumbnails are generated on a pool of THUMBNAIL_WORKERS threads, as soon
+    as a file is indexed and again on request if one is missing, so neither
+    list requests nor uploads wait for an image to be decoded. A thumbnail
+    is named by its source's inode and size: the names of one blob, in
+    either area, share it, and a new upload under an old name gets a new
+    one. FileIndex evicts it when the last name of the file expires or is
+    replaced, and prune() clears those left over from before a restart.
+    Storage without a thumbnail directory (memory) gets no thumbnails."""
+
+    def __init__(self, directory=THUMBNAIL_DIRECTORY, workers=THUMBNAIL_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+        # Futures of the thumbnails being generated, and the sources that can't be read
+        self.pending = {}
+        self.failed = set()
+
+    def supported(self, name):
+        return PIL is not None and self.directory is not None and os.path.splitext(name)[1].lower() in THUMBNAIL_EXTENSIONS
+
+    @staticmethod
+    def key(entry):
+        device, inode = entry['inode']
+        return f'{device:x}-{inode:x}-{entry["size"]:x}'
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.jpg')
+
+    def request(self, directory, entry):
+        """A future for the thumbnail path of an indexed file, generating it
+        if it isn't cached yet; None if the file gets no thumbnail"""
+        if not self.supported(entry['name']):
+            return None
+        key = self.key(entry)
+        with self.lock:
+            if key in self.failed:
+                return None
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+            if os.path.exists(self.path(key)):
+                future = concurrent.futures.Future()
+                future.set_result(self.path(key))
+                return future
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='snap-send-thumbnail')
+            future = self.executor.submit(self.generate, storage.path(directory, entry['name']), key)
+            self.pending[key] = future
+        return future
+
+    def generate(self, source_path, key):
+        temp_path = os.path.join(self.directory, f'.{key}-{secrets.token_hex(4)}.tmp')
+        try:
+            from PIL import Image, ImageOps
+            with Image.open(source_path) as image:
+                # JPEGs are decoded at a reduced scale, many times faster
+                image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                thumbnail = ImageOps.exif_transpose(image)
+                thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            if thumbnail.mode != 'RGB':
+                # JPEG has no alpha channel; flatten onto white
+                thumbnail = thumbnail.convert('RGBA')
+                background = Image.new('RGB', thumbnail.size, 'white')
+                background.paste(thumbnail, mask=thumbnail.getchannel('A'))
+                thumbnail = background
+            os.makedirs(self.directory, exist_ok=True)
+            thumbnail.save(temp_path, 'JPEG', quality=THUMBNAIL_QUALITY)
+            os.replace(temp_path, self.path(key))
+            return self.path(key)
+        except Exception as e:
+            logger.debug(f"No thumbnail for {source_path}: {e}")
+            with self.lock:
+                self.failed.add(key)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def evict(self, entry):
+        """Delete the thumbnail of a file no name refers to any more"""
+        if self.directory is None:
+            return
+        key = self.key(entry)
+        with self.lock:
+            self.failed.discard(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def prune(self, keys):
+        """Delete the thumbnails not among keys, and temp files left behind"""
+        if self.directory is None:
+            return
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            pending = set(self.pending)
+        for name in names:
+            if name.startswith('.'):
+                # .<key>-<random>.tmp, still being written if its key is pending
+                remove = name[1:].rsplit('-', 1)[0] not in pending
+            else:
+                remove = os.path.splitext(name)[0] not in keys
+            if remove:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+thumbnails = ThumbnailCache()
+
+# Describe a file the way the list endpoints and events report it
+
+
+def describe_file(directory, entry, current_time):
+    created_time = entry['mtime']
+    area = file_area(directory)
+    thumbnail = None
+    if thumbnails.supported(entry['name']):
+        # The version changes with the file, so browsers can cache it for good
+        list_path = '/api/files' if area == 'received' else '/api/shared-files'
+        thumbnail = f'{list_path}/thumbnail?name={quote(entry["name"])}&v={thumbnails.key(entry)}'
+    return {
+        'name': entry['name'],
+        'size': entry['size'],
+        # The pairing session cookie picks the directory behind the path
+        'path': f'/{FILE_AREAS[area]}/{entry["name"]}',
+        'thumbnail': thumbnail,
+        'created': entry['created'],
+        'timestamp': created_time,
+        'expiresIn': max(0, int(created_time + FILE_EXPIRY_TIME - current_time))  # Remaining seconds
+    }
+
+
+class FileIndex:
+    """In-memory listing of the files in the transfer directories of one
+    pairing session, publishing their changes to its events.
+
+    Upload handlers call add() once a file is in place, so list requests are
+    served without touching the disk. Expiry is driven by a min-heap of
+    (expires_at, directory, name, mtime_ns): the sweeper thread sleeps until
+    the earliest entry is due and deletes it. Heap items left behind when a
+    file is replaced by a newer upload are recognized by their mtime_ns and
+    skipped. The JSON for each listing is cached until the directory changes
+    or the clock moves to the next second, since expiresIn is relative.
+    Image files have their thumbnails made when added and evicted when
+    their content is no longer named anywhere.
+
+    Names that are hard links to the same blob share one modification time,
+    so when add() sees a refreshed one the other names are rescheduled too,
+    in the indexes of all pairing sessions.
+
+    With --workers each process keeps an index of its own. Files another
+    worker adds arrive through WorkerSync, and every worker sweeps its own
+    heap, so a file expires from all of them at the same time; the mtime
+    check in storage.remove() lets only one of them delete it."""
+
+    def __init__(self, directories, events):
+        self.events = events
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = {directory: {} for directory in directories}
+        self.versions = {directory: 0 for directory in directories}
+        self.listing_cache = {}
+        self.expiry_heap = []
+        self.closed = False
+
+    def scan(self):
+        """Index the files already stored, e.g. from before a restart"""
+        for directory in self.entries:
+            for filename in storage.names(directory):
+                # Skip uploads that are still being written
+                if not filename.startswith('.'):
+                    self.add(directory, filename, publish=False)
+
+    def thumbnail_keys(self):
+        """The thumbnail cache keys of the indexed files"""
+        with self.lock:
+            return {thumbnails.key(entry) for entries in self.entries.values()
+                    for entry in entries.values()}
+
+    def add(self, directory, filename, publish=True, local=True):
+        """Index directory/filename after it has been written; local is
+        False for a file another worker process wrote and announced, which
+        that worker makes the thumbnail of"""
+        info = storage.stat(directory, filename)
+        if info is None:
+            return None
+
+        entry = {
+            'name': filename,
+            'size': info.size,
+            'mtime': info.mtime,
+            'mtime_ns': info.mtime_ns,
+            'inode': info.inode,
+            # Format the timestamp as a readable date once, not per listing
+            'created': datetime.datetime.fromtimestamp(info.mtime).strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with self.lock:
+            previous = self.entries[directory].get(filename)
+            self.entries[directory][filename] = entry
+            if previous is not None and self.referenced(previous['inode']):
+                previous = None
+            self.versions[directory] += 1
+            heapq.heappush(self.expiry_heap, (entry['mtime'] + FILE_EXPIRY_TIME, directory,
+                                              filename, entry['mtime_ns']))
+            self.changed.notify()
+
+        if previous is not None:
+            # Replaced by different content
+            thumbnails.evict(previous)
+        if local:
+            thumbnails.request(directory, entry)
+            if publish:
+                worker_sync.announce('file', {'directory': directory, 'name': filename})
+        if publish:
+            self.events.publish('file-added', {
+                'area': file_area(directory),
+                'file': describe_file(directory, entry, time.time())
+            })
+
+        # Other names of the same blob now expire with this one; blobs belong
+        # to one pairing session, so those names are all in this index
+        if info.shared:
+            self.refresh(entry, publish)
+        return entry
+
+    def refresh(self, entry, publish=True):
+        """Reschedule the other names of the file entry is, whose
+        modification time it refreshed"""
+        refreshed = []
+        with self.lock:
+            for directory, entries in self.entries.items():
+                for other in list(entries.values()):
+                    if other['inode'] != entry['inode'] or other['mtime_ns'] == entry['mtime_ns']:
+                        continue
+                    renamed = dict(entry, name=other['name'])
+                    entries[other['name']] = renamed
+                    self.versions[directory] += 1
+                    heapq.heappush(self.expiry_heap, (renamed['mtime'] + FILE_EXPIRY_TIME,
+                                                      directory, other['name'], renamed['mtime_ns']))
+                    refreshed.append((directory, renamed))
+            if refreshed:
+                self.changed.notify()
+
+        if publish:
+            current_time = time.time()
+            for directory, renamed in refreshed:
+                self.events.publish('file-added', {
+                    'area': file_area(directory),
+                    'file': describe_file(directory, renamed, current_time)
+                })
+
+    def remove(self, directory, filename):
+        """Drop a file the storage evicted to make room"""
+        with self.lock:
+            entry = self.entries[directory].pop(filename, None)
+            if entry is None:
+                return
+            self.versions[directory] += 1
+            unreferenced = not self.referenced(entry['inode'])
+        if unreferenced:
+            thumbnails.evict(entry)
+        self.events.publish('file-expired', {'area': file_area(directory), 'name': filename})
+
+    def referenced(self, inode):
+        """Whether any indexed name is the file with this (device, inode);
+        call with the lock held"""
+        return any(entry['inode'] == inode for entries in self.entries.values()
+                   for entry in entries.values())
+
+    def get(self, directory, filename):
+        """The entry of an unexpired file, or None"""
+        with self.lock:
+            entry = self.entries[directory].get(filename)
+        if entry is None or entry['mtime'] + FILE_EXPIRY_TIME <= time.time():
+            return None
+        return entry
+
+    def names(self, directory):
+        """Names of the unexpired files in directory, newest first"""
+        current_time = time.time()
+        with self.lock:
+            entries = [entry for entry in self.entries[directory].values()
+                       if entry['mtime'] + FILE_EXPIRY_TIME > current_time]
+        entries.sort(key=lambda entry: entry['mtime'], reverse=True)
+        return [entry['name'] for entry in entries]
+
+    def listing_json(self, directory):
+        """The list endpoint body for directory, newest first"""
+        current_time = time.time()
+        second = int(current_time)
+        with self.lock:
+            version = self.versions[directory]
+            cached = self.listing_cache.get(directory)
+            if cached and cached[0] == version and cached[1] == second:
+                return cached[2]
+            entries = list(self.entries[directory].values())
+
+        files = [describe_file(directory, entry, current_time) for entry in entries]
+        # Only include unexpired files, even if the sweeper hasn't run yet
+        files = [file for file in files if file['expiresIn'] > 0]
+        files.sort(key=lambda x: x['timestamp'], reverse=True)
+        body = json.dumps(files).encode('utf-8')
+
+        with self.lock:
+            if self.versions[directory] == version:
+                self.listing_cache[directory] = (version, second, body)
+        return body
+
+    def expire_due(self):
+        """Delete every file whose expiry time has passed.
+
+        Returns the seconds until the next expiry, or None if nothing is
+        scheduled."""
+        expired = []
+        unreferenced = []
+        with self.lock:
+            current_time = time.time()
+            while self.expiry_heap and self.expiry_heap[0][0] <= current_time:
+                _, directory, filename, mtime_ns = heapq.heappop(self.expiry_heap)
+                entry = self.entries[directory].get(filename)
+                if entry is None or entry['mtime_ns'] != mtime_ns:
+                    # Replaced by a newer upload or already gone
+                    continue
+
+                del self.entries[directory][filename]
+                self.versions[directory] += 1
+                expired.append((directory, filename, mtime_ns))
+                if not self.referenced(entry['inode']):
+                    unreferenced.append(entry)
+
+            next_due = self.expiry_heap[0][0] - current_time if self.expiry_heap else None
+
+        # Delete outside the lock so listings aren't held up by the disk
+        for directory, filename, mtime_ns in expired:
+            try:
+                # Don't delete a newer file that replaced this one in storage
+                if storage.remove(directory, filename, mtime_ns):
+                    logger.info(f"Deleted expired file: {directory}/{filename}")
+            except Exception as e:
+                logger.error(f"Error deleting file: {e}")
+            self.events.publish('file-expired', {'area': file_area(directory), 'name': filename})
+        for entry in unreferenced:
+            thumbnails.evict(entry)
+        if expired:
+            # Also picks up blobs orphaned by names replaced with new content
+            storage.collect()
+        return next_due
+
+    def run_sweeper(self):
+        while True:
+            try:
+                next_due = self.expire_due()
+            except Exception as e:
+                logger.error(f"Error expiring files: {e}")
+                next_due = 1
+            with self.lock:
+                if self.closed:
+                    return
+                # add() notifies us in case a new file expires sooner
+                self.changed.wait(timeout=next_due)
+                if self.closed:
+                    return
+
+    def start_sweeper(self):
+        threading.Thread(target=self.run_sweeper, name='snap-send-expiry', daemon=True).start()
+
+    def close(self):
+        """Stop the sweeper and forget every file, which the caller
+        deletes; returns their entries"""
+        with self.lock:
+            self.closed = True
+            entries = []
+            for directory_entries in self.entries.values():
+                entries.extend(directory_entries.values())
+                directory_entries.clear()
+            self.expiry_heap.clear()
+            self.changed.notify()
+        return entries
+
+
+# Files of the default pairing session
+file_index = FileIndex(FILE_AREAS.values(), event_broker)
+
+# Pairing sessions: a desktop page and the phones that scanned its QR code
+
+
+class PairingSession:
+    """The messages, files, transfers and event streams of one pairing,
+    none of which any other pairing sees.
+
+    The default session, whose token is None, is the one requests without
+    a pairing cookie get: messages.json and the transfer directories Snap
+    Send has always had. Every other session keeps its messages in memory
+    and its files under PAIRING_DIRECTORY/<token>."""
+
+    def __init__(self, token, messages, files, events, transfers, directories):
+        self.token = token
+        self.messages = messages
+        self.files = files
+        self.events = events
+        self.transfers = transfers
+        # Transfer directory by area name
+        self.directories = dict(directories)
+        self.last_activity = time.monotonic()
+        # When this worker process last told the others the session is in use
+        self.announced = 0
+
+    def touch(self):
+        """Note that the session is in use, telling the other worker
+        processes now and then"""
+        now = time.monotonic()
+        self.last_activity = now
+        if worker_sync.active and now - self.announced >= PAIRING_ACTIVITY_INTERVAL:
+            self.announced = now
+            worker_sync.announce('pairing', {'token': self.token})
+
+
+class PairingRegistry:
+    """The pairing sessions by token.
+
+    A desktop page starts one with POST /api/pairing and puts its token in
+    the QR code, and the phone joins it the same way. From then on the
+    pairing cookie scopes the lists, uploads, downloads and event streams
+    of both to that session, so what they cost depends on its size alone.
+    A session nobody has sent a request to or held an event stream open
+    on for FILE_EXPIRY_TIME ends, and its files are deleted.
+
+    Sessions survive a restart along with the storage: load() finds them
+    by their directories, though without their messages unless there is a
+    message history. With --workers,
+    each process hears of the sessions the others start, use and end
+    through WorkerSync."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def open(self, token):
+        """A new, empty PairingSession for token"""
+        directories = {area: f'{PAIRING_DIRECTORY}/{token}/{directory}'
+                       for area, directory in FILE_AREAS.items()}
+        events = EventBroker()
+        messages = MessageStore(None, None, token=token)
+        messages.resume(history.latest(token, MAX_MESSAGES))
+        return PairingSession(token, messages,
+                              FileIndex(directories.values(), events), events,
+                              TransferRegistry(token, events), directories)
+
+    def load(self):
+        """Index the files of every session, restoring the sessions a
+        previous run left"""
+        try:
+            tokens = storage.names(PAIRING_DIRECTORY)
+        except FileNotFoundError:
+            tokens = []
+        for token in tokens:
+            pairing = self.open(token)
+            try:
+                storage.prepare(pairing.directories.values())
+            except OSError as e:
+                logger.warning(f"Skipping pairing session {token}: {e}")
+                continue
+            self.sessions[token] = pairing
+        if self.sessions:
+            logger.info(f"Restored {len(self.sessions)} pairing session(s)")
+
+        keys = set()
+        for pairing in self.all():
+            pairing.files.scan()
+            keys |= pairing.files.thumbnail_keys()
+        thumbnails.prune(keys)
+
+    def start(self):
+        """Start the expiry sweepers, and the thread ending idle sessions"""
+        for pairing in self.all():
+            pairing.files.start_sweeper()
+        threading.Thread(target=self.run_evictor, name='snap-send-pairings', daemon=True).start()
+
+    def create(self):
+        pairing = self.open(secrets.token_urlsafe(PAIRING_TOKEN_BYTES))
+        storage.prepare(pairing.directories.values())
+        with self.lock:
+            self.sessions[pairing.token] = pairing
+        pairing.files.start_sweeper()
+        pairing.touch()
+        logger.info(f"Pairing session {pairing.token} started")
+        return pairing
+
+    def get(self, token):
+        """The session under token, the default one for None, or None if
+        there is no such session (any more)"""
+        if token is None:
+            return default_pairing
+        with self.lock:
+            return self.sessions.get(token)
+
+    def all(self):
+        with self.lock:
+            return [default_pairing, *self.sessions.values()]
+
+    def for_directory(self, directory):
+        """The session a transfer directory belongs to, or None if it has ended"""
+        if directory in FILE_AREAS_BY_DIRECTORY:
+            return default_pairing
+        return self.get(directory.split('/')[1])
+
+    def resolve(self, cookie_header):
+        """The session named by the cookies of a request, which is now in
+        use: the default one without a pairing cookie, None if it has ended"""
+        token = None
+        for item in (cookie_header or '').split(';'):
+            name, _, value = item.strip().partition('=')
+            if name == PAIRING_COOKIE:
+                token = value or None
+        pairing = self.get(token)
+        if pairing is not None and pairing.token is not None:
+            pairing.touch()
+        return pairing
+
+    def subscribe(self, pairing, limit):
+        """A new event stream of pairing, or None if limit streams are open
+        across all sessions, as they hold threads of the same pool"""
+        with self.lock:
+            streams = len(default_pairing.events.subscribers) + \
+                sum(len(other.events.subscribers) for other in self.sessions.values())
+            if streams >= limit:
+                return None
+            return pairing.events.subscribe(limit)
+
+    def apply_remote(self, token):
+        """Take on or keep alive a session another worker process uses"""
+        with self.lock:
+            pairing = self.sessions.get(token)
+            started = pairing is None
+            if started:
+                pairing = self.sessions[token] = self.open(token)
+        if started:
+            pairing.files.start_sweeper()
+        pairing.last_activity = time.monotonic()
+
+    def end(self, pairing, remove=True):
+        """Forget a session, deleting its files unless remove is False
+        because another worker process has"""
+        with self.lock:
+            if self.sessions.get(pairing.token) is not pairing:
+                return
+            del self.sessions[pairing.token]
+        upload_sessions.drop(pairing.directories.values())
+        for entry in pairing.files.close():
+            thumbnails.evict(entry)
+        if remove:
+            storage.discard(f'{PAIRING_DIRECTORY}/{pairing.token}')
+            storage.collect()
+            history.clear(pairing.token)
+            worker_sync.announce('pairing-ended', {'token': pairing.token})
+        logger.info(f"Pairing session {pairing.token} ended")
+
+    def end_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for pairing in sessions:
+            if pairing.events.subscribers:
+                # A page is still listening, even if it has nothing to ask
+                pairing.touch()
+            elif now - pairing.last_activity > FILE_EXPIRY_TIME:
+                self.end(pairing)
+
+    def run_evictor(self):
+        while True:
+            time.sleep(PAIRING_CHECK_INTERVAL)
+            try:
+                self.end_idle()
+            except Exception as e:
+                logger.error(f"Error ending idle pairing sessions: {e}")
+
+
+# Requests without a pairing cookie get the state Snap Send has always had
+default_pairing = PairingSession(None, message_store, file_index, event_broker, transfers, FILE_AREAS)
+
+pairings = PairingRegistry()
+
+
+class UploadSession:
+    """One chunked upload: the part its chunks are written into (see
+    storage.create_part) plus the set of chunks written.
+
+    With storage that persists, a small JSON status file lives hidden in
+    the target directory next to the part and is rewritten after each
+    chunk, so an upload can be resumed after a server restart as well as
+    after a dropped connection."""
+
+    def __init__(self, session_id, directory, name, size, chunk_size, sha256=None, received=()):
+        self.id = session_id
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256
+        self.received = set(received)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.part = None
+        self.last_activity = time.time()
+        self.status_path = storage.path(directory, f'.upload-{session_id}.json') if storage.persistent else None
+
+    @property
+    def chunk_count(self):
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def status(self):
+        with self.lock:
+            received = sorted(self.received)
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.size,
+            'target': file_area(self.directory),
+            'chunkSize': self.chunk_size,
+            'chunkCount': self.chunk_count,
+            'received': received
+        }
+
+    def save_status(self):
+        if self.status_path is None:
+            return
+        with self.save_lock:
+            # Per process, as --workers may save the same session at once
+            temp_path = f'{self.status_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.status() | {'sha256': self.sha256}, f)
+            os.replace(temp_path, self.status_path)
+
+    def close(self):
+        if self.part is not None:
+            self.part.close()
+
+    def received_bytes(self):
+        with self.lock:
+            return sum(self.chunk_length(index) for index in self.received)
+
+    def write_chunk(self, index, pieces, progress=None):
+        """Write chunk index into place in the part from an iterable of
+        byte strings, which must add up to exactly its length, or
+        ChunkLengthMismatch is raised. progress is called with the size of
+        each piece written. Chunks of the same session may be written
+        concurrently."""
+        offset = index * self.chunk_size
+        end = offset + self.chunk_length(index)
+        for data in pieces:
+            if offset + len(data) > end:
+                raise ChunkLengthMismatch(f"Chunk {index} is longer than {self.chunk_length(index)} bytes")
+            self.part.write_at(data, offset)
+            offset += len(data)
+            if progress:
+                progress(len(data))
+        if offset < end:
+            raise ChunkLengthMismatch(f"Chunk {index} is {end - offset} bytes short")
+
+        self.mark_received(index)
+        self.save_status()
+        worker_sync.announce('chunk', {'id': self.id, 'index': index})
+
+    def mark_received(self, index):
+        """Record chunk index as written; returns whether it is new"""
+        with self.lock:
+            new = index not in self.received
+            self.received.add(index)
+            self.last_activity = time.time()
+            return new
+
+    def missing_chunks(self):
+        with self.lock:
+            return [index for index in range(self.chunk_count) if index not in self.received]
+
+    def discard(self):
+        if self.part is not None:
+            self.part.discard()
+        if self.status_path is not None:
+            try:
+                os.remove(self.status_path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadLimiter:
+    """Admission control for upload bodies.
+
+    Caps how many uploads are being written at once across the server and
+    how many bytes any one client may have in flight, so a sender with many
+    parallel chunks can't starve the others. Requests over a limit are turned
+    away straight away with a Retry-After rather than queued, which would
+    hold a worker thread."""
+
+    def __init__(self, max_writers=MAX_UPLOAD_WRITERS, max_client_bytes=MAX_CLIENT_INFLIGHT_BYTES):
+        self.lock = threading.Lock()
+        self.max_writers = max_writers
+        self.max_client_bytes = max_client_bytes
+        self.writers = 0
+        self.client_bytes = {}
+
+    def acquire(self, client, size):
+        """Reserve a writer slot and size bytes for client.
+
+        Returns None on success, otherwise the HTTP status to reject with.
+        A client with nothing in flight is always allowed one body, however
+        large, so a single big upload can't lock itself out."""
+        with self.lock:
+            if self.writers >= self.max_writers:
+                return 503
+            in_flight = self.client_bytes.get(client, 0)
+            if in_flight and in_flight + size > self.max_client_bytes:
+                return 429
+            self.writers += 1
+            self.client_bytes[client] = in_flight + size
+            return None
+
+    def release(self, client, size):
+        with self.lock:
+            self.writers -= 1
+            remaining = self.client_bytes.get(client, 0) - size
+            if remaining > 0:
+                self.client_bytes[client] = remaining
+            else:
+                self.client_bytes.pop(client, None)
+
+
+upload_limiter = UploadLimiter()
+
+
+class UploadSessionManager:
+    """Chunked upload sessions by id: init, PUT chunks, then complete.
+
+    Sessions idle for longer than UPLOAD_SESSION_TIMEOUT are discarded
+    along with their temp files. With --workers, each process knows the
+    sessions of all of them, as the chunks of one upload can arrive at
+    any: sessions started, chunks written and sessions ended are passed
+    on through WorkerSync."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def load(self):
+        """Restore sessions left by a previous run and drop stale temp files"""
+        if not storage.persistent:
+            return
+        current_time = time.time()
+        for directory in [directory for pairing in pairings.all()
+                          for directory in pairing.directories.values()]:
+            directory_path = storage.path(directory)
+            for filename in os.listdir(directory_path):
+                path = os.path.join(directory_path, filename)
+                if filename.startswith('.upload-') and filename.endswith('.json'):
+                    try:
+                        with open(path, 'r') as f:
+                            data = json.load(f)
+                        session = UploadSession(data['id'], directory, data['name'], data['size'],
+                                                data['chunkSize'], data.get('sha256'), data['received'])
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning(f"Discarding unreadable upload session {path}: {e}")
+                        os.remove(path)
+                        continue
+                    session.part = storage.open_part(directory, session.id)
+                    if session.part is not None:
+                        session.last_activity = os.stat(path).st_mtime
+                        self.sessions[session.id] = session
+                    else:
+                        session.discard()
+
+            # Temp files of uploads that died with the previous run
+            live = {session.part.path for session in self.sessions.values()}
+            for filename in os.listdir(directory_path):
+                path = os.path.join(directory_path, filename)
+                if filename.startswith('.') and filename.endswith('.part') and path not in live:
+                    try:
+                        if os.stat(path).st_mtime < current_time - UPLOAD_SESSION_TIMEOUT:
+                            os.remove(path)
+                    except OSError:
+                        pass
+
+        if self.sessions:
+            logger.info(f"Restored {len(self.sessions)} unfinished upload(s)")
+        self.expire_idle()
+
+    def create(self, directory, name, size, chunk_size, sha256=None):
+        self.expire_idle()
+        session = UploadSession(secrets.token_hex(16), directory, name, size, chunk_size, sha256)
+        session.part = storage.create_part(directory, session.id, size)
+        session.save_status()
+        with self.lock:
+            self.sessions[session.id] = session
+        worker_sync.announce('upload', session.status() | {'sha256': sha256, 'directory': directory})
+        return session
+
+    def adopt(self, status):
+        """Take on a session another worker process started"""
+        session = UploadSession(status['id'], status['directory'], status['name'],
+                                status['size'], status['chunkSize'], status.get('sha256'),
+                                status['received'])
+        session.part = storage.open_part(session.directory, session.id)
+        if session.part is not None:
+            with self.lock:
+                self.sessions.setdefault(session.id, session)
+
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            worker_sync.announce('upload-done', {'id': session_id})
+        return session
+
+    def forget(self, session_id):
+        """Drop a session another worker process completed or discarded"""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+            pairing = pairings.for_directory(session.directory)
+            if pairing is not None:
+                pairing.transfers.discard(session_id)
+
+    def drop(self, directories):
+        """Forget the sessions uploading into directories, which are about
+        to be deleted"""
+        with self.lock:
+            dropped = [session for session in self.sessions.values() if session.directory in directories]
+            for session in dropped:
+                del self.sessions[session.id]
+        for session in dropped:
+            session.discard()
+
+    def expire_idle(self):
+        cutoff = time.time() - UPLOAD_SESSION_TIMEOUT
+        with self.lock:
+            idle = [session for session in self.sessions.values() if session.last_activity < cutoff]
+            for session in idle:
+                del self.sessions[session.id]
+        for session in idle:
+            logger.info(f"Discarding idle upload of {session.name}")
+            pairing = pairings.for_directory(session.directory)
+            if pairing is not None:
+                pairing.transfers.finish(session.id, 'failed')
+            session.discard()
+
+
+upload_sessions = UploadSessionManager()
+
+
+class WorkerSync:
+    """The changes the --workers processes make to shared state, kept in a
+    SQLite database in WAL mode that all of them open.
+
+    A worker appends a row for each change to the pairing sessions, their
+    messages, file indexes and transfers in progress, and the chunked
+    uploads, and applies the other workers' rows to its own in-memory copies in rowid order. PRAGMA
+    data_version tells cheaply whether anyone has written since the last
+    look, so every request starts by catching up; responses then never miss
+    a change another worker has already answered for. A watcher thread also
+    catches up every WORKER_SYNC_INTERVAL, so event streams hear of the
+    other workers' changes without waiting for a request.
+
+    Messages are applied from the log by the worker adding them as well, so
+    the rowid orders them across workers and serves as their id and cursor.
+    The log stands in for the message journal while workers run: the
+    supervisor seeds it from the snapshot and MessageStore.load() takes the
+    messages back from it when they stop."""
+
+    def __init__(self, path=WORKERS_DATABASE):
+        self.path = path
+        self.active = False
+        self.origin = None
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.last_seq = 0
+
+    def connect(self):
+        """This thread's connection; SQLite connections can't be shared"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.version = None
+        return connection
+
+    def create(self, entries, first_seq=1):
+        """Start a new log holding the message journal entries given, whose
+        new rows take seqs from first_seq on at least"""
+        self.remove()
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'origin INTEGER NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL, '
+                               'time REAL NOT NULL)')
+            connection.execute('CREATE INDEX changes_kind ON changes (kind, seq)')
+            rows = [(entry['seq'], 'message' if entry['op'] == 'add' else 'messages-cleared',
+                     json.dumps(entry.get('message', {})), time.time()) for entry in entries]
+            with connection:
+                connection.executemany('INSERT INTO changes (seq, origin, kind, data, time) '
+                                       'VALUES (?, 0, ?, ?, ?)', rows)
+                # Message ids go on from those in the history
+                connection.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'changes', 0 "
+                                   "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'changes')")
+                connection.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'changes'",
+                                   (first_seq - 1,))
+        finally:
+            connection.close()
+
+    def remove(self):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def leftover_messages(self, after):
+        """Message journal entries past seq after in the log of a --workers
+        run that has ended; none if there is no log"""
+        if not os.path.exists(self.path):
+            return []
+        connection = sqlite3.connect(self.path)
+        try:
+            # Those of the default pairing session; the others live in memory only
+            rows = connection.execute("SELECT seq, kind, data FROM changes WHERE kind IN "
+                                      "('message', 'messages-cleared') AND seq > ? AND "
+                                      "json_extract(data, '$.pairing') IS NULL ORDER BY seq",
+                                      (after,)).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Error reading messages from {self.path}: {e}")
+            return []
+        finally:
+            connection.close()
+        entries = []
+        for seq, kind, data in rows:
+            if kind == 'message':
+                entries.append({'seq': seq, 'op': 'add', 'message': dict(json.loads(data), id=seq)})
+            else:
+                entries.append({'seq': seq, 'op': 'clear'})
+        return entries
+
+    def start(self):
+        """Apply the other workers' changes from now on; called in each
+        worker process once it has loaded its state"""
+        # Nothing opened before the fork is used in the worker
+        self.local = threading.local()
+        self.origin = os.getpid()
+        self.active = True
+        self.catch_up(force=True)
+        threading.Thread(target=self.watch, name='snap-send-sync', daemon=True).start()
+
+    def append(self, kind, data):
+        """Log a change for the other workers; returns its seq"""
+        cursor = self.connect().execute('INSERT INTO changes (origin, kind, data, time) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (self.origin, kind, json.dumps(data), time.time()))
+        return cursor.lastrowid
+
+    def announce(self, kind, data):
+        """Log a change if workers run, without failing the request that made it"""
+        if not self.active:
+            return
+        try:
+            self.append(kind, data)
+        except sqlite3.Error as e:
+            logger.error(f"Error passing a {kind} change to the other workers: {e}")
+
+    def catch_up(self, force=False):
+        """Apply the changes logged since the last call, if there are any;
+        force for this thread's own writes, which data_version doesn't count"""
+        if not self.active:
+            return
+        try:
+            connection = self.connect()
+            version = connection.execute('PRAGMA data_version').fetchone()[0]
+            if version == self.local.version and not force:
+                return
+            self.local.version = version
+            with self.lock:
+                rows = connection.execute('SELECT seq, origin, kind, data FROM changes WHERE seq > ? '
+                                          'ORDER BY seq', (self.last_seq,)).fetchall()
+                for seq, origin, kind, data in rows:
+                    self.last_seq = seq
+                    own = origin == self.origin
+                    if own and kind not in WORKER_ORDERED_KINDS:
+                        continue
+                    try:
+                        self.handlers[kind](seq, json.loads(data), own)
+                    except Exception as e:
+                        logger.error(f"Error applying a {kind} change from another worker: {e}")
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the other workers' changes: {e}")
+
+    def watch(self):
+        while True:
+            time.sleep(WORKER_SYNC_INTERVAL)
+            self.catch_up()
+
+    def prune(self, max_messages=MAX_MESSAGES):
+        """Delete the changes no worker needs any more: messages cleared,
+        pushed out of the list of their pairing session or left by one that
+        has ended, and other changes past WORKER_SYNC_RETENTION"""
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                connection.execute("DELETE FROM changes WHERE kind IN ('message', 'messages-cleared') "
+                                   "AND seq < (SELECT max(cleared.seq) FROM changes AS cleared "
+                                   "WHERE cleared.kind = 'messages-cleared' AND "
+                                   "json_extract(cleared.data, '$.pairing') IS "
+                                   "json_extract(changes.data, '$.pairing'))")
+                connection.execute("DELETE FROM changes WHERE seq IN (SELECT seq FROM (SELECT seq, "
+                                   "row_number() OVER (PARTITION BY json_extract(data, '$.pairing') "
+                                   "ORDER BY seq DESC) AS newer FROM changes WHERE kind = 'message') "
+                                   "WHERE newer > ?)", (max_messages,))
+                connection.execute("DELETE FROM changes WHERE kind IN ('message', 'messages-cleared') "
+                                   "AND json_extract(data, '$.pairing') IN (SELECT "
+                                   "json_extract(data, '$.token') FROM changes WHERE kind = 'pairing-ended')")
+                connection.execute("DELETE FROM changes WHERE kind NOT IN ('message', 'messages-cleared') "
+                                   "AND time < ?", (time.time() - WORKER_SYNC_RETENTION,))
+        finally:
+            connection.close()
+
+
+# Idle until main() starts worker processes
+worker_sync = WorkerSync()
+
+# Apply a change another worker process logged
+
+
+def apply_worker_message(seq, message, own):
+    pairing = pairings.get(message.pop('pairing', None))
+    if pairing is None:
+        return
+    message['id'] = seq
+    if pairing.messages.apply_shared({'seq': seq, 'op': 'add', 'message': message}) and not own:
+        pairing.events.publish('message', {'message': message_preview(message), 'cursor': seq})
+
+
+def apply_worker_clear(seq, data, own):
+    pairing = pairings.get(data.get('pairing'))
+    if pairing is not None and pairing.messages.apply_shared({'seq': seq, 'op': 'clear'}) and not own:
+        pairing.events.publish('messages-cleared', {'cursor': seq})
+
+
+def apply_worker_file(seq, data, own):
+    pairing = pairings.for_directory(data['directory'])
+    if pairing is not None:
+        pairing.files.add(data['directory'], data['name'], local=False)
+
+
+def apply_worker_upload(seq, status, own):
+    upload_sessions.adopt(status)
+
+
+def apply_worker_chunk(seq, data, own):
+    session = upload_sessions.get(data['id'])
+    if session is not None and session.mark_received(data['index']):
+        pairing = pairings.for_directory(session.directory)
+        transfer = pairing.transfers.get(session.id) if pairing is not None else None
+        if transfer is not None:
+            transfer.credit(session.chunk_length(data['index']))
+
+
+def apply_worker_upload_done(seq, data, own):
+    upload_sessions.forget(data['id'])
+
+
+def apply_worker_transfer(seq, data, own):
+    pairing = pairings.get(data['pairing'])
+    if pairing is not None:
+        pairing.transfers.apply_remote(data['transfer'])
+
+
+def apply_worker_pairing(seq, data, own):
+    pairings.apply_remote(data['token'])
+
+
+def apply_worker_pairing_ended(seq, data, own):
+    pairing = pairings.get(data['token'])
+    if pairing is not None:
+        pairings.end(pairing, remove=False)
+
+
+worker_sync.handlers.update({
+    'message': apply_worker_message,
+    'messages-cleared': apply_worker_clear,
+    'file': apply_worker_file,
+    'upload': apply_worker_upload,
+    'chunk': apply_worker_chunk,
+    'upload-done': apply_worker_upload_done,
+    'transfer': apply_worker_transfer,
+    'pairing': apply_worker_pairing,
+    'pairing-ended': apply_worker_pairing_ended,
+})
+
+
+class StaticFile:
+    """One static file held in memory in every encoding worth sending"""
+
+    def __init__(self, data, content_type, cache_control, mtime):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.mtime = mtime
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        self.variants = {'identity': data}
+        if len(data) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants['br'] = compressed
+
+    def etag(self, encoding):
+        # Each encoding is a different representation, so it gets its own tag
+        if encoding == 'identity':
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+    def choose_encoding(self, accept_encoding):
+        """Pick the smallest variant the client accepts"""
+        accepted = {}
+        for item in (accept_encoding or '').split(','):
+            coding, _, params = item.strip().partition(';')
+            coding = coding.strip().lower()
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            if coding:
+                accepted[coding] = quality
+
+        best = 'identity'
+        for encoding in self.variants:
+            if encoding == 'identity':
+                continue
+            if accepted.get(encoding, accepted.get('*', 0)) > 0 and \
+                    len(self.variants[encoding]) < len(self.variants[best]):
+                best = encoding
+        return best
+
+
+class StaticAssetCache:
+    """The pages, scripts and stylesheet of the web interface.
+
+    Everything is read and compressed once by load(). Scripts and the
+    stylesheet are also published under a content-hashed name such as
+    /style.<hash>.css, which the pages refer to, so browsers may cache
+    them forever (Cache-Control: immutable); a changed file gets a new
+    name. The pages themselves are revalidated on every load with their
+    ETag. The plain names keep working for anything linking to them."""
+
+    def __init__(self, directory=STATIC_DIR):
+        self.directory = directory
+        self.files = {}
+
+    def read(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, 'rb') as f:
+            return f.read(), os.fstat(f.fileno()).st_mtime
+
+    def load(self):
+        files = {}
+        hashed_names = {}
+        for name in STATIC_ASSETS:
+            try:
+                data, mtime = self.read(name)
+            except OSError as e:
+                logger.warning(f"Static file {name} not loaded: {e}")
+                continue
+            for placeholder, value in STATIC_PLACEHOLDERS.items():
+                data = data.replace(placeholder, value)
+            stem, extension = os.path.splitext(name)
+            content_type = STATIC_CONTENT_TYPES[extension]
+            asset = StaticFile(data, content_type, 'no-cache', mtime)
+            hashed_names[name] = f'{stem}.{asset.digest}{extension}'
+            files['/' + name] = asset
+            files['/' + hashed_names[name]] = StaticFile(
+                data, content_type, 'public, max-age=31536000, immutable', mtime)
+
+        for name in STATIC_PAGES:
+            try:
+                data, mtime = self.read(name)
+            except OSError as e:
+                logger.warning(f"Static file {name} not loaded: {e}")
+                continue
+            page = data.decode('utf-8')
+            for asset_name, hashed_name in hashed_names.items():
+                page = page.replace(f'"{asset_name}"', f'"{hashed_name}"')
+            files['/' + name] = StaticFile(page.encode('utf-8'), STATIC_CONTENT_TYPES['.html'],
+                                           'no-cache', mtime)
+
+        if '/desktop.html' in files:
+            files['/'] = files['/desktop.html']
+        self.files = files
+
+    def get(self, path):
+        return self.files.get(path)
+
+
+static_assets = StaticAssetCache()
+
+# Write all of data at offset without using the descriptor's file position
+
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # No positional writes (Windows): serialize seek+write instead
+            with write_at_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+write_at_lock = threading.Lock()
+
+# Reduce a client supplied file name to a plain name inside the target directory
+
+
+def safe_file_name(file_name):
+    file_name = os.path.basename(file_name.replace('\\', '/')).strip()
+    if file_name in ('', '.', '..'):
+        return None
+    return file_name
+
+# Stream an upload body to disk
+
+
+def save_upload_stream(rfile, content_length, directory, file_name, expected_sha256=None):
+    """Copy content_length bytes from rfile to directory/file_name.
+
+    The body is read in UPLOAD_CHUNK_SIZE pieces, see save_upload_chunks.
+    Returns the number of bytes written, or raises OSError/ValueError
+    (ChecksumMismatch if expected_sha256 is given and doesn't match)."""
+    return save_upload_chunks(read_body_chunks(rfile, content_length), directory, file_name,
+                              expected_sha256, content_length)
+
+# Read a request body of known length in UPLOAD_CHUNK_SIZE pieces
+
+
+def read_body_chunks(rfile, content_length):
+    remaining = content_length
+    while remaining > 0:
+        chunk = rfile.read(min(UPLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise ValueError(f"Connection closed with {remaining} bytes still expected")
+        remaining -= len(chunk)
+        yield chunk
+
+# Undo Content-Encoding: gzip on request body pieces, in UPLOAD_CHUNK_SIZE pieces
+
+
+def gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            # Bounded output per call, so a small body can't inflate into a huge buffer
+            while chunk:
+                if decompressor.eof:
+                    raise InvalidEncoding("Data after the end of the gzip stream")
+                data = decompressor.decompress(chunk, UPLOAD_CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+                if data:
+                    yield data
+            if decompressor.unused_data:
+                raise InvalidEncoding("Data after the end of the gzip stream")
+        data = decompressor.flush()
+        if data:
+            yield data
+    except zlib.error as e:
+        raise InvalidEncoding(f"Invalid gzip body: {e}") from None
+    if not decompressor.eof:
+        raise InvalidEncoding("Truncated gzip body")
+
+
+def save_upload_chunks(chunks, directory, file_name, expected_sha256=None, size=None):
+    """Store the byte strings from chunks as directory/file_name.
+
+    The storage takes them as they come, so memory use doesn't depend on
+    the file size with disk storage, and nobody sees a half written file.
+    Returns the number of bytes written, or raises OSError/ValueError
+    (ChecksumMismatch if expected_sha256 is given and doesn't match,
+    StorageFull if there is no room). size is the expected size if known
+    in advance."""
+    return storage.save(chunks, directory, file_name, expected_sha256, size)
+
+
+class MultipartReader:
+    """Streaming parser for a multipart/form-data request body.
+
+    The body comes in as pieces from an iterable, e.g. read_body_chunks().
+    next_part() returns the headers of the next part (None after the last),
+    and part_chunks() then yields that part's body in pieces of about the
+    same size. Only the unread piece of the body plus one boundary's
+    worth of look-behind is held in memory, so many large files can arrive
+    in a single request."""
+
+    # Largest header block accepted for one part (bytes)
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__(self, chunks, boundary):
+        self.chunks = iter(chunks)
+        self.delimiter = b'\r\n--' + boundary
+        # The first boundary isn't preceded by a line break of its own
+        self.buffer = bytearray(b'\r\n')
+        self.in_part = False
+        self.finished = False
+
+    def fill(self):
+        data = next(self.chunks, None)
+        if data is None:
+            raise ValueError("Multipart body ended before its closing boundary")
+        self.buffer += data
+
+    def part_chunks(self):
+        """Yield the current part's body up to (not including) the next boundary"""
+        keep = len(self.delimiter) - 1
+        while self.in_part:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buffer[:index])
+                del self.buffer[:index]
+                self.in_part = False
+                return
+            # The end of the buffer may be the start of a boundary
+            if len(self.buffer) > keep:
+                chunk = bytes(self.buffer[:-keep])
+                del self.buffer[:-keep]
+                yield chunk
+            self.fill()
+
+    def next_part(self):
+        """Skip to the next part and return its headers as a dict with
+        lower-case names, or None once the closing boundary is reached"""
+        for _ in self.part_chunks():
+            pass
+        if self.finished:
+            return None
+
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0 and len(self.buffer) >= index + len(self.delimiter) + 2:
+                break
+            self.fill()
+        del self.buffer[:index + len(self.delimiter)]
+        if self.buffer.startswith(b'--'):
+            self.finished = True
+            return None
+
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise ValueError("Multipart part headers too large")
+            self.fill()
+        header_lines = self.buffer[:end].decode('utf-8', 'replace').split('\r\n')
+        del self.buffer[:end + 4]
+
+        headers = {}
+        # The first line is the rest of the boundary line (transport padding)
+        for line in header_lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        self.in_part = True
+        return headers
+
+    @staticmethod
+    def file_name(headers):
+        """The filename parameter of a part's Content-Disposition, if any"""
+        disposition = headers.get('content-disposition', '')
+        message = email.message.Message()
+        message['Content-Disposition'] = disposition
+        file_name = message.get_param('filename', header='Content-Disposition')
+        if file_name is None:
+            return None
+        return email.utils.collapse_rfc2231_value(file_name)
+
+
+class ChunkedWriter:
+    """Write-only file object for a response body of unknown length.
+
+    Data is collected into pieces of about size bytes and sent with
+    chunked transfer encoding, or as-is for HTTP/1.0 clients, where the end
+    of the body is marked by closing the connection. It has no tell(), so
+    zipfile writes to it in streaming mode."""
+
+    def __init__(self, wfile, chunked=True, progress=None, size=DOWNLOAD_CHUNK_SIZE):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.size = size
+        # Called with the size of each piece once it is sent
+        self.progress = progress
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.chunked:
+            self.wfile.write(b'%x\r\n' % len(self.buffer))
+            self.wfile.write(self.buffer)
+            self.wfile.write(b'\r\n')
+        else:
+            self.wfile.write(self.buffer)
+        if self.progress:
+            self.progress(len(self.buffer))
+        self.buffer.clear()
+
+    def close(self):
+        """Send what is left and mark the end of the body"""
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+# Read a whole number from the query string
+
+
+def query_int(query, name, default=None, low=None, high=None):
+    """The parameter name from parse_qs() output as an int, default when
+    it is absent; raises ValueError with a message for the client if it
+    isn't a whole number from low to high (either None for no bound)"""
+    if name not in query:
+        return default
+    try:
+        value = int(query[name][0])
+    except ValueError:
+        raise ValueError(f'{name} must be an integer') from None
+    if low is not None and value < low or high is not None and value > high:
+        raise ValueError(f'{name} must be from {low} to {high}' if high is not None
+                         else f'{name} must be at least {low}')
+    return value
+
+# Parse a single "bytes=" Range header against a file size
+
+
+def parse_byte_range(range_header, file_size):
+    """Return (start, end) inclusive, None to ignore the header and send the
+    whole file, or 'unsatisfiable' when no requested byte exists."""
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        # Multiple ranges are allowed to be answered with the full body
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix <= 0:
+                return 'unsatisfiable'
+            return max(0, file_size - suffix), file_size - 1
+        start = int(first)
+        end = int(last) if last else file_size - 1
+    except ValueError:
+        return None
+
+    if start >= file_size:
+        return 'unsatisfiable'
+    if end < start:
+        return None
+    return start, min(end, file_size - 1)
+
+
+# ioctl request reading an interface's IPv4 address (SIOCGIFADDR)
+SIOCGIFADDR = 0xc0206921 if sys.platform == 'darwin' or 'bsd' in sys.platform else 0x8915
+
+# List the addresses other devices can reach this machine at
+
+
+def address_rank(address):
+    """Sort key putting the addresses most likely on the user's LAN first"""
+    first, second = (int(part) for part in address.split('.')[:2])
+    if (first, second) == (192, 168):
+        return 0
+    if first == 10:
+        return 1
+    if first == 172 and 16 <= second <= 31:
+        # Also what Docker gives its bridges, so after the other private ranges
+        return 2
+    if (first, second) == (169, 254):
+        # Link-local, only there when nothing assigned an address
+        return 4
+    return 3
+
+
+def interface_addresses():
+    """IPv4 addresses of the network interfaces, LAN addresses first.
+
+    Each interface is asked for its address with an ioctl, which only reads
+    kernel state: unlike resolving the host name or routing a probe to an
+    outside address, it can't wait on DNS or a network that isn't there.
+    Loopback is left out; an empty list means the addresses couldn't be
+    read this way."""
+    if fcntl is None or not hasattr(socket, 'if_nameindex'):
+        return []
+    addresses = []
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            for _, name in socket.if_nameindex():
+                request = struct.pack('256s', name.encode()[:15])
+                try:
+                    reply = fcntl.ioctl(probe.fileno(), SIOCGIFADDR, request)
+                except OSError:
+                    # Down, or without an IPv4 address
+                    continue
+                # struct ifreq: 16 bytes of name, then a sockaddr_in
+                address = socket.inet_ntoa(reply[20:24])
+                if not address.startswith('127.') and address not in addresses:
+                    addresses.append(address)
+    except OSError as e:
+        logger.debug(f"Could not list interface addresses: {e}")
+        return []
+    return sorted(addresses, key=address_rank)
+
+
+def get_local_ip():
+    """The LAN address found by routing and DNS lookups, for systems where
+    interface_addresses() can't list them; this can take seconds offline"""
+
+    # Try multiple methods to get IP
+    try:
+        # Preferred method: Create UDP connection and get local IP
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+        s.close()
+
+        # Confirm if it's a local network IP
+        if ip.startswith(('192.168.', '10.', '172.16.', '172.17.', '172.18.')):
+            return ip
+    except Exception as e:
+        logger.warning(f"Primary IP detection method failed: {e}")
+
+    # Alternative method: Try to get all network interfaces
+    try:
+        interfaces = socket.gethostbyname_ex(socket.gethostname())[-1]
+        for ip in interfaces:
+            if ip.startswith(('192.168.', '10.', '172.16.', '172.17.', '172.18.')):
+                return ip
+    except Exception as e:
+        logger.warning(f"Alternative IP detection method failed: {e}")
+
+    # All methods failed, return local loopback
+    return "127.0.0.1"
+
+
+class CountingReader(io.BufferedReader):
+    """Buffered socket reader that counts the bytes handed out, so the
+    handler can tell whether a request body was read to the end"""
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.consumed = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.consumed += len(data)
+        metrics.received.add(len(data))
+        return data
+
+    def read1(self, size=-1):
+        data = super().read1(size)
+        self.consumed += len(data)
+        metrics.received.add(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = super().readline(size)
+        self.consumed += len(data)
+        metrics.received.add(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = super().readinto(buffer)
+        self.consumed += count or 0
+        metrics.received.add(count or 0)
+        return count
+
+
+class CountingWriter(io.BufferedIOBase):
+    """Unbuffered socket writer (like the one StreamRequestHandler makes)
+    that counts the bytes sent, including those sent with sendfile()"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sock.sendall(data)
+        with memoryview(data) as view:
+            count = view.nbytes
+        self.written += count
+        metrics.sent.add(count)
+        return count
+
+    def sendfile(self, file, offset, count):
+        sent = self.sock.sendfile(file, offset, count)
+        self.written += sent
+        metrics.sent.add(sent)
+        return sent
+
+    def fileno(self):
+        return self.sock.fileno()
+
+# Request, transfer and throughput statistics for /api/metrics
+
+
+class Histogram:
+    """Counts of observed values per bucket, Prometheus style: a value
+    falls in the first bucket whose upper bound is >= it"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, count of values <= it) pairs, ending with +Inf"""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None if empty
+        or past the last bound)"""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return None if bound == float('inf') else bound
+        return None
+
+    def summary(self, scale=1):
+        def scaled(value):
+            return None if value is None else round(value * scale, 3)
+        return {
+            'count': self.count,
+            'mean': scaled(self.sum / self.count) if self.count else None,
+            'p50': scaled(self.quantile(0.5)),
+            'p90': scaled(self.quantile(0.9)),
+            'p99': scaled(self.quantile(0.99)),
+        }
+
+
+class RateMeter:
+    """Byte counter with a per-second ring, for the current throughput"""
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.seconds = [0] * (window + 1)
+        self.buckets = [0] * (window + 1)
+        self.total = 0
+
+    def add(self, count):
+        now = int(time.monotonic())
+        slot = now % len(self.buckets)
+        with self.lock:
+            if self.seconds[slot] != now:
+                self.seconds[slot] = now
+                self.buckets[slot] = 0
+            self.buckets[slot] += count
+            self.total += count
+
+    def rate(self):
+        """Bytes per second over the last window whole seconds"""
+        now = int(time.monotonic())
+        with self.lock:
+            recent = sum(count for second, count in zip(self.seconds, self.buckets)
+                         if now - self.window <= second < now)
+        return recent / self.window
+
+
+def route_name(path):
+    """Collapse a request path to its route, so that file names and upload
+    ids don't each get their own metrics"""
+    if static_assets.get(path) is not None:
+        return '/static'
+    parts = path.strip('/').split('/')
+    if parts[0] in ('received_files', 'shared_files') and len(parts) == 2:
+        parts[1] = '<name>'
+    elif parts[:2] == ['api', 'uploads'] and len(parts) > 2:
+        parts[2] = '<id>'
+        if len(parts) == 5:
+            parts[4] = '<n>'
+    elif parts[:2] == ['api', 'messages'] and len(parts) == 3 and parts[2] != 'search':
+        parts[2] = '<id>'
+    elif parts[:2] == ['api', 'blobs'] and len(parts) > 2:
+        parts[2] = '<sha256>'
+    route = '/' + '/'.join(parts)
+    return route if route in METRIC_ROUTES else 'other'
+
+
+class Metrics:
+    """Per-route request counts, latencies and bytes, file transfers in
+    progress and their durations, and the current throughput.
+
+    Handlers call record_request() once per request and wrap file uploads
+    and downloads in transfer(). Everything is kept in memory and costs a
+    lock and a few dictionary updates per request."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.routes = {}
+        self.active_transfers = {'upload': 0, 'download': 0}
+        self.transfer_durations = {direction: Histogram(TRANSFER_BUCKETS)
+                                   for direction in self.active_transfers}
+        self.received = RateMeter()
+        self.sent = RateMeter()
+
+    def record_request(self, method, route, status, duration, bytes_in, bytes_out):
+        with self.lock:
+            stats = self.routes.get((method, route))
+            if stats is None:
+                stats = self.routes[(method, route)] = {
+                    'statuses': collections.Counter(),
+                    'latency': Histogram(LATENCY_BUCKETS),
+                    'bytes_in': 0,
+                    'bytes_out': 0,
+                }
+            stats['statuses'][status] += 1
+            stats['latency'].observe(duration)
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+
+    @contextlib.contextmanager
+    def transfer(self, direction):
+        """Count a file upload or download as active while the block runs"""
+        start = time.perf_counter()
+        with self.lock:
+            self.active_transfers[direction] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_transfers[direction] -= 1
+                self.transfer_durations[direction].observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        """The metrics as the /api/metrics JSON body"""
+        with self.lock:
+            routes = {}
+            for (method, route), stats in sorted(self.routes.items()):
+                routes[f'{method} {route}'] = {
+                    'requests': sum(stats['statuses'].values()),
+                    'statuses': {str(status): count for status, count in sorted(stats['statuses'].items())},
+                    'latency_ms': stats['latency'].summary(scale=1000),
+                    'bytes_in': stats['bytes_in'],
+                    'bytes_out': stats['bytes_out'],
+                }
+            transfers = {direction: {
+                'active': self.active_transfers[direction],
+                'duration_seconds': self.transfer_durations[direction].summary(),
+            } for direction in self.active_transfers}
+        return {
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'routes': routes,
+            'transfers': transfers,
+            'throughput_bytes_per_second': {'in': round(self.received.rate()), 'out': round(self.sent.rate())},
+            'bytes_total': {'in': self.received.total, 'out': self.sent.total},
+        }
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        def labels(**values):
+            return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+
+        def histogram(name, histogram, **values):
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{name}_bucket{labels(**values, le=le)} {count}')
+            lines.append(f'{name}_sum{labels(**values)} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{labels(**values)} {histogram.count}')
+
+        lines = []
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines.append('# HELP snapsend_requests_total Requests handled, by route and status.')
+            lines.append('# TYPE snapsend_requests_total counter')
+            for (method, route), stats in routes:
+                for status, count in sorted(stats['statuses'].items()):
+                    lines.append(f'snapsend_requests_total{labels(method=method, route=route, status=status)} {count}')
+
+            lines.append('# HELP snapsend_request_duration_seconds Time to handle a request.')
+            lines.append('# TYPE snapsend_request_duration_seconds histogram')
+            for (method, route), stats in routes:
+                histogram('snapsend_request_duration_seconds', stats['latency'], method=method, route=route)
+
+            for key, help_text in (('bytes_in', 'Request bytes received, headers included.'),
+                                   ('bytes_out', 'Response bytes sent, headers included.')):
+                name = 'snapsend_request_bytes_total' if key == 'bytes_in' else 'snapsend_response_bytes_total'
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for (method, route), stats in routes:
+                    lines.append(f'{name}{labels(method=method, route=route)} {stats[key]}')
+
+            lines.append('# HELP snapsend_active_transfers File uploads and downloads in progress.')
+            lines.append('# TYPE snapsend_active_transfers gauge')
+            for direction, active in self.active_transfers.items():
+                lines.append(f'snapsend_active_transfers{labels(direction=direction)} {active}')
+
+            lines.append('# HELP snapsend_transfer_duration_seconds Time taken by file uploads and downloads.')
+            lines.append('# TYPE snapsend_transfer_duration_seconds histogram')
+            for direction, durations in self.transfer_durations.items():
+                histogram('snapsend_transfer_duration_seconds', durations, direction=direction)
+
+        lines.append(f'# HELP snapsend_throughput_bytes_per_second Bytes per second over the last {THROUGHPUT_WINDOW} s.')
+        lines.append('# TYPE snapsend_throughput_bytes_per_second gauge')
+        lines.append(f'snapsend_throughput_bytes_per_second{labels(direction="in")} {self.received.rate():.1f}')
+        lines.append(f'snapsend_throughput_bytes_per_second{labels(direction="out")} {self.sent.rate():.1f}')
+        lines.append('# HELP snapsend_start_time_seconds When the server started, in Unix time.')
+        lines.append('# TYPE snapsend_start_time_seconds gauge')
+        lines.append(f'snapsend_start_time_seconds {self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# Rate limits and fair sharing of bandwidth between transfers
+
+
+def fair_shares(capacity, demands, cap=float('inf')):
+    """Split capacity max-min fairly: whoever wants less than an equal
+    share gets what it wants, the others split what is left equally.
+    demands maps keys to rates (float('inf') for as much as there is);
+    capacity nobody wants is spread over everyone, up to cap each, so
+    that a transfer can speed up before the next round."""
+    if capacity == float('inf'):
+        return {key: cap for key in demands}
+    shares = {}
+    remaining = dict(demands)
+    while remaining:
+        share = capacity / len(remaining)
+        satisfied = {key: demand for key, demand in remaining.items() if demand <= share}
+        if not satisfied:
+            shares.update((key, share) for key in remaining)
+            return shares
+        for key, demand in satisfied.items():
+            shares[key] = demand
+            capacity -= demand
+            del remaining[key]
+    spare = capacity / len(shares) if shares else 0
+    return {key: min(cap, share + spare) for key, share in shares.items()}
+
+
+class TokenBucket:
+    """Bytes allowed at rate per second, saved up to a burst. take() may
+    overdraw the bucket; wait() says how long until the debt is paid off."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(BANDWIDTH_PIECE_SIZE, rate * BANDWIDTH_BURST_TIME)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+        self.burst = max(BANDWIDTH_PIECE_SIZE, rate * BANDWIDTH_BURST_TIME)
+        self.tokens = min(self.tokens, self.burst)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate == float('inf'):
+            self.tokens = self.burst
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, count):
+        self.refill()
+        self.tokens -= count
+
+    def wait(self):
+        self.refill()
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class BandwidthStream:
+    """What the scheduler knows about one transfer"""
+
+    def __init__(self, transfer, rate):
+        self.transfer = transfer
+        self.bucket = TokenBucket(rate)
+        self.moved = 0
+        self.waited = 0.0
+        self.rate = None
+        self.demand = float('inf')
+        self.last_moved = time.monotonic()
+
+
+class BandwidthScheduler:
+    """Meters uploads and downloads through token buckets so that the
+    --max-rate, --client-rate and --transfer-rate limits hold and are
+    shared fairly.
+
+    Every BANDWIDTH_INTERVAL the total is split max-min fairly between
+    clients (by address), and each client's share between its transfers,
+    so a phone with four downloads gets no more than one with one. A
+    transfer that moved less than it was given, e.g. a slow receiver,
+    only keeps a little more than it used and the rest goes to the others.
+    Requests that aren't transfers (the API, pages) are never held back;
+    their response bytes come off --max-rate first, so that small responses
+    don't queue in the network behind bulk bytes.
+
+    The thread moving a transfer's data calls meter() after each piece and
+    is held there while the transfer is over its rate. For an upload that
+    means the rest of the body stays unread, so the sender is slowed down by
+    TCP flow control instead of the server buffering what it can't take."""
+
+    def __init__(self, total=None, client=None, transfer=None):
+        self.lock = threading.Lock()
+        self.configure(total, client, transfer)
+        self.streams = {}
+        self.client_shares = {}
+        self.measured_at = time.monotonic()
+        # Bytes of downloads, and of all responses, at the last measure()
+        self.sent = 0
+        self.last_sent = 0
+        self.last_total = 0
+        self.interactive_rate = 0.0
+        self.available = float('inf')
+
+    def configure(self, total=None, client=None, transfer=None):
+        """Set the limits in bytes per second; None is unlimited"""
+        def limit(rate):
+            return float('inf') if rate is None else float(rate)
+        self.total = limit(total)
+        self.client = limit(client)
+        self.transfer = limit(transfer)
+
+    @property
+    def limited(self):
+        return min(self.total, self.client, self.transfer) != float('inf')
+
+    def piece_size(self, size):
+        """The size to move data in at a time, at most size"""
+        return min(size, BANDWIDTH_PIECE_SIZE) if self.limited else size
+
+    def meter(self, transfer, count):
+        """Count count bytes moved for transfer, then wait for as long as
+        the transfer is over the rate it was given"""
+        with self.lock:
+            now = time.monotonic()
+            stream = self.streams.get(transfer)
+            if stream is None:
+                stream = self.streams[transfer] = BandwidthStream(transfer, self.transfer)
+                self.share()
+            stream.moved += count
+            stream.last_moved = now
+            if transfer.direction == 'download':
+                self.sent += count
+            if now - self.measured_at >= BANDWIDTH_INTERVAL:
+                self.measure(now)
+                self.share()
+            stream.bucket.take(count)
+            delay = stream.bucket.wait()
+        while delay > 0:
+            # In slices, so that a larger share given meanwhile applies
+            pause = min(delay, BANDWIDTH_INTERVAL)
+            time.sleep(pause)
+            with self.lock:
+                stream.waited += pause
+                delay = stream.bucket.wait()
+
+    def release(self, transfer):
+        """Forget a transfer that has ended"""
+        with self.lock:
+            if self.streams.pop(transfer, None) is not None:
+                self.share()
+
+    def measure(self, now):
+        """Work out the rates of the last interval and what each transfer
+        would take if it could"""
+        elapsed = now - self.measured_at
+        self.measured_at = now
+        # Responses that aren't downloads; request bodies don't count, as
+        # rejected uploads are read at full speed only to be thrown away
+        total = metrics.sent.total
+        self.interactive_rate = max(0, total - self.last_total - (self.sent - self.last_sent)) / elapsed
+        self.last_total = total
+        self.last_sent = self.sent
+        for transfer, stream in list(self.streams.items()):
+            # Chunked uploads keep their transfer between chunks
+            if now - stream.last_moved > 2 * BANDWIDTH_INTERVAL:
+                del self.streams[transfer]
+                continue
+            stream.rate = stream.moved / elapsed
+            # One that waited for its rate would have taken more
+            if stream.waited:
+                stream.demand = float('inf')
+            else:
+                stream.demand = max(BANDWIDTH_MIN_RATE, stream.rate * 1.5)
+            stream.moved = 0
+            stream.waited = 0.0
+
+    def share(self):
+        """Give every transfer its rate: the total split between clients,
+        each client's share split between its transfers"""
+        if self.total == float('inf'):
+            self.available = self.total
+        else:
+            self.available = max(self.total - self.interactive_rate, self.total * BANDWIDTH_BULK_FLOOR)
+        by_client = collections.defaultdict(dict)
+        for stream in self.streams.values():
+            by_client[stream.transfer.client][stream] = min(self.transfer, stream.demand)
+        self.client_shares = fair_shares(self.available, {
+            client: min(self.client, sum(demands.values())) for client, demands in by_client.items()
+        }, self.client)
+        for client, demands in by_client.items():
+            for stream, rate in fair_shares(self.client_shares[client], demands, self.transfer).items():
+                stream.bucket.set_rate(rate)
+
+    def describe(self, registry):
+        """The limits and current allocations as the /api/bandwidth JSON
+        body, listing only the transfers of registry's pairing session"""
+        def rate(value):
+            return None if value is None or value == float('inf') else round(value)
+
+        with self.lock:
+            own = [stream for stream in self.streams.values() if stream.transfer.registry is registry]
+            transfers = [{
+                'id': stream.transfer.id,
+                'direction': stream.transfer.direction,
+                'name': stream.transfer.name,
+                'client': stream.transfer.client,
+                'rate': rate(stream.rate),
+                'allocated': rate(stream.bucket.rate),
+                'throttled': stream.demand == float('inf') and stream.rate is not None,
+            } for stream in own]
+            clients = {client: rate(self.client_shares.get(client))
+                       for client in {stream.transfer.client for stream in own}}
+            return {
+                'limits': {'total': rate(self.total), 'client': rate(self.client),
+                           'transfer': rate(self.transfer)},
+                'interactive_rate': round(self.interactive_rate),
+                'available': rate(self.available),
+                'active_transfers': len(self.streams),
+                'clients': clients,
+                'transfers': transfers,
+            }
+
+
+bandwidth = BandwidthScheduler()
+
+# Custom HTTP request handler
+
+
+class CustomHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections. In threaded mode an idle connection doesn't
+    # hold a worker: it is parked with the server until its next request
+    # arrives (see WorkerPoolHTTPServer). Single mode closes after each
+    # request, since an open connection would block every other client.
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes. With Nagle's algorithm on, the
+    # body of a response on a reused connection waits for the client's
+    # delayed ACK of the headers, adding ~40 ms to every request.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.rfile = CountingReader(self.rfile.detach())
+        self.wfile = CountingWriter(self.connection)
+        self.response_status = None
+        self.body_start = 0
+        self.requests_served = 0
+        self.parked = False
+        self.connection_header_sent = False
+
+    def handle(self):
+        self.serve_requests()
+
+    def resume(self):
+        """Serve a parked connection again once its next request is in"""
+        self.parked = False
+        try:
+            self.serve_requests()
+        finally:
+            self.finish()
+
+    def finish(self):
+        # A parked connection keeps its streams for the next request
+        if not self.parked:
+            super().finish()
+
+    def serve_requests(self):
+        """Handle requests for as long as they arrive back to back, then
+        park the connection with the server, or close it"""
+        while True:
+            start = time.perf_counter()
+            consumed, written = self.rfile.consumed, self.wfile.written
+            self.response_status = None
+            self.handle_one_request()
+            if self.response_status is not None:
+                self.record_request(time.perf_counter() - start, self.rfile.consumed - consumed,
+                                    self.wfile.written - written)
+            self.requests_served += 1
+            if not self.close_connection and not self.skip_unread_body():
+                self.close_connection = True
+            if self.close_connection:
+                return
+            if not self.has_buffered_request():
+                self.parked = True
+                return
+
+    def parse_request(self):
+        ok = super().parse_request()
+        if ok:
+            # Answer with what the other worker processes have done so far
+            worker_sync.catch_up()
+            self.pairing = pairings.resolve(self.headers.get('Cookie'))
+        self.body_start = self.rfile.consumed
+        self.connection_header_sent = False
+        if not hasattr(self.server, 'park_connection') or \
+                self.requests_served + 1 >= KEEP_ALIVE_MAX_REQUESTS:
+            self.close_connection = True
+        return ok
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if not self.close_connection and self.unread_body() is None:
+            self.close_connection = True
+        # Tell the client whether the connection stays open
+        if not self.connection_header_sent and hasattr(self, '_headers_buffer'):
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+
+    def log_request(self, code='-', size='-'):
+        # Logged with its timing once the response is complete, see record_request
+        self.response_status = code.value if isinstance(code, http.HTTPStatus) else code
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+    def log_error(self, format, *args):
+        # The status is in the request line logged after it
+        logger.debug('%s %s', self.address_string(), format % args)
+
+    def record_request(self, duration, bytes_in, bytes_out):
+        """Add a finished request to the metrics and the logs"""
+        method = self.command or '-'
+        path = urlparse(self.path).path if self.command else ''
+        route = route_name(path) if self.command else 'other'
+        metrics.record_request(method, route, self.response_status, duration, bytes_in, bytes_out)
+
+        logger.info('%s "%s" %s %d %.1fms', self.client_address[0], self.requestline,
+                    self.response_status, bytes_out, duration * 1000)
+        if access_logger.isEnabledFor(logging.INFO):
+            headers = getattr(self, 'headers', None)
+            access_logger.info(json.dumps({
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                'client': self.client_address[0],
+                'method': method,
+                'path': path,
+                'route': route,
+                'status': self.response_status,
+                'duration_ms': round(duration * 1000, 3),
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'user_agent': headers.get('User-Agent') if headers is not None else None,
+            }))
+
+    def unread_body(self):
+        """Bytes of the request body not read so far, or None if the rest
+        can't be skipped to reuse the connection: the body is chunked,
+        malformed or more than MAX_SKIP_BODY_BYTES"""
+        if 'Transfer-Encoding' in self.headers:
+            return None
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return None
+        unread = max(0, length - (self.rfile.consumed - self.body_start))
+        return unread if unread <= MAX_SKIP_BODY_BYTES else None
+
+    def skip_unread_body(self):
+        """Read whatever the handler left of the request body so the next
+        request starts in the right place. False if the connection can't be
+        reused after all."""
+        unread = self.unread_body()
+        if unread is None:
+            return False
+        try:
+            return len(self.rfile.read(unread)) == unread
+        except OSError:
+            return False
+
+    def has_buffered_request(self):
+        """True if (part of) the next request has already arrived"""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        # Parse URL path
+        parsed_path = urlparse(self.path)
+        path = parsed_path.path
+        if self.pairing_ended(path):
+            return
+
+        # API endpoint to get messages
+        if path == '/api/messages':
+            self.send_messages(parse_qs(parsed_path.query))
+            return
+
+        # Messages containing every word of ?q=, newest first
+        elif path == '/api/messages/search':
+            self.send_message_search(parse_qs(parsed_path.query))
+            return
+
+        # The whole text of a message that lists cut short
+        elif path.startswith('/api/messages/'):
+            message_id = path[len('/api/messages/'):]
+            message = find_message(self.pairing, int(message_id)) if message_id.isdigit() else None
+            if message is None:
+                self.send_json(404, {'status': 'error', 'message': 'Unknown message'})
+            else:
+                self.send_json(200, message)
+            return
+
+        # Request, transfer and throughput metrics, as JSON or for Prometheus
+        elif path == '/api/metrics':
+            self.send_metrics(parse_qs(parsed_path.query))
+            return
+
+        # Uploads and downloads in progress, oldest first
+        elif path == '/api/transfers':
+            self.send_json(200, self.pairing.transfers.listing())
+            return
+
+        # Rate limits and what each transfer is given of them
+        elif path == '/api/bandwidth':
+            self.send_json(200, bandwidth.describe(self.pairing.transfers))
+            return
+
+        # Addresses the server can be reached at, for the QR code
+        elif path == '/api/addresses':
+            self.send_json(200, {'addresses': interface_addresses(),
+                                 'port': self.server.server_address[1]})
+            return
+
+        # Server-sent event stream of message and file changes
+        elif path == '/api/events':
+            self.stream_events()
+            return
+
+        # Whether a file with this SHA-256 is stored, so it needn't be uploaded
+        elif path.startswith('/api/blobs/'):
+            digest = path.split('/')[3]
+            size = storage.lookup(digest, self.pairing.directories['received'])
+            if size is None:
+                self.send_json(404, {'status': 'error', 'message': 'Unknown content'})
+            else:
+                self.send_json(200, {'sha256': digest.lower(), 'size': size})
+            return
+
+        # Status of a chunked upload, to find out which chunks to resend
+        elif path.startswith('/api/uploads/'):
+            session = self.upload_session(path.split('/')[3])
+            if session is None:
+                self.send_json(404, {'status': 'error', 'message': 'Unknown upload'})
+            else:
+                self.send_json(200, session.status())
+            return
+
+        # API endpoint to clear all messages
+        elif path == '/api/clear-messages':
+            # Clear all messages
+            if clear_messages(self.pairing):
+                self.send_json(200, {
+                    'status': 'success',
+                    'message': 'All messages cleared'
+                })
+            else:
+                self.send_json(200, {
+                    'status': 'error',
+                    'message': 'Failed to clear messages'
+                })
+            return
+
+        # ZIP of all or the selected (?name=...) received or shared files
+        elif path in ('/api/files/archive', '/api/shared-files/archive'):
+            directory = self.pairing.directories['received' if path == '/api/files/archive' else 'shared']
+            self.send_archive(directory, parse_qs(parsed_path.query).get('name', []))
+            return
+
+        # Preview of a received or shared image file (?name=...)
+        elif path in ('/api/files/thumbnail', '/api/shared-files/thumbnail'):
+            directory = self.pairing.directories['received' if path == '/api/files/thumbnail' else 'shared']
+            self.send_thumbnail(directory, parse_qs(parsed_path.query).get('name', [''])[0])
+            return
+
+        # API endpoint to get received files list (from mobile to desktop)
+        if path == '/api/files':
+            self.send_json_bytes(200, self.pairing.files.listing_json(self.pairing.directories['received']))
+            return
+
+        # API endpoint to get shared files list (from desktop to mobile)
+        elif path == '/api/shared-files':
+            self.send_json_bytes(200, self.pairing.files.listing_json(self.pairing.directories['shared']))
+            return
+
+        # Serve received files
+        elif path.startswith('/received_files/'):
+            self.serve_file(self.pairing.directories['received'], unquote(path.split('/')[-1]))
+            return
+
+        # Serve shared files
+        elif path.startswith('/shared_files/'):
+            self.serve_file(self.pairing.directories['shared'], unquote(path.split('/')[-1]))
+            return
+
+        # Pages, scripts and stylesheet from the in-memory cache
+        elif static_assets.get(path) is not None:
+            self.serve_static(static_assets.get(path))
+            return
+
+        # Nothing else is served: the working directory holds the blob store,
+        # the pairing sessions' files and the message databases
+        self.send_error(404, 'File not found')
+
+    def do_HEAD(self):
+        """Answer HEAD for transferred files without sending the body"""
+        path = urlparse(self.path).path
+        if self.pairing_ended(path):
+            return
+        if path.startswith('/received_files/'):
+            self.serve_file(self.pairing.directories['received'], unquote(path.split('/')[-1]), head_only=True)
+        elif path.startswith('/shared_files/'):
+            self.serve_file(self.pairing.directories['shared'], unquote(path.split('/')[-1]), head_only=True)
+        elif static_assets.get(path) is not None:
+            self.serve_static(static_assets.get(path), head_only=True)
+        else:
+            self.send_error(404, 'File not found')
+
+    def do_POST(self):
+        """Handle POST requests for file uploads and messages"""
+        parsed_path = urlparse(self.path)
+        path = parsed_path.path
+        if self.pairing_ended(path):
+            return
+
+        # Start, resume or join a pairing session
+        if path == '/api/pairing':
+            self.handle_pairing()
+            return
+
+        # Streamed raw uploads, mobile to desktop and desktop to mobile
+        if path in ('/upload/stream', '/upload-to-mobile/stream'):
+            directory = self.pairing.directories['received' if path == '/upload/stream' else 'shared']
+            self.handle_stream_upload(directory, parse_qs(parsed_path.query))
+            return
+
+        # Many files in one multipart/form-data request
+        if path in ('/upload/batch', '/upload-to-mobile/batch'):
+            directory = self.pairing.directories['received' if path == '/upload/batch' else 'shared']
+            self.handle_batch_upload(directory)
+            return
+
+        # Start a chunked upload
+        if path == '/api/uploads':
+            self.handle_upload_init()
+            return
+
+        # Finish a chunked upload once every chunk is in
+        parts = path.strip('/').split('/')
+        if len(parts) == 4 and parts[:2] == ['api', 'uploads'] and parts[3] == 'complete':
+            self.handle_upload_complete(parts[2])
+            return
+
+        # Name an already stored file instead of uploading it again
+        if len(parts) == 4 and parts[:2] == ['api', 'blobs'] and parts[3] == 'link':
+            self.handle_blob_link(parts[2])
+            return
+
+        # Handle sending a message
+        if path == '/api/send-message':
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+
+            try:
+                # Parse JSON data
+                json_data = json.loads(post_data.decode('utf-8'))
+
+                # Check if it's a valid message
+                if 'sender' in json_data and 'content' in json_data:
+                    sender = json_data['sender']
+                    content = json_data['content']
+
+                    # Validate message content
+                    if content.strip() == "":
+                        self.send_json(400, {
+                            'status': 'error',
+                            'message': 'Message content cannot be empty'
+                        })
+                        return
+
+                    # Add message
+                    message = add_message(self.pairing, sender, content)
+                    if message:
+                        self.send_json(200, {
+                            'status': 'success',
+                            'message': 'Message sent successfully',
+                            'id': message['id']
+                        })
+                        return
+                    else:
+                        self.send_json(500, {
+                            'status': 'error',
+                            'message': 'Failed to send message'
+                        })
+                        return
+            except Exception as e:
+                logger.error(f"Error processing message: {e}")
+                # If JSON parsing fails or any other error
+                pass
+
+        # Handle upload from mobile to desktop
+        elif path == '/upload':
+            # The JSON body is decoded whole in memory, so a gzip one could
+            # inflate without bound; compressed uploads go to /upload/stream
+            if self.accept_content_encoding(('identity',)) is None:
+                return
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+
+            try:
+                # Try to parse JSON data
+                json_data = json.loads(post_data.decode('utf-8'))
+
+                # If it's a file upload
+                if 'fileName' in json_data and 'fileData' in json_data:
+                    file_name = json_data['fileName']
+                    file_data = json_data['fileData']
+
+                    # If fileData is a base64 string
+                    if isinstance(file_data, str):
+                        try:
+                            file_bytes = base64.b64decode(file_data)
+                        except Exception:
+                            file_bytes = file_data.encode('utf-8')
+                    elif isinstance(file_data, list):
+                        file_bytes = bytes(file_data)
+                    else:
+                        file_bytes = file_data
+
+                    if not isinstance(file_bytes, bytes):
+                        file_bytes = file_bytes.encode('utf-8')
+
+                    # Save the file through a temp file so readers never see a partial write
+                    file_name = safe_file_name(file_name)
+                    if file_name is None:
+                        raise ValueError('Invalid file name')
+                    directory = self.pairing.directories['received']
+                    save_upload_stream(io.BytesIO(file_bytes), len(file_bytes), directory, file_name)
+                    self.pairing.files.add(directory, file_name)
+
+                    logger.info(f"File saved: {file_name} ({len(file_bytes)} bytes)")
+
+                    # Send success response
+                    self.send_json(200, {
+                        'status': 'success',
+                        'message': f'File {file_name} received successfully'
+                    })
+                    return
+            except Exception as e:
+                logger.error(f"Error processing upload: {e}")
+                # If JSON parsing fails or any other error
+                pass
+
+        # Handle upload from desktop to mobile
+        elif path == '/upload-to-mobile':
+            # The JSON body is decoded whole in memory, so a gzip one could
+            # inflate without bound; compressed uploads go to /upload/stream
+            if self.accept_content_encoding(('identity',)) is None:
+                return
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+
+            try:
+                # Try to parse JSON data
+                json_data = json.loads(post_data.decode('utf-8'))
+
+                # If it's a file upload
+                if 'fileName' in json_data and 'fileData' in json_data:
+                    file_name = json_data['fileName']
+                    file_data = json_data['fileData']
+
+                    # If fileData is a base64 string
+                    if isinstance(file_data, str):
+                        try:
+                            file_bytes = base64.b64decode(file_data)
+                        except Exception:
+                            file_bytes = file_data.encode('utf-8')
+                    elif isinstance(file_data, list):
+                        file_bytes = bytes(file_data)
+                    else:
+                        file_bytes = file_data
+
+                    if not isinstance(file_bytes, bytes):
+                        file_bytes = file_bytes.encode('utf-8')
+
+                    # Save the file through a temp file so readers never see a partial write
+                    file_name = safe_file_name(file_name)
+                    if file_name is None:
+                        raise ValueError('Invalid file name')
+                    directory = self.pairing.directories['shared']
+                    save_upload_stream(io.BytesIO(file_bytes), len(file_bytes), directory, file_name)
+                    self.pairing.files.add(directory, file_name)
+
+                    logger.info(f"File shared: {file_name} ({len(file_bytes)} bytes)")
+
+                    # Send success response
+                    self.send_json(200, {
+                        'status': 'success',
+                        'message': f'File {file_name} shared successfully'
+                    })
+                    return
+            except Exception as e:
+                logger.error(f"Error processing shared file: {e}")
+                # If JSON parsing fails or any other error
+                pass
+
+        # Default response for other POST requests or errors
+        self.send_json(400, {
+            'status': 'error',
+            'message': 'Invalid request'
+        })
+
+    def do_PUT(self):
+        """Handle PUT /api/uploads/<id>/chunks/<index>"""
+        path = urlparse(self.path).path
+        if self.pairing_ended(path):
+            return
+        parts = path.strip('/').split('/')
+        if len(parts) == 5 and parts[:2] == ['api', 'uploads'] and parts[3] == 'chunks':
+            self.handle_upload_chunk(parts[2], parts[4])
+            return
+
+        self.close_connection = True
+        self.send_json(404, {'status': 'error', 'message': 'Not found'})
+
+    def do_DELETE(self):
+        """Handle DELETE /api/uploads/<id> to abandon a chunked upload"""
+        path = urlparse(self.path).path
+        if self.pairing_ended(path):
+            return
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ['api', 'uploads']:
+            session = self.upload_session(parts[2])
+            if session is not None:
+                session = upload_sessions.remove(session.id)
+            if session is None:
+                self.send_json(404, {'status': 'error', 'message': 'Unknown upload'})
+            else:
+                self.pairing.transfers.finish(session.id, 'failed')
+                session.discard()
+                self.send_json(200, {'status': 'success', 'message': 'Upload cancelled'})
+            return
+
+        self.send_json(404, {'status': 'error', 'message': 'Not found'})
+
+    def read_json_body(self, max_size=64 * 1024):
+        """Read and parse a small JSON request body, or return None"""
+        content_length = self.headers.get('Content-Length')
+        if content_length is None or not content_length.isdigit() or int(content_length) > max_size:
+            self.close_connection = True
+            return None
+        try:
+            data = json.loads(self.rfile.read(int(content_length)).decode('utf-8'))
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def pairing_ended(self, path):
+        """Refuse a request for the state of a pairing session that has
+        ended, so the page asks for the QR code to be scanned again;
+        returns whether it did"""
+        if self.pairing is not None or not path.startswith(PAIRING_PATHS):
+            return False
+        self.send_json(410, {'status': 'error', 'message': 'This pairing has ended, scan the QR code again'})
+        return True
+
+    def handle_pairing(self):
+        """POST /api/pairing {token?}: join the session token, as a phone
+        that scanned the QR code does, or without one keep the session of
+        this browser or start a new one, as the desktop page does"""
+        data = self.read_json_body()
+        if data is None:
+            self.send_json(400, {'status': 'error', 'message': 'Invalid JSON body'})
+            return
+
+        if data.get('token') is not None:
+            pairing = pairings.get(str(data['token']))
+            if pairing is None:
+                self.send_json(404, {'status': 'error',
+                                     'message': 'This pairing has ended, scan the QR code again'})
+                return
+            pairing.touch()
+        elif self.pairing is not None and self.pairing.token is not None:
+            pairing = self.pairing
+        else:
+            pairing = pairings.create()
+
+        self.send_json(200, {'status': 'success', 'token': pairing.token}, headers={
+            'Set-Cookie': f'{PAIRING_COOKIE}={pairing.token}; Path=/; HttpOnly; SameSite=Lax'
+        })
+
+    def upload_session(self, session_id):
+        """The chunked upload under session_id if it is one of this
+        request's pairing session, else None"""
+        session = upload_sessions.get(session_id)
+        if session is None or session.directory not in self.pairing.directories.values():
+            return None
+        return session
+
+    def handle_upload_init(self):
+        """POST /api/uploads {name, size, target, chunkSize?, sha256?}"""
+        data = self.read_json_body()
+        if data is None:
+            self.send_json(400, {'status': 'error', 'message': 'Invalid JSON body'})
+            return
+
+        file_name = safe_file_name(str(data.get('name', '')))
+        size = data.get('size')
+        directory = self.pairing.directories.get(data.get('target', 'received'))
+        if file_name is None or directory is None or not isinstance(size, int) or size < 0:
+            self.send_json(400, {
+                'status': 'error',
+                'message': 'name, size and a target of "received" or "shared" are required'
+            })
+            return
+
+        chunk_size = data.get('chunkSize', DEFAULT_UPLOAD_SESSION_CHUNK_SIZE)
+        if not isinstance(chunk_size, int):
+            chunk_size = DEFAULT_UPLOAD_SESSION_CHUNK_SIZE
+        chunk_size = min(max(chunk_size, MIN_UPLOAD_SESSION_CHUNK_SIZE), MAX_UPLOAD_SESSION_CHUNK_SIZE)
+
+        sha256 = data.get('sha256')
+        if sha256 is not None and not is_sha256(sha256):
+            self.send_json(400, {'status': 'error', 'message': 'sha256 must be a hex digest'})
+            return
+
+        try:
+            session = upload_sessions.create(directory, file_name, size, chunk_size, sha256)
+        except StorageFull as e:
+            logger.warning(f"Refused upload of {file_name}: {e}")
+            self.send_json(507, {'status': 'error', 'message': str(e)})
+            return
+        except OSError as e:
+            logger.error(f"Error starting upload of {file_name}: {e}")
+            self.send_json(500, {'status': 'error', 'message': f'Failed to start upload of {file_name}'})
+            return
+
+        logger.info(f"Upload started: {file_name} ({size} bytes in {session.chunk_count} chunks)")
+        self.send_json(201, session.status())
+
+    def handle_upload_chunk(self, session_id, index):
+        """Write one chunk, which may arrive in any order and more than once"""
+        session = self.upload_session(session_id)
+        content_length = self.headers.get('Content-Length')
+        if session is None or not index.isdigit() or int(index) >= session.chunk_count:
+            self.close_connection = True
+            self.send_json(404, {'status': 'error', 'message': 'Unknown upload or chunk'})
+            return
+
+        encoding = self.accept_content_encoding()
+        if encoding is None:
+            return
+        index = int(index)
+        expected = session.chunk_length(index)
+        # A gzip body only has to be no larger than the chunk it inflates to
+        if content_length is None or not content_length.isdigit() or \
+                not (int(content_length) == expected or
+                     encoding == 'gzip' and 0 < int(content_length) <= expected):
+            self.close_connection = True
+            self.send_json(400, {
+                'status': 'error',
+                'message': f'Chunk {index} must be exactly {expected} bytes'
+            })
+            return
+
+        if not self.admit_upload(expected):
+            return
+        # One transfer for the whole session, shared by its parallel chunks
+        # and picked up again when an upload is resumed
+        transfer = self.pairing.transfers.start('upload', session.directory, session.name, session.size,
+                                                self.client_address[0], transfer_id=session.id,
+                                                transferred=session.received_bytes())
+        try:
+            with metrics.transfer('upload'):
+                pieces = read_body_chunks(self.rfile, int(content_length))
+                if encoding == 'gzip':
+                    pieces = gunzip_chunks(pieces)
+                session.write_chunk(index, pieces, transfer.advance)
+        except (InvalidEncoding, ChunkLengthMismatch) as e:
+            # The same body would fail again, so not a 5xx the client retries
+            logger.warning(f"Rejected chunk {index} of {session.name}: {e}")
+            self.close_connection = True
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error writing chunk {index} of {session.name}: {e}")
+            self.close_connection = True
+            self.send_json(500, {'status': 'error', 'message': f'Failed to write chunk {index}'})
+            return
+        finally:
+            upload_limiter.release(self.client_address[0], expected)
+
+        self.send_json(200, {'status': 'success', 'chunk': index,
+                             'remaining': len(session.missing_chunks())})
+
+    def handle_upload_complete(self, session_id):
+        """Verify a chunked upload and atomically move it into place"""
+        session = self.upload_session(session_id)
+        if session is None:
+            self.send_json(404, {'status': 'error', 'message': 'Unknown upload'})
+            return
+
+        missing = session.missing_chunks()
+        if missing:
+            self.send_json(409, {'status': 'error', 'message': 'Upload incomplete', 'missing': missing})
+            return
+
+        if upload_sessions.remove(session_id) is None:
+            # A concurrent complete request got there first
+            self.send_json(409, {'status': 'error', 'message': 'Upload already completed'})
+            return
+
+        session.close()
+        try:
+            digest = session.part.digest()
+            if session.sha256 and digest != session.sha256.lower():
+                self.pairing.transfers.finish(session.id, 'failed')
+                session.discard()
+                self.send_json(422, {'status': 'error', 'message': 'Checksum mismatch, upload discarded'})
+                return
+            deduplicated = storage.commit(session.part, digest, session.directory, session.name)
+        except OSError as e:
+            logger.error(f"Error completing upload of {session.name}: {e}")
+            self.pairing.transfers.finish(session.id, 'failed')
+            session.discard()
+            self.send_json(500, {'status': 'error', 'message': f'Failed to save {session.name}'})
+            return
+        self.pairing.transfers.finish(session.id)
+        session.discard()
+
+        action = file_area(session.directory)
+        logger.info(f"File {action}: {session.name} ({session.size} bytes)")
+        self.pairing.files.add(session.directory, session.name)
+        self.send_json(200, {
+            'status': 'success',
+            'message': f'File {session.name} {action} successfully',
+            'name': session.name,
+            'size': session.size,
+            'deduplicated': deduplicated
+        })
+
+    def handle_blob_link(self, digest):
+        """POST /api/blobs/<sha256>/link {name, target}: save a file whose
+        bytes the server already has, without sending them again"""
+        data = self.read_json_body()
+        if data is None:
+            self.send_json(400, {'status': 'error', 'message': 'Invalid JSON body'})
+            return
+
+        file_name = safe_file_name(str(data.get('name', '')))
+        directory = self.pairing.directories.get(data.get('target', 'received'))
+        if file_name is None or directory is None:
+            self.send_json(400, {
+                'status': 'error',
+                'message': 'name and a target of "received" or "shared" are required'
+            })
+            return
+
+        try:
+            size = storage.link(digest, directory, file_name)
+        except OSError as e:
+            logger.error(f"Error linking {file_name}: {e}")
+            self.send_json(500, {'status': 'error', 'message': f'Failed to save {file_name}'})
+            return
+        if size is None:
+            self.send_json(404, {'status': 'error', 'message': 'Unknown content, upload the file'})
+            return
+
+        action = file_area(directory)
+        logger.info(f"File {action} without upload: {file_name} ({size} bytes)")
+        self.pairing.files.add(directory, file_name)
+        self.send_json(200, {
+            'status': 'success',
+            'message': f'File {file_name} {action} successfully',
+            'name': file_name,
+            'size': size,
+            'deduplicated': True
+        })
+
+    def stream_events(self):
+        """Push events to the client as text/event-stream until it goes away.
+
+        Each open stream holds a worker thread, so at most half the pool may
+        be streaming; beyond that (and in single mode, where a stream would
+        block every other request) the client gets a 503 and polls instead."""
+        limit = getattr(self.server, 'max_workers', 0) // 2
+        subscriber = pairings.subscribe(self.pairing, limit)
+        if subscriber is None:
+            self.close_connection = True
+            self.send_json(503, {
+                'status': 'error',
+                'message': 'Event stream not available, poll instead'
+            })
+            return
+
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+
+            while True:
+                try:
+                    event, payload = subscriber.get(timeout=EVENT_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    if subscriber not in self.pairing.events.subscribers:
+                        # Dropped for falling behind; let the browser reconnect
+                        return
+                    # Comment line; also how we notice the client has gone
+                    self.wfile.write(b': keep-alive\n\n')
+                    continue
+                self.wfile.write(f'event: {event}\ndata: {payload}\n\n'.encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.pairing.events.unsubscribe(subscriber)
+
+    def send_messages(self, query):
+        """Answer /api/messages.
+
+        Without parameters this is the full message list. With ?since=<cursor>
+        the reply is {"messages", "cursor", "reset"} holding only messages
+        newer than the cursor. The ETag is the store cursor, so a poll that
+        sends If-None-Match gets an empty 304 until something changes; it
+        names the pairing session too, as their cursors overlap.
+
+        With ?limit=<n> and/or ?before=<id> it is {"messages", "more"}: the
+        latest n (MESSAGE_PAGE_SIZE) messages with ids below before, oldest
+        first, from the history too if there is one. Messages longer than
+        MESSAGE_PREVIEW_LENGTH are cut short in all of these, see
+        message_preview()."""
+        try:
+            since = query_int(query, 'since')
+            limit = query_int(query, 'limit', MESSAGE_PAGE_SIZE, 1, MAX_MESSAGE_PAGE_SIZE)
+            before = query_int(query, 'before', None, 1)
+        except ValueError as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+
+        if 'limit' in query or 'before' in query:
+            messages, more = message_page(self.pairing, before, limit)
+            self.send_json(200, {'messages': [message_preview(message) for message in messages],
+                                 'more': more})
+            return
+
+        tag = f'm{self.pairing.token}-' if self.pairing.token is not None else 'm'
+        etag = f'"{tag}{self.pairing.messages.cursor()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+
+        messages, cursor, reset = self.pairing.messages.changes_since(since)
+        messages = [message_preview(message) for message in messages]
+        if since is None:
+            data = messages
+        else:
+            data = {'messages': messages, 'cursor': cursor, 'reset': reset}
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{tag}{cursor}"')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_message_search(self, query):
+        """Answer /api/messages/search?q=<words>[&limit=<n>][&before=<id>]
+        with {"messages", "more"}: messages containing every word anywhere,
+        ignoring case, newest first, whether they are found in the message
+        store or the history; previews of long messages show the text
+        around the first word found."""
+        terms = query.get('q', [''])[0].lower().split()
+        if not terms:
+            self.send_json(400, {'status': 'error', 'message': 'q must have a word to search for'})
+            return
+        try:
+            limit = query_int(query, 'limit', MESSAGE_PAGE_SIZE, 1, MAX_MESSAGE_PAGE_SIZE)
+            before = query_int(query, 'before', None, 1)
+        except ValueError as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+        try:
+            messages, more = search_messages(self.pairing, terms, before, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error searching messages: {e}")
+            self.send_json(500, {'status': 'error', 'message': 'Search failed'})
+            return
+        self.send_json(200, {'messages': [message_preview(message, terms) for message in messages],
+                             'more': more})
+
+    def serve_file(self, directory, filename, head_only=False):
+        """Send directory/filename with Range and conditional request support.
+
+        The body is sent in DOWNLOAD_CHUNK_SIZE pieces (smaller under a
+        rate limit, see BandwidthScheduler) without passing through Python
+        memory: from disk with socket.sendfile(), from
+        memory storage as slices of the stored bytes. A single byte range
+        is answered with 206 Partial Content to let interrupted downloads
+        resume and media players seek."""
+        if safe_file_name(filename) != filename or filename.startswith('.'):
+            self.send_error(404, 'File not found')
+            return
+
+        # Open before sending headers so a concurrent expiry or upload
+        # can't change the file between the size check and the read
+        try:
+            content = storage.open(directory, filename)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return
+
+        with content:
+            file_info = content.info
+            file_size = file_info.size
+            etag = f'"{file_info.inode[1]:x}-{file_info.mtime_ns:x}-{file_size:x}"'
+            last_modified = email.utils.formatdate(file_info.mtime, usegmt=True)
+
+            if self.is_not_modified(etag, file_info.mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+
+            byte_range = None
+            range_header = self.headers.get('Range')
+            if range_header and self.if_range_matches(etag, file_info.mtime):
+                byte_range = parse_byte_range(range_header, file_size)
+                if byte_range == 'unsatisfiable':
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{file_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+            else:
+                start, end = 0, file_size - 1
+                self.send_response(200)
+            length = end - start + 1
+
+            # Determine content type based on file extension
+            extension = os.path.splitext(filename)[1].lower()
+            self.send_header('Content-Type', self.get_content_type(extension))
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            # Use quotes for filename and handle special characters
+            safe_filename = filename.replace('"', '\\"')
+            self.send_header('Content-Disposition', f'attachment; filename="{safe_filename}"')
+            self.end_headers()
+
+            if head_only or length <= 0:
+                return
+
+            offset = start
+            try:
+                with self.pairing.transfers.track('download', directory, filename, length,
+                                                  self.client_address[0]) as transfer:
+                    piece_size = bandwidth.piece_size(DOWNLOAD_CHUNK_SIZE)
+                    while offset <= end:
+                        sent = content.send(self.wfile, offset, min(piece_size, end - offset + 1))
+                        if sent == 0:
+                            break
+                        offset += sent
+                        transfer.advance(sent)
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away mid-download; it can resume with a Range request
+                self.close_connection = True
+
+    def serve_static(self, asset, head_only=False):
+        """Send a cached static file in the best encoding the client accepts"""
+        encoding = asset.choose_encoding(self.headers.get('Accept-Encoding'))
+        etag = asset.etag(encoding)
+        not_modified = self.is_not_modified(etag, asset.mtime)
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', asset.cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        if not_modified:
+            self.end_headers()
+            return
+
+        body = asset.variants[encoding]
+        self.send_header('Content-Type', asset.content_type)
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def is_not_modified(self, etag, mtime):
+        """Check If-None-Match / If-Modified-Since against the current file"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            candidates = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def if_range_matches(self, etag, mtime):
+        """A Range request only applies if If-Range (when present) still matches"""
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == etag
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(if_range).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+
+    def handle_stream_upload(self, directory, query):
+        """Save a raw application/octet-stream body as a file in directory.
+
+        The file name comes from the X-File-Name header (URL-encoded) or the
+        ?name= query parameter. An optional ?sha256= is checked against the
+        received bytes before the file is kept. A body sent with
+        Content-Encoding: gzip is decompressed on its way to disk."""
+        file_name = self.headers.get('X-File-Name')
+        if file_name is not None:
+            file_name = unquote(file_name)
+        else:
+            file_name = query.get('name', [''])[0]
+        file_name = safe_file_name(file_name)
+
+        content_length = self.headers.get('Content-Length')
+        if file_name is None or content_length is None or not content_length.isdigit():
+            # The body was not consumed, so the connection can't be reused
+            self.close_connection = True
+            status = 400 if content_length is not None else 411
+            self.send_json(status, {
+                'status': 'error',
+                'message': 'A file name and a Content-Length are required'
+            })
+            return
+
+        sha256 = query.get('sha256', [None])[0]
+        if sha256 is not None and not is_sha256(sha256):
+            self.close_connection = True
+            self.send_json(400, {'status': 'error', 'message': 'sha256 must be a hex digest'})
+            return
+
+        encoding = self.accept_content_encoding()
+        if encoding is None:
+            return
+        if not self.admit_upload(int(content_length)):
+            return
+        try:
+            # Progress is counted in bytes on the wire, as is the size
+            with self.pairing.transfers.track('upload', directory, file_name, int(content_length),
+                                              self.client_address[0]) as transfer:
+                chunks = transfer.counted(read_body_chunks(self.rfile, int(content_length)))
+                if encoding == 'gzip':
+                    chunks = gunzip_chunks(chunks)
+                size = save_upload_chunks(chunks, directory, file_name, sha256,
+                                          int(content_length) if encoding == 'identity' else None)
+        except ChecksumMismatch as e:
+            logger.warning(f"Discarded streamed upload: {e}")
+            self.send_json(422, {'status': 'error', 'message': 'Checksum mismatch, upload discarded'})
+            return
+        except InvalidEncoding as e:
+            logger.warning(f"Discarded streamed upload: {e}")
+            self.close_connection = True
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+        except StorageFull as e:
+            logger.warning(f"Discarded streamed upload: {e}")
+            self.close_connection = True
+            self.send_json(507, {'status': 'error', 'message': str(e)})
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error processing streamed upload: {e}")
+            self.close_connection = True
+            self.send_json(500, {
+                'status': 'error',
+                'message': f'Failed to save {file_name}'
+            })
+            return
+        finally:
+            upload_limiter.release(self.client_address[0], int(content_length))
+
+        action = file_area(directory)
+        logger.info(f"File {action}: {file_name} ({size} bytes)")
+        self.pairing.files.add(directory, file_name)
+        self.send_json(200, {
+            'status': 'success',
+            'message': f'File {file_name} {action} successfully',
+            'name': file_name,
+            'size': size
+        })
+
+    def handle_batch_upload(self, directory):
+        """Save every file in a multipart/form-data body to directory.
+
+        Parts are parsed and written one after another as the body streams
+        in, so neither the request nor any single file is held in memory.
+        The whole body may be sent with Content-Encoding: gzip. Form fields
+        without a filename are ignored."""
+        content_length = self.headers.get('Content-Length')
+        boundary = None
+        if self.headers.get_content_type() == 'multipart/form-data':
+            boundary = self.headers.get_param('boundary')
+        if content_length is None or not content_length.isdigit() or not boundary:
+            self.close_connection = True
+            status = 400 if content_length is not None else 411
+            self.send_json(status, {
+                'status': 'error',
+                'message': 'A multipart/form-data body with a Content-Length is required'
+            })
+            return
+
+        encoding = self.accept_content_encoding()
+        if encoding is None:
+            return
+        content_length = int(content_length)
+        if not self.admit_upload(content_length):
+            return
+        files = []
+        try:
+            with self.pairing.transfers.track('upload', directory, None, content_length,
+                                              self.client_address[0]) as transfer:
+                chunks = transfer.counted(read_body_chunks(self.rfile, content_length))
+                if encoding == 'gzip':
+                    chunks = gunzip_chunks(chunks)
+                reader = MultipartReader(chunks, boundary.encode('latin-1'))
+                while True:
+                    headers = reader.next_part()
+                    if headers is None:
+                        break
+                    file_name = safe_file_name(reader.file_name(headers) or '')
+                    if file_name is None:
+                        continue
+                    # Reported under the name of the file being received
+                    transfer.name = file_name
+                    size = save_upload_chunks(reader.part_chunks(), directory, file_name)
+                    self.pairing.files.add(directory, file_name)
+                    files.append({'name': file_name, 'size': size})
+        except InvalidEncoding as e:
+            logger.warning(f"Rejected batch upload: {e}")
+            self.close_connection = True
+            self.send_json(400, {'status': 'error', 'message': str(e), 'files': files})
+            return
+        except StorageFull as e:
+            logger.warning(f"Rejected batch upload: {e}")
+            self.close_connection = True
+            self.send_json(507, {'status': 'error', 'message': str(e), 'files': files})
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error processing batch upload: {e}")
+            self.close_connection = True
+            # Report the files saved before the error so only the rest are resent
+            self.send_json(500, {
+                'status': 'error',
+                'message': f'Failed after {len(files)} files',
+                'files': files
+            })
+            return
+        finally:
+            upload_limiter.release(self.client_address[0], content_length)
+
+        action = file_area(directory)
+        logger.info(f"Files {action}: {len(files)} in one batch ({content_length} bytes)")
+        self.send_json(200, {
+            'status': 'success',
+            'message': f'{len(files)} files {action} successfully',
+            'files': files
+        })
+
+    def send_archive(self, directory, names):
+        """Stream a ZIP of the named files in directory (all when names is
+        empty), built on the fly while it is sent.
+
+        Files are read in DOWNLOAD_CHUNK_SIZE pieces and written straight to
+        the socket with chunked transfer encoding, so the archive exists
+        neither on disk nor in memory. Types in COMPRESSED_EXTENSIONS are
+        stored, the rest deflated at ARCHIVE_COMPRESS_LEVEL."""
+        available = self.pairing.files.names(directory)
+        if names:
+            selected = set(names)
+            available = [name for name in available if name in selected]
+        if not available:
+            self.send_json(404, {'status': 'error', 'message': 'No files to download'})
+            return
+
+        area = file_area(directory)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        archive_name = f'snap-send-{area}-{stamp}.zip'
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{archive_name}"')
+        self.send_header('Cache-Control', 'no-store')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # Without a length the end of the body is the end of the connection
+            self.close_connection = True
+        self.end_headers()
+
+        count = 0
+        try:
+            with self.pairing.transfers.track('download', directory, archive_name, None,
+                                              self.client_address[0]) as transfer:
+                piece_size = bandwidth.piece_size(DOWNLOAD_CHUNK_SIZE)
+                writer = ChunkedWriter(self.wfile, chunked, transfer.advance, piece_size)
+                with zipfile.ZipFile(writer, 'w') as archive:
+                    for name in available:
+                        try:
+                            content = storage.open(directory, name)
+                        except OSError:
+                            # Expired or replaced since the listing
+                            continue
+                        with content:
+                            info = zipfile.ZipInfo(name, time.localtime(content.info.mtime)[:6])
+                            info.external_attr = 0o644 << 16
+                            # Known up front so ZIP64 records are used when needed
+                            info.file_size = content.info.size
+                            if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+                                info.compress_type = zipfile.ZIP_STORED
+                            else:
+                                info.compress_type = zipfile.ZIP_DEFLATED
+                                # ZipFile.open() has no level argument of its own
+                                info._compresslevel = ARCHIVE_COMPRESS_LEVEL
+                            with archive.open(info, 'w') as entry:
+                                for piece in content.chunks(piece_size):
+                                    entry.write(piece)
+                        count += 1
+                writer.close()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return
+        except Exception as e:
+            # The status line is gone; a cut-off body tells the client it failed
+            logger.error(f"Error creating archive: {e}")
+            self.close_connection = True
+            return
+        logger.info(f"Sent archive of {count} files from {directory}")
+
+    def send_thumbnail(self, directory, name):
+        """Send the thumbnail of an image file, waiting up to THUMBNAIL_WAIT
+        seconds if it is still being generated"""
+        entry = self.pairing.files.get(directory, name)
+        future = thumbnails.request(directory, entry) if entry is not None else None
+        if future is None:
+            self.send_json(404, {'status': 'error', 'message': 'No thumbnail for this file'})
+            return
+        try:
+            thumbnail_path = future.result(timeout=THUMBNAIL_WAIT)
+        except concurrent.futures.TimeoutError:
+            self.send_json(503, {'status': 'error', 'message': 'Thumbnail not ready, retry shortly'},
+                           headers={'Retry-After': '1'})
+            return
+
+        if thumbnail_path is None:
+            self.send_json(404, {'status': 'error', 'message': 'Not an image that can be previewed'})
+            return
+        etag = f'"{thumbnails.key(entry)}"'
+        if self.is_not_modified(etag, entry['mtime']):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            with open(thumbnail_path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            # Evicted in the meantime
+            self.send_json(404, {'status': 'error', 'message': 'No thumbnail for this file'})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        # The URL in the listings changes along with the file
+        self.send_header('Cache-Control', 'private, max-age=86400')
+        self.end_headers()
+        self.wfile.write(body)
 
-# Initialize messages file if it doesn't exist
+    def accept_content_encoding(self, encodings=('identity', 'gzip')):
+        """The request body's Content-Encoding, one of encodings.
 
+        Anything else is answered with 415 and the accepted encodings, and
+        None is returned."""
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding in encodings:
+            return encoding
+        # The body was not consumed, so the connection can't be reused
+        self.close_connection = True
+        self.send_json(415, {'status': 'error', 'message': f'Unsupported Content-Encoding: {encoding}'},
+                       headers={'Accept-Encoding': ', '.join(encodings)})
+        return None
 
-def init_messages_file():
-    if not os.path.exists(MESSAGES_FILE):
-        with open(MESSAGES_FILE, 'w') as f:
-            json.dump({"messages": []}, f)
-    else:
-        # Verify the file has the correct structure
-        try:
-            with open(MESSAGES_FILE, 'r') as f:
-                data = json.load(f)
-                if "messages" not in data:
-                    # Reset file if structure is invalid
-                    with open(MESSAGES_FILE, 'w') as f:
-                        json.dump({"messages": []}, f)
-        except Exception as e:
-            print(f"Error reading messages file, resetting: {e}")
-            with open(MESSAGES_FILE, 'w') as f:
-                json.dump({"messages": []}, f)
+    def admit_upload(self, size):
+        """Reserve upload capacity for a body of size bytes.
 
-# Add a new message
+        On refusal the rejection is sent, with Retry-After so the client
+        backs off and tries again, and False is returned."""
+        status = upload_limiter.acquire(self.client_address[0], size)
+        if status is None:
+            return True
 
+        # The body was not consumed, so the connection can't be reused
+        self.close_connection = True
+        body = json.dumps({
+            'status': 'error',
+            'message': 'Server busy, retry shortly' if status == 503 else 'Too many uploads in flight'
+        }).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+        self.drain_rejected_body(size)
+        return False
 
-def add_message(sender, content):
-    try:
-        # Read existing messages
-        with open(MESSAGES_FILE, 'r') as f:
-            data = json.load(f)
+    def drain_rejected_body(self, size):
+        """Discard up to size bytes of an unread request body.
 
-        # Add new message with timestamp
-        message = {
-            "sender": sender,
-            "content": content,
-            "timestamp": time.time(),
-            "time": datetime.datetime.now().strftime("%H:%M:%S")
+        Closing a socket with unread data in it makes the kernel send a
+        reset, and most clients report that as a network error before they
+        read our response. Half-closing and reading the rest for a bounded
+        time lets the rejection arrive intact."""
+        deadline = time.monotonic() + REJECTED_BODY_DRAIN_TIMEOUT
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+            while size > 0:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    break
+                self.connection.settimeout(remaining_time)
+                data = self.rfile.read1(min(size, UPLOAD_CHUNK_SIZE))
+                if not data:
+                    break
+                size -= len(data)
+        except OSError:
+            pass
+
+    def send_metrics(self, query):
+        """Send the metrics as JSON, or in the Prometheus text format when
+        asked for with ?format=prometheus or an Accept header without JSON"""
+        accept = self.headers.get('Accept', '')
+        fmt = query.get('format', [None])[0]
+        if fmt == 'prometheus' or (fmt is None and 'text/plain' in accept and 'json' not in accept):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(200, metrics.snapshot())
+
+    def send_json(self, status, data, headers=None):
+        """Send data as a JSON response with the given status code"""
+        self.send_json_bytes(status, json.dumps(data).encode('utf-8'), headers)
+
+    def send_json_bytes(self, status, body, headers=None):
+        """Send an already serialized JSON body, plus any extra headers"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_content_type(self, extension):
+        """Determine content type based on file extension"""
+        content_types = {
+            '.html': 'text/html',
+            '.css': 'text/css',
+            '.js': 'application/javascript',
+            '.json': 'application/json',
+            '.png': 'image/png',
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.gif': 'image/gif',
+            '.pdf': 'application/pdf',
+            '.txt': 'text/plain',
+            '.mp3': 'audio/mpeg',
+            '.mp4': 'video/mp4',
+            '.zip': 'application/zip'
         }
-        data["messages"].append(message)
+        return content_types.get(extension, 'application/octet-stream')
 
-        # Keep only the last 100 messages
-        if len(data["messages"]) > 100:
-            data["messages"] = data["messages"][-100:]
 
-        # Write updated messages
-        with open(MESSAGES_FILE, 'w') as f:
-            json.dump(data, f)
+class WorkerPoolHTTPServer(http.server.HTTPServer):
+    """HTTP server that handles each connection on a fixed-size thread pool.
 
-        return True
-    except Exception as e:
-        print(f"Error adding message: {e}")
-        return False
+    Unlike socketserver.ThreadingMixIn, which starts an unbounded thread per
+    connection, the pool caps how many requests run at once; connections
+    beyond that wait in the queue instead of being refused. Workers are
+    daemon threads so Ctrl+C doesn't wait for running downloads.
 
-# Get all messages
+    Workers only run while a connection has a request to serve. New and
+    idle keep-alive connections are parked: a watcher thread waits for
+    any of them to become readable with a selector and queues it for the
+    pool then, and closes those idle for KEEP_ALIVE_TIMEOUT or beyond
+    MAX_IDLE_CONNECTIONS. Polling clients can so keep their connection
+    without tying up a thread between polls."""
 
+    request_queue_size = LISTEN_BACKLOG
 
-def get_messages():
-    try:
-        with open(MESSAGES_FILE, 'r') as f:
-            data = json.load(f)
-        return data["messages"]
-    except Exception as e:
-        print(f"Error getting messages: {e}")
-        return []
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_WORKER_THREADS,
+                 reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self.max_workers = max_workers
+        self.requests = queue.Queue()
 
-# Clear all messages
+        # Parked connections: socket -> (handler or None, client_address, parked_at)
+        self.idle = {}
+        self.parking = []
+        self.parking_lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.closing = False
+        threading.Thread(target=self.watch_idle_connections, name='snap-send-keep-alive',
+                         daemon=True).start()
 
+        self.workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self.process_request_worker,
+                                      name=f'snap-send-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
 
-def clear_messages():
-    try:
-        with open(MESSAGES_FILE, 'w') as f:
-            json.dump({"messages": []}, f)
-        return True
-    except Exception as e:
-        print(f"Error clearing messages: {e}")
-        return False
+    def process_request(self, request, client_address):
+        # A new connection waits for its first request like an idle one
+        self.park_connection(request, client_address, None)
 
-# Get local IP address
+    def park_connection(self, request, client_address, handler):
+        with self.parking_lock:
+            self.parking.append((request, client_address, handler))
+        self.wakeup_writer.send(b'\0')
 
+    def close_parked(self, request):
+        handler, _, _ = self.idle.pop(request)
+        self.selector.unregister(request)
+        if handler is not None:
+            handler.parked = False
+            handler.finish()
+        self.shutdown_request(request)
 
-def get_local_ip():
-    # Try multiple methods to get IP
-    try:
-        # Preferred method: Create UDP connection and get local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
+    def watch_idle_connections(self):
+        last_sweep = time.monotonic()
+        while not self.closing:
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj is self.wakeup_reader:
+                    try:
+                        self.wakeup_reader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                request = key.fileobj
+                handler, client_address, _ = self.idle.pop(request)
+                self.selector.unregister(request)
+                self.requests.put((request, client_address, handler))
 
-        # Confirm if it's a local network IP
-        if ip.startswith(('192.168.', '10.', '172.16.', '172.17.', '172.18.')):
-            return ip
-    except Exception as e:
-        print(f"Primary IP detection method failed: {e}")
+            with self.parking_lock:
+                parking, self.parking = self.parking, []
+            now = time.monotonic()
+            for request, client_address, handler in parking:
+                self.idle[request] = (handler, client_address, now)
+                self.selector.register(request, selectors.EVENT_READ)
 
-    # Alternative method: Try to get all network interfaces
-    try:
-        interfaces = socket.gethostbyname_ex(socket.gethostname())[-1]
-        for ip in interfaces:
-            if ip.startswith(('192.168.', '10.', '172.16.', '172.17.', '172.18.')):
-                return ip
-    except Exception as e:
-        print(f"Alternative IP detection method failed: {e}")
+            # Oldest parked first, as dicts keep insertion order
+            while len(self.idle) > MAX_IDLE_CONNECTIONS:
+                self.close_parked(next(iter(self.idle)))
+            if now - last_sweep >= 1:
+                last_sweep = now
+                for request, (_, _, parked_at) in list(self.idle.items()):
+                    if now - parked_at > KEEP_ALIVE_TIMEOUT:
+                        self.close_parked(request)
 
-    # All methods failed, return local loopback
-    return "127.0.0.1"
+        for request in list(self.idle):
+            self.close_parked(request)
 
-# Custom HTTP request handler
+    def process_request_worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address, handler = item
+            try:
+                if handler is None:
+                    handler = self.RequestHandlerClass(request, client_address, self)
+                else:
+                    handler.resume()
+            except Exception:
+                self.handle_error(request, client_address)
+            if handler is not None and handler.parked:
+                self.park_connection(request, client_address, handler)
+            else:
+                self.shutdown_request(request)
 
+    def handle_error(self, request, client_address):
+        logger.exception(f"Error handling request from {client_address[0]}")
 
-class CustomHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        # Parse URL path
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
+    def server_bind(self):
+        # HTTPServer.server_bind also looks up the host's fully qualified
+        # name, which can wait seconds on DNS, for server_name nothing uses
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address[:2]
 
-        # Print the requested path
-        print(f"GET request for: {path}")
+    def server_close(self):
+        super().server_close()
+        self.closing = True
+        self.wakeup_writer.send(b'\0')
+        for _ in self.workers:
+            self.requests.put(None)
 
-        # API endpoint to get messages
-        if path == '/api/messages':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
 
-            # Get all messages
-            messages = get_messages()
+class SingleHTTPServer(socketserver.TCPServer):
+    """HTTP server handling one request at a time, as in earlier versions"""
 
-            # Send messages as JSON
-            self.wfile.write(json.dumps(messages).encode('utf-8'))
-            return
+    allow_reuse_address = True
+    request_queue_size = LISTEN_BACKLOG
 
-        # API endpoint to clear all messages
-        elif path == '/api/clear-messages':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
 
-            # Clear all messages
-            if clear_messages():
-                self.wfile.write(json.dumps({
-                    'status': 'success',
-                    'message': 'All messages cleared'
-                }).encode('utf-8'))
-            else:
-                self.wfile.write(json.dumps({
-                    'status': 'error',
-                    'message': 'Failed to clear messages'
-                }).encode('utf-8'))
-            return
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
-        # API endpoint to get received files list (from mobile to desktop)
-        if path == '/api/files':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
 
-            # Get list of files in received_files directory
-            files = []
-            current_time = time.time()
+def bind_port(bind, port):
+    """Return bind(port); without a port, bind(DEFAULT_PORT) or, if that
+    is taken, bind(0) so the system picks a free one"""
+    if port is not None:
+        return bind(port)
+    try:
+        return bind(DEFAULT_PORT)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        logger.info(f"Port {DEFAULT_PORT} is in use, using a free port instead")
+        return bind(0)
 
-            if os.path.exists('received_files'):
-                for filename in os.listdir('received_files'):
-                    file_path = os.path.join('received_files', filename)
-                    if os.path.isfile(file_path):
-                        file_stats = os.stat(file_path)
-                        file_size = file_stats.st_size
-                        created_time = file_stats.st_mtime
-
-                        # Calculate remaining time (seconds)
-                        time_left = max(0, int(created_time + FILE_EXPIRY_TIME - current_time))
-
-                        # Only include unexpired files
-                        if time_left > 0:
-                            # Format the timestamp as a readable date
-                            created_date = datetime.datetime.fromtimestamp(
-                                created_time).strftime('%Y-%m-%d %H:%M:%S')
-
-                            files.append({
-                                'name': filename,
-                                'size': file_size,
-                                'path': f'/received_files/{filename}',
-                                'created': created_date,
-                                'timestamp': created_time,
-                                'expiresIn': time_left  # Remaining seconds
-                            })
-                        else:
-                            # File has expired, delete it
-                            try:
-                                os.remove(file_path)
-                                print(f"Deleted expired file: {file_path}")
-                            except Exception as e:
-                                print(f"Error deleting file: {e}")
-
-            # Sort by timestamp, newest first
-            files.sort(key=lambda x: x['timestamp'], reverse=True)
-
-            # Send file list as JSON
-            self.wfile.write(json.dumps(files).encode('utf-8'))
-            return
 
-        # API endpoint to get shared files list (from desktop to mobile)
-        elif path == '/api/shared-files':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
+def create_server(port, handler, mode='threaded', threads=DEFAULT_WORKER_THREADS, reuse_port=False):
+    """Create and bind the HTTP server for the selected serving mode.
 
-            # Get list of files in shared_files directory
-            files = []
-            current_time = time.time()
+    Without a port, DEFAULT_PORT is tried and, if it is taken, the system
+    picks a free one; the port bound is in httpd.server_address. With
+    reuse_port, the --workers processes listen on the same port."""
+    def bind(port):
+        if mode == 'single':
+            return SingleHTTPServer(("", port), handler, reuse_port=reuse_port)
+        return WorkerPoolHTTPServer(("", port), handler, max_workers=threads, reuse_port=reuse_port)
 
-            if os.path.exists('shared_files'):
-                for filename in os.listdir('shared_files'):
-                    file_path = os.path.join('shared_files', filename)
-                    if os.path.isfile(file_path):
-                        file_stats = os.stat(file_path)
-                        file_size = file_stats.st_size
-                        created_time = file_stats.st_mtime
-
-                        # Calculate remaining time (seconds)
-                        time_left = max(0, int(created_time + FILE_EXPIRY_TIME - current_time))
-
-                        # Only include unexpired files
-                        if time_left > 0:
-                            # Format the timestamp as a readable date
-                            created_date = datetime.datetime.fromtimestamp(
-                                created_time).strftime('%Y-%m-%d %H:%M:%S')
-
-                            files.append({
-                                'name': filename,
-                                'size': file_size,
-                                'path': f'/shared_files/{filename}',
-                                'created': created_date,
-                                'timestamp': created_time,
-                                'expiresIn': time_left  # Remaining seconds
-                            })
-                        else:
-                            # File has expired, delete it
-                            try:
-                                os.remove(file_path)
-                                print(f"Deleted expired file: {file_path}")
-                            except Exception as e:
-                                print(f"Error deleting file: {e}")
-
-            # Sort by timestamp, newest first
-            files.sort(key=lambda x: x['timestamp'], reverse=True)
-
-            # Send file list as JSON
-            self.wfile.write(json.dumps(files).encode('utf-8'))
-            return
+    return bind_port(bind, port)
 
-        # Serve received files
-        elif path.startswith('/received_files/'):
-            encoded_filename = path.split('/')[-1]
-            filename = unquote(encoded_filename)  # Decode URL-encoded filename
-            file_path = os.path.join('received_files', filename)
 
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                # Determine content type based on file extension
-                extension = os.path.splitext(filename)[1].lower()
-                content_type = self.get_content_type(extension)
+def reserve_port(port):
+    """A socket bound to port with SO_REUSEPORT, not listening, that holds
+    it for the --workers processes while they come and go. Ports are
+    chosen as in create_server. The port is bound once without the option
+    first, so one another server listens on with it isn't shared."""
+    def bind(port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind(("", port))
+            port = probe.getsockname()[1]
+        reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reservation.bind(("", port))
+        return reservation
 
-                # Send the file
-                self.send_response(200)
-                self.send_header('Content-Type', content_type)
-                self.send_header('Content-Length', str(os.path.getsize(file_path)))
-                # Use quotes for filename and handle special characters
-                safe_filename = filename.replace('"', '\\"')
-                self.send_header('Content-Disposition', f'attachment; filename="{safe_filename}"')
-                self.end_headers()
+    return bind_port(bind, port)
 
-                # Read and send the file
-                with open(file_path, 'rb') as file:
-                    self.wfile.write(file.read())
-                return
-            else:
-                self.send_error(404, 'File not found')
-                return
+# Tell the user where to open the pages
 
-        # Serve shared files
-        elif path.startswith('/shared_files/'):
-            encoded_filename = path.split('/')[-1]
-            filename = unquote(encoded_filename)  # Decode URL-encoded filename
-            file_path = os.path.join('shared_files', filename)
 
-            print(f"Trying to access shared file: '{filename}' (from '{encoded_filename}')")
-            print(f"Full path: {file_path}")
+def print_addresses(port, addresses):
+    """Print the URLs to open the desktop and mobile pages at"""
+    print(f"Server running at http://{addresses[0]}:{port}/")
+    print(f"For mobile access, use http://{addresses[0]}:{port}/mobile.html")
+    for address in addresses[1:]:
+        print(f"Also reachable at http://{address}:{port}/")
 
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                # Determine content type based on file extension
-                extension = os.path.splitext(filename)[1].lower()
-                content_type = self.get_content_type(extension)
 
-                print(f"File found! Serving '{filename}' ({os.path.getsize(file_path)} bytes)")
+def open_browser(url):
+    # Imported here, off the startup path, as it is only needed for this
+    import webbrowser
+    webbrowser.open(url)
 
-                # Send the file
-                self.send_response(200)
-                self.send_header('Content-Type', content_type)
-                self.send_header('Content-Length', str(os.path.getsize(file_path)))
-                # Use quotes for filename and handle special characters
-                safe_filename = filename.replace('"', '\\"')
-                self.send_header('Content-Disposition', f'attachment; filename="{safe_filename}"')
-                self.end_headers()
 
-                # Read and send the file
-                with open(file_path, 'rb') as file:
-                    self.wfile.write(file.read())
-                return
-            else:
-                self.send_error(404, 'File not found')
-                return
+def find_addresses_slowly(port, open_url):
+    """Find the LAN address the slow way, for systems where the interfaces
+    can't be listed, and print it once found"""
+    ip = get_local_ip()
+    if ip != '127.0.0.1':
+        print_addresses(port, [ip])
+    if open_url:
+        open_browser(f"http://{ip}:{port}/")
 
-        # Serve index.html for the root path
-        elif path == '/':
-            self.path = '/desktop.html'
 
-        # Proceed with default handler
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+def show_addresses(port, open_url):
+    """Print the URLs and, if open_url, open the desktop page in a browser"""
+    addresses = interface_addresses()
+    if addresses:
+        print_addresses(port, addresses)
+        if open_url:
+            threading.Thread(target=open_browser, args=(f"http://{addresses[0]}:{port}/",),
+                             daemon=True).start()
+    else:
+        print(f"Server running at http://127.0.0.1:{port}/")
+        threading.Thread(target=find_addresses_slowly, args=(port, open_url),
+                         name='snap-send-address', daemon=True).start()
+    print("Press Ctrl+C to stop the server")
 
-    def do_POST(self):
-        """Handle POST requests for file uploads and messages"""
-        print(f"POST request for: {self.path}")
+# Log through queues so a slow terminal or disk never holds up a request
 
-        # Handle sending a message
-        if self.path == '/api/send-message':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
 
-            try:
-                # Parse JSON data
-                json_data = json.loads(post_data.decode('utf-8'))
+def setup_logging(level='info', access_log=None):
+    """Send server log records to stderr and, if access_log is given, one
+    JSON line per request to that file ('-' for stdout).
 
-                # Check if it's a valid message
-                if 'sender' in json_data and 'content' in json_data:
-                    sender = json_data['sender']
-                    content = json_data['content']
+    Handlers only put records on a queue; a QueueListener thread per
+    destination formats and writes them."""
+    # A worker process replaces the handlers it inherited, whose listener
+    # threads stayed behind in the supervisor
+    logger.handlers.clear()
+    access_logger.handlers.clear()
 
-                    # Validate message content
-                    if content.strip() == "":
-                        self.send_response(400)
-                        self.send_header('Content-Type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({
-                            'status': 'error',
-                            'message': 'Message content cannot be empty'
-                        }).encode('utf-8'))
-                        return
+    def attach(target_logger, handler):
+        log_queue = queue.SimpleQueue()
+        target_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        # Write out what is still queued on exit
+        atexit.register(listener.stop)
 
-                    # Add message
-                    if add_message(sender, content):
-                        self.send_response(200)
-                        self.send_header('Content-Type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({
-                            'status': 'success',
-                            'message': 'Message sent successfully'
-                        }).encode('utf-8'))
-                        return
-                    else:
-                        self.send_response(500)
-                        self.send_header('Content-Type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({
-                            'status': 'error',
-                            'message': 'Failed to send message'
-                        }).encode('utf-8'))
-                        return
-            except Exception as e:
-                print(f"Error processing message: {e}")
-                # If JSON parsing fails or any other error
-                pass
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logger.setLevel(level.upper())
+    attach(logger, console)
 
-        # Handle upload from mobile to desktop
-        elif self.path == '/upload':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
+    if access_log:
+        if access_log == '-':
+            destination = logging.StreamHandler(sys.stdout)
+        else:
+            destination = logging.FileHandler(access_log, encoding='utf-8')
+        destination.setFormatter(logging.Formatter('%(message)s'))
+        access_logger.setLevel(logging.INFO)
+        attach(access_logger, destination)
 
-            try:
-                # Try to parse JSON data
-                json_data = json.loads(post_data.decode('utf-8'))
+# Build the storage selected with --storage
 
-                # If it's a file upload
-                if 'fileName' in json_data and 'fileData' in json_data:
-                    file_name = json_data['fileName']
-                    file_data = json_data['fileData']
 
-                    # Create received_files directory if it doesn't exist
-                    if not os.path.exists('received_files'):
-                        os.makedirs('received_files')
+def create_storage(kind, spool_directory=DEFAULT_SPOOL_DIRECTORY, memory_mb=DEFAULT_MEMORY_STORAGE_MB):
+    if kind == 'memory':
+        logger.info(f"Keeping transferred files in memory only, up to {memory_mb} MB")
+        return MemoryStorage(memory_mb * 1024 * 1024)
+    if kind == 'spool':
+        logger.info(f"Keeping transferred files in {spool_directory}")
+        return DiskStorage(spool_directory)
+    return DiskStorage()
 
-                    # If fileData is a base64 string
-                    if isinstance(file_data, str):
-                        try:
-                            file_bytes = base64.b64decode(file_data)
-                        except Exception:
-                            file_bytes = file_data.encode('utf-8')
-                    elif isinstance(file_data, list):
-                        file_bytes = bytes(file_data)
-                    else:
-                        file_bytes = file_data
+# Apply the options shared by every serving process
 
-                    # Save the file
-                    file_path = os.path.join('received_files', file_name)
-                    with open(file_path, 'wb') as f:
-                        if isinstance(file_bytes, bytes):
-                            f.write(file_bytes)
-                        else:
-                            f.write(file_bytes.encode('utf-8'))
 
-                    print(f"File saved: {file_name} ({os.path.getsize(file_path)} bytes)")
+def configure(args):
+    global storage
+    upload_limiter.max_writers = args.max_upload_writers
+    upload_limiter.max_client_bytes = args.max_client_inflight * 1024 * 1024
+    bandwidth.configure(*(None if rate is None else rate * 1024 * 1024
+                          for rate in (args.max_rate, args.client_rate, args.transfer_rate)))
 
-                    # Send success response
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({
-                        'status': 'success',
-                        'message': f'File {file_name} received successfully'
-                    }).encode('utf-8'))
-                    return
-            except Exception as e:
-                print(f"Error processing upload: {e}")
-                # If JSON parsing fails or any other error
-                pass
+    # Keep the transfer files where --storage says, creating its directories
+    storage = create_storage(args.storage, args.spool_dir, args.memory_limit)
+    thumbnails.directory = storage.thumbnail_directory
+    storage.prepare()
 
-        # Handle upload from desktop to mobile
-        elif self.path == '/upload-to-mobile':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
+    if args.history_days is not None:
+        history.open(args.history_days * 24 * 60 * 60)
 
-            try:
-                # Try to parse JSON data
-                json_data = json.loads(post_data.decode('utf-8'))
+# Serve with several processes, for --workers
 
-                # If it's a file upload
-                if 'fileName' in json_data and 'fileData' in json_data:
-                    file_name = json_data['fileName']
-                    file_data = json_data['fileData']
 
-                    # Create shared_files directory if it doesn't exist
-                    if not os.path.exists('shared_files'):
-                        os.makedirs('shared_files')
+def serve_worker(args, port):
+    """Run in a forked worker process: listen on port alongside the other
+    workers and serve until stopped"""
+    setup_logging(args.log_level, args.access_log)
+    httpd = create_server(port, CustomHTTPRequestHandler, args.mode, args.threads, reuse_port=True)
 
-                    # If fileData is a base64 string
-                    if isinstance(file_data, str):
-                        try:
-                            file_bytes = base64.b64decode(file_data)
-                        except Exception:
-                            file_bytes = file_data.encode('utf-8')
-                    elif isinstance(file_data, list):
-                        file_bytes = bytes(file_data)
-                    else:
-                        file_bytes = file_data
+    # The files are shared; sessions and the indexes are kept in every worker
+    history.after_fork()
+    pairings.load()
+    upload_sessions.load()
+    pairings.start()
+    worker_sync.start()
 
-                    # Save the file
-                    file_path = os.path.join('shared_files', file_name)
-                    with open(file_path, 'wb') as f:
-                        if isinstance(file_bytes, bytes):
-                            f.write(file_bytes)
-                        else:
-                            f.write(file_bytes.encode('utf-8'))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        httpd.server_close()
 
-                    print(f"File shared: {file_name} ({os.path.getsize(file_path)} bytes)")
 
-                    # Send success response
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({
-                        'status': 'success',
-                        'message': f'File {file_name} shared successfully'
-                    }).encode('utf-8'))
-                    return
-            except Exception as e:
-                print(f"Error processing shared file: {e}")
-                # If JSON parsing fails or any other error
-                pass
+def run_workers(args):
+    """Fork args.workers processes serving the same port with SO_REUSEPORT,
+    which the kernel spreads the connections over, and start a new one when
+    a worker dies. The supervisor loads what all of them share before
+    forking and, once they have stopped, writes their messages back."""
+    try:
+        reservation = reserve_port(args.port)
+    except OSError as e:
+        logger.error(f"Unable to start server: {e}")
+        logger.error("Please choose another port with --port, or stop the program using this one")
+        sys.exit(1)
+    port = reservation.getsockname()[1]
 
-        # Default response for other POST requests or errors
-        self.send_response(400)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps({
-            'status': 'error',
-            'message': 'Invalid request'
-        }).encode('utf-8'))
+    configure(args)
+    message_store.load()
+    message_store.close()
+    worker_sync.create(message_store.entries(), history.highest_id() + 1)
+    storage.collect()
+    # Compressed once here, the workers share the pages copy-on-write
+    static_assets.load()
 
-    def get_content_type(self, extension):
-        """Determine content type based on file extension"""
-        content_types = {
-            '.html': 'text/html',
-            '.css': 'text/css',
-            '.js': 'application/javascript',
-            '.json': 'application/json',
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.pdf': 'application/pdf',
-            '.txt': 'text/plain',
-            '.mp3': 'audio/mpeg',
-            '.mp4': 'video/mp4',
-            '.zip': 'application/zip'
-        }
-        return content_types.get(extension, 'application/octet-stream')
+    # Stop the workers too when stopped by the service manager
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    children = {}
+
+    def start_worker(number):
+        pid = os.fork()
+        if pid == 0:
+            # Never return into the supervisor's loop
+            reservation.close()
+            try:
+                serve_worker(args, port)
+            except KeyboardInterrupt:
+                pass
+            # Ctrl+C reaches the workers as well as the supervisor, which then
+            # sends SIGTERM; neither should cut the exit short
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            sys.exit(0)
+        children[pid] = (number, time.monotonic())
 
+    for number in range(args.workers):
+        start_worker(number)
+    show_addresses(port, not args.no_browser)
+    logger.info(f"Serving on {args.workers} worker processes"
+                + (f" of {args.threads} threads each" if args.mode == 'threaded' else ""))
 
-def find_available_port(start_port=8000, max_attempts=10):
-    """Try to find an available port"""
-    port = start_port
-    attempts = 0
+    last_prune = time.monotonic()
+    failed = False
+    try:
+        while not failed:
+            time.sleep(1)
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                number, started = children.pop(pid)
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0 and \
+                        time.monotonic() - started < WORKER_MIN_LIFETIME:
+                    logger.error(f"Worker {number} failed to start, stopping the server")
+                    failed = True
+                    break
+                if os.WIFSIGNALED(status):
+                    logger.warning(f"Worker {number} was killed by signal {os.WTERMSIG(status)}, "
+                                   "starting a new one")
+                else:
+                    logger.warning(f"Worker {number} exited with status {os.WEXITSTATUS(status)}, "
+                                   "starting a new one")
+                start_worker(number)
+            if time.monotonic() - last_prune >= WORKER_PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                try:
+                    worker_sync.prune()
+                except sqlite3.Error as e:
+                    logger.error(f"Error pruning {worker_sync.path}: {e}")
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
 
-    while attempts < max_attempts:
+    for pid in children:
         try:
-            # Create a temporary socket to test if port is available
-            test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            test_socket.settimeout(1)
-            test_socket.bind(('', port))
-            test_socket.close()
-            return port  # Port is available
-        except OSError:
-            # Port not available, try another one
-            attempts += 1
-            if port == start_port:
-                # If default port isn't available, try a random port
-                port = random.randint(8001, 9000)
-            else:
-                # Otherwise, continue incrementing
-                port += 1
-
-    # If all attempts fail, use a random high port
-    return random.randint(49152, 65535)
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        os.waitpid(pid, 0)
+    # Back into the snapshot, for whichever mode runs next
+    message_store.load()
+    message_store.close()
+    if failed:
+        sys.exit(1)
 
-# Main function
+# Parse command line options
 
 
-def main():
-    # Initialize messages file
-    init_messages_file()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Snap Send local network file transfer server')
+    parser.add_argument('--port', type=int, default=None,
+                        help=f'port to listen on (default: {DEFAULT_PORT}, or a free one if it is taken)')
+    parser.add_argument('--mode', choices=('threaded', 'single'), default='threaded',
+                        help='serve requests on a worker thread pool or one at a time (default: threaded)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_WORKER_THREADS,
+                        help=f'worker pool size in threaded mode (default: {DEFAULT_WORKER_THREADS})')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='server processes sharing the port with SO_REUSEPORT, each with its own '
+                             'threads, to use several cores (default: 1)')
+    parser.add_argument('--max-upload-writers', type=int, default=MAX_UPLOAD_WRITERS,
+                        help=f'uploads written at the same time across all clients (default: {MAX_UPLOAD_WRITERS})')
+    parser.add_argument('--max-client-inflight', type=int, default=MAX_CLIENT_INFLIGHT_BYTES // (1024 * 1024),
+                        help='upload megabytes one client may have in flight at once '
+                             f'(default: {MAX_CLIENT_INFLIGHT_BYTES // (1024 * 1024)})')
+    parser.add_argument('--max-rate', type=float, metavar='MB/S',
+                        help='megabytes per second all transfers together may use, after API responses; '
+                             'set it a little below the network speed so those never wait (default: no limit)')
+    parser.add_argument('--client-rate', type=float, metavar='MB/S',
+                        help='megabytes per second the transfers of one client may use (default: no limit)')
+    parser.add_argument('--transfer-rate', type=float, metavar='MB/S',
+                        help='megabytes per second one transfer may use (default: no limit)')
+    parser.add_argument('--no-browser', action='store_true',
+                        help="don't open the desktop page in a browser on startup")
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='info',
+                        help='lowest level of log message shown; warning hides the line per request (default: info)')
+    parser.add_argument('--storage', choices=('directory', 'spool', 'memory'), default='directory',
+                        help='keep transferred files in received_files and shared_files here, under '
+                             '--spool-dir, or in memory only (default: directory)')
+    parser.add_argument('--spool-dir', metavar='DIR', default=DEFAULT_SPOOL_DIRECTORY,
+                        help=f'directory for --storage spool (default: {DEFAULT_SPOOL_DIRECTORY})')
+    parser.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_STORAGE_MB, metavar='MB',
+                        help='megabytes of files --storage memory holds before evicting the least recently '
+                             f'used (default: {DEFAULT_MEMORY_STORAGE_MB})')
+    parser.add_argument('--history-days', type=float, metavar='DAYS',
+                        help=f'keep every message for DAYS days in {HISTORY_DATABASE}, to page back through '
+                             f'and search (default: only the last {MAX_MESSAGES})')
+    parser.add_argument('--access-log', metavar='FILE',
+                        help="write one JSON line per request to FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.max_upload_writers < 1 or args.max_client_inflight < 1:
+        parser.error('upload limits must be at least 1')
+    if any(rate is not None and rate <= 0 for rate in (args.max_rate, args.client_rate, args.transfer_rate)):
+        parser.error('rate limits must be above 0')
+    if args.memory_limit < 1:
+        parser.error('--memory-limit must be at least 1')
+    if args.history_days is not None and args.history_days <= 0:
+        parser.error('--history-days must be above 0')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error('--workers needs a system with fork() and SO_REUSEPORT')
+    if args.workers > 1 and args.storage == 'memory':
+        parser.error("--storage memory can't be shared by --workers processes")
+    return args
 
-    # Create required directories if they don't exist
-    for directory in ['received_files', 'shared_files']:
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+# Main function
 
-    # Get local IP address
-    ip = get_local_ip()
 
-    # Find available port
-    port = find_available_port()
-    print(f"Trying to use port: {port}")
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.log_level, args.access_log)
 
     # Create handler with current directory
     handler = CustomHTTPRequestHandler
@@ -578,41 +5664,43 @@ def main():
         '.html': 'text/html; charset=UTF-8',
     })
 
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    # Listen first: connections made while the state below loads wait in the
+    # backlog, and the URLs can be printed straight away
     try:
-        # Create server
-        httpd = socketserver.TCPServer(("", port), handler)
+        httpd = create_server(args.port, handler, args.mode, args.threads)
+    except OSError as e:
+        logger.error(f"Unable to start server: {e}")
+        logger.error("Please choose another port with --port, or stop the program using this one")
+        sys.exit(1)
+    port = httpd.server_address[1]
+    show_addresses(port, not args.no_browser)
 
-        print(f"Server running at http://{ip}:{port}/")
-        print(f"For mobile access, use http://{ip}:{port}/mobile.html")
-        print("Press Ctrl+C to stop the server")
+    if args.mode == 'threaded':
+        logger.info(f"Serving requests concurrently on {args.threads} worker threads")
 
-        # Open browser automatically
-        threading.Timer(1.0, lambda: webbrowser.open(f"http://{ip}:{port}/")).start()
+    # Recover messages from the snapshot and journal, with ids past the history's
+    configure(args)
+    message_store.load()
 
-        # Start server
+    # Restore the pairing sessions, index existing files, pick up unfinished
+    # uploads, and expire files and idle sessions in the background
+    pairings.load()
+    upload_sessions.load()
+    storage.collect()
+    pairings.start()
+
+    # Read and compress the web interface once
+    static_assets.load()
+
+    try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped.")
-        if 'httpd' in locals():
-            httpd.server_close()
-    except Exception as e:
-        print(f"Error starting server: {e}")
-        print("Trying to use a random port...")
-        # If still fails, try a completely random port
-        port = random.randint(10000, 65000)
-        try:
-            httpd = socketserver.TCPServer(("", port), handler)
-            print(f"Server running at http://{ip}:{port}/")
-            print(f"For mobile access, use http://{ip}:{port}/mobile.html")
-            print("Press Ctrl+C to stop the server")
-
-            # Open browser automatically
-            threading.Timer(1.0, lambda: webbrowser.open(f"http://{ip}:{port}/")).start()
-
-            httpd.serve_forever()
-        except Exception as e2:
-            print(f"Unable to start server: {e2}")
-            print("Please make sure no other programs are using too many ports, or try to manually terminate other Python processes")
+        httpd.server_close()
 
 
 if __name__ == "__main__":
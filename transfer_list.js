@@ -0,0 +1,137 @@
+// Live list of the uploads and downloads in progress, shared by the desktop
+// and mobile pages.
+//
+// The server publishes a 'transfer' event at most twice a second for each
+// transfer that takes longer than that, and a last one when it is done or
+// has failed; GET /api/transfers lists the transfers still running. The page
+// feeds both into a TransferList, which shows each transfer with a progress
+// bar, its rate and the time left.
+(function() {
+    // How often the list is re-fetched while it isn't empty, to notice stalled transfers (ms)
+    const REFRESH_INTERVAL = 5000;
+
+    // What each kind of transfer is called, by direction and file area
+    const LABELS = {
+        'upload:received': 'Mobile → Desktop',
+        'upload:shared': 'Desktop → Mobile',
+        'download:received': 'Downloading on Desktop',
+        'download:shared': 'Downloading on Mobile'
+    };
+
+    function formatSize(bytes) {
+        if (bytes < 1024) return bytes + ' bytes';
+        else if (bytes < 1048576) return (bytes / 1024).toFixed(1) + ' KB';
+        else if (bytes < 1073741824) return (bytes / 1048576).toFixed(1) + ' MB';
+        else return (bytes / 1073741824).toFixed(1) + ' GB';
+    }
+
+    function formatEta(seconds) {
+        if (seconds < 60) return Math.ceil(seconds) + ' s left';
+        if (seconds < 3600) return Math.ceil(seconds / 60) + ' min left';
+        return (seconds / 3600).toFixed(1) + ' h left';
+    }
+
+    function describe(transfer) {
+        const parts = [];
+        if (transfer.size) {
+            parts.push(Math.floor(transfer.transferred / transfer.size * 100) + '%');
+        } else {
+            parts.push(formatSize(transfer.transferred));
+        }
+        if (transfer.state === 'stalled') {
+            parts.push('stalled');
+        } else if (transfer.rate) {
+            parts.push(formatSize(transfer.rate) + '/s');
+        }
+        if (transfer.eta !== null) {
+            parts.push(formatEta(transfer.eta));
+        }
+        return parts.join(' · ');
+    }
+
+    class TransferList {
+        constructor(element) {
+            this.element = element;
+            this.transfers = new Map();
+            this.refreshTimer = null;
+        }
+
+        // Apply one 'transfer' event
+        update(transfer) {
+            if (transfer.state === 'done' || transfer.state === 'failed') {
+                this.transfers.delete(transfer.id);
+            } else {
+                this.transfers.set(transfer.id, transfer);
+            }
+            this.render();
+        }
+
+        // Replace the list with what the server has now
+        refresh() {
+            return fetch('/api/transfers')
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Network response was not ok');
+                    }
+                    return response.json();
+                })
+                .then(list => {
+                    this.transfers = new Map(list.map(transfer => [transfer.id, transfer]));
+                    this.render();
+                })
+                .catch(error => {
+                    console.error('Error fetching transfers:', error);
+                });
+        }
+
+        render() {
+            this.element.innerHTML = '';
+            this.element.hidden = this.transfers.size === 0;
+
+            this.transfers.forEach(transfer => {
+                const li = document.createElement('li');
+
+                const label = document.createElement('div');
+                label.className = 'transfer-label';
+                const direction = document.createElement('span');
+                direction.className = 'transfer-direction';
+                direction.textContent = LABELS[`${transfer.direction}:${transfer.area}`] || transfer.direction;
+                const name = document.createElement('span');
+                name.className = 'transfer-name';
+                name.textContent = transfer.name || '';
+                label.append(direction, name);
+
+                const bar = document.createElement('div');
+                bar.className = 'transfer-bar';
+                const fill = document.createElement('div');
+                if (transfer.size) {
+                    fill.style.width = Math.min(100, transfer.transferred / transfer.size * 100) + '%';
+                } else {
+                    // Unknown total (a ZIP being built): show activity only
+                    fill.className = 'transfer-indeterminate';
+                }
+                bar.appendChild(fill);
+
+                const details = document.createElement('div');
+                details.className = 'transfer-details';
+                details.textContent = describe(transfer);
+
+                li.append(label, bar, details);
+                this.element.appendChild(li);
+            });
+
+            // Events only come while bytes are moving, so a stalled or
+            // vanished transfer is only noticed by asking again
+            if (this.transfers.size > 0 && this.refreshTimer === null) {
+                this.refreshTimer = setInterval(() => this.refresh(), REFRESH_INTERVAL);
+            } else if (this.transfers.size === 0 && this.refreshTimer !== null) {
+                clearInterval(this.refreshTimer);
+                this.refreshTimer = null;
+            }
+        }
+    }
+
+    window.SnapSendTransfers = {
+        TransferList: TransferList
+    };
+})();
@@ -0,0 +1,453 @@
+// Resumable chunked uploads shared by the desktop and mobile pages.
+//
+// Files larger than one chunk go through an upload session: POST /api/uploads
+// starts it, each Blob.slice() of the file is PUT to
+// /api/uploads/<id>/chunks/<n>, and POST /api/uploads/<id>/complete moves the
+// finished file into place. The session id is remembered in localStorage, so
+// picking the same file again after a dropped connection or a page reload
+// only sends the chunks the server doesn't have yet.
+//
+// Up to SnapSendUpload.parallelChunks chunks are in flight at once, which
+// keeps a congested Wi-Fi link busy where one TCP stream would leave it idle.
+//
+// Files up to HASH_MAX_SIZE are hashed first. If the server already stores
+// the same bytes (the same photo sent twice, or back in the other
+// direction), POST /api/blobs/<sha256>/link names it without an upload.
+//
+// uploadFiles() sends a selection of many small files together as
+// multipart/form-data batches, one request per batch instead of per file.
+//
+// Where the browser has CompressionStream, bodies with files of other types
+// than COMPRESSED_EXTENSIONS (text, logs, CSV, JSON...) are gzipped first and
+// sent with Content-Encoding: gzip, if that makes them noticeably smaller;
+// the server decompresses them on the way to disk.
+(function() {
+    const CHUNK_SIZE = 4 * 1024 * 1024;
+
+    // Limits for one multipart batch of small files
+    const BATCH_MAX_SIZE = 16 * 1024 * 1024;
+    const BATCH_MAX_FILES = 100;
+
+    // Largest file hashed to look for a stored copy; past this the hashing time outweighs the likely saving
+    const HASH_MAX_SIZE = 64 * 1024 * 1024;
+
+    // Types that are compressed already, so not gzipped; the server fills in its COMPRESSED_EXTENSIONS
+    const COMPRESSED_EXTENSIONS = new Set(/* COMPRESSED_EXTENSIONS */[]);
+
+    // Smallest file worth gzipping, and the share of its size gzip must save to be sent that way
+    const MIN_COMPRESS_SIZE = 1024;
+    const MIN_COMPRESS_SAVING = 0.1;
+
+    // Retries per request before giving up, with exponential backoff
+    const MAX_ATTEMPTS = 8;
+    const MAX_RETRY_DELAY = 30000;
+
+    // How long to keep honouring "busy, retry later" answers for one request
+    const MAX_BUSY_WAIT = 5 * 60 * 1000;
+
+    function sessionKey(file, target) {
+        return `snap-send-upload:${target}:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    function delay(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    // fetch() that retries network errors and 5xx responses, e.g. while the phone reconnects to Wi-Fi.
+    // 429/503 with Retry-After mean the server's upload limits are full; those waits don't use up attempts.
+    // 507 means its storage is full, which retrying won't change.
+    async function fetchWithRetry(url, options) {
+        let lastError = null;
+        let busySince = null;
+        let attempt = 0;
+        while (attempt < MAX_ATTEMPTS) {
+            try {
+                const response = await fetch(url, options);
+                const retryAfter = response.headers.get('Retry-After');
+                if ((response.status === 429 || response.status === 503) && retryAfter) {
+                    busySince = busySince || Date.now();
+                    if (Date.now() - busySince < MAX_BUSY_WAIT) {
+                        await delay(parseFloat(retryAfter) * 1000 * (1 + Math.random()));
+                        continue;
+                    }
+                }
+                if (response.status < 500 || response.status === 507) {
+                    return response;
+                }
+                lastError = new Error(`Server returned ${response.status}`);
+            } catch (error) {
+                lastError = error;
+            }
+            attempt++;
+            console.warn(`Retrying ${url}:`, lastError);
+            if (attempt < MAX_ATTEMPTS) {
+                await delay(Math.min(1000 * 2 ** (attempt - 1), MAX_RETRY_DELAY));
+            }
+        }
+        throw lastError;
+    }
+
+    // Incremental SHA-256. crypto.subtle only exists on https and localhost
+    // pages, and the phone loads this one over plain http.
+    const SHA256_K = new Uint32Array([
+        0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+        0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+        0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+        0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+        0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+        0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+        0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+        0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+    ]);
+
+    class Sha256 {
+        constructor() {
+            this.state = new Uint32Array([
+                0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+            ]);
+            this.words = new Uint32Array(64);
+            this.pending = new Uint8Array(64);
+            this.pendingLength = 0;
+            this.length = 0;
+        }
+
+        update(bytes) {
+            let offset = 0;
+            this.length += bytes.length;
+            if (this.pendingLength > 0) {
+                offset = Math.min(64 - this.pendingLength, bytes.length);
+                this.pending.set(bytes.subarray(0, offset), this.pendingLength);
+                this.pendingLength += offset;
+                if (this.pendingLength < 64) {
+                    return;
+                }
+                this.block(this.pending, 0);
+                this.pendingLength = 0;
+            }
+            for (; offset + 64 <= bytes.length; offset += 64) {
+                this.block(bytes, offset);
+            }
+            this.pending.set(bytes.subarray(offset), 0);
+            this.pendingLength = bytes.length - offset;
+        }
+
+        block(bytes, offset) {
+            const w = this.words;
+            for (let i = 0; i < 16; i++) {
+                const j = offset + i * 4;
+                w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+            }
+            for (let i = 16; i < 64; i++) {
+                const x = w[i - 15];
+                const y = w[i - 2];
+                const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+                const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+                w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+            }
+
+            const s = this.state;
+            let a = s[0], b = s[1], c = s[2], d = s[3], e = s[4], f = s[5], g = s[6], h = s[7];
+            for (let i = 0; i < 64; i++) {
+                const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+                const t1 = (h + S1 + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) | 0;
+                const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+                h = g;
+                g = f;
+                f = e;
+                e = (d + t1) | 0;
+                d = c;
+                c = b;
+                b = a;
+                a = (t1 + t2) | 0;
+            }
+            s[0] += a; s[1] += b; s[2] += c; s[3] += d;
+            s[4] += e; s[5] += f; s[6] += g; s[7] += h;
+        }
+
+        hex() {
+            const bits = this.length * 8;
+            const padding = new Uint8Array((this.pendingLength < 56 ? 64 : 128) - this.pendingLength);
+            padding[0] = 0x80;
+            const view = new DataView(padding.buffer);
+            view.setUint32(padding.length - 8, Math.floor(bits / 0x100000000));
+            view.setUint32(padding.length - 4, bits >>> 0);
+            this.update(padding);
+            return Array.from(this.state, word => word.toString(16).padStart(8, '0')).join('');
+        }
+    }
+
+    function isCompressible(file) {
+        const dot = file.name.lastIndexOf('.');
+        const extension = dot >= 0 ? file.name.slice(dot).toLowerCase() : '';
+        return window.SnapSendUpload.compress && typeof CompressionStream !== 'undefined' &&
+            file.size >= MIN_COMPRESS_SIZE && !COMPRESSED_EXTENSIONS.has(extension);
+    }
+
+    // gzip a Blob; null if that doesn't save enough to be worth it
+    async function gzipBlob(blob) {
+        const compressed = await new Response(blob.stream().pipeThrough(new CompressionStream('gzip'))).blob();
+        return compressed.size <= blob.size * (1 - MIN_COMPRESS_SAVING) ? compressed : null;
+    }
+
+    async function hashFile(file) {
+        const hash = new Sha256();
+        for (let start = 0; start < file.size; start += CHUNK_SIZE) {
+            const buffer = await file.slice(start, start + CHUNK_SIZE).arrayBuffer();
+            hash.update(new Uint8Array(buffer));
+        }
+        return hash.hex();
+    }
+
+    // Name a copy the server already stores; null if it has to be uploaded
+    async function linkStored(file, target, sha256) {
+        const response = await fetchWithRetry(`/api/blobs/${sha256}/link`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ name: file.name, target: target })
+        });
+        if (response.status === 404) {
+            return null;
+        }
+        return readJson(response);
+    }
+
+    async function readJson(response) {
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.message || `Server returned ${response.status}`);
+        }
+        return data;
+    }
+
+    // Resume the saved session for this file if the server still has it, otherwise start one
+    async function openSession(file, target, sha256) {
+        const key = sessionKey(file, target);
+        const savedId = localStorage.getItem(key);
+
+        if (savedId) {
+            const response = await fetchWithRetry(`/api/uploads/${savedId}`, { cache: 'no-store' });
+            if (response.ok) {
+                return readJson(response);
+            }
+            localStorage.removeItem(key);
+        }
+
+        const response = await fetchWithRetry('/api/uploads', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                name: file.name,
+                size: file.size,
+                target: target,
+                chunkSize: CHUNK_SIZE,
+                sha256: sha256 || undefined
+            })
+        });
+        const session = await readJson(response);
+        localStorage.setItem(key, session.id);
+        return session;
+    }
+
+    // compression.enabled is cleared once a chunk doesn't gzip well, so the rest of the file isn't tried
+    async function sendChunk(session, file, index, compression) {
+        const start = index * session.chunkSize;
+        const chunk = file.slice(start, Math.min(start + session.chunkSize, file.size));
+        const headers = {
+            'Content-Type': 'application/octet-stream'
+        };
+        let body = chunk;
+        if (compression.enabled) {
+            const compressed = await gzipBlob(chunk);
+            if (compressed) {
+                body = compressed;
+                headers['Content-Encoding'] = 'gzip';
+            } else {
+                compression.enabled = false;
+            }
+        }
+        const response = await fetchWithRetry(`/api/uploads/${session.id}/chunks/${index}`, {
+            method: 'PUT',
+            headers: headers,
+            body: body
+        });
+        await readJson(response);
+        return chunk.size;
+    }
+
+    async function uploadChunked(file, target, onProgress, sha256) {
+        const session = await openSession(file, target, sha256);
+        const received = new Set(session.received);
+
+        let sent = 0;
+        received.forEach(index => {
+            sent += Math.min(session.chunkSize, file.size - index * session.chunkSize);
+        });
+        onProgress(sent / file.size);
+
+        const pending = [];
+        for (let index = 0; index < session.chunkCount; index++) {
+            if (!received.has(index)) {
+                pending.push(index);
+            }
+        }
+
+        // Each worker takes the next pending chunk until none are left
+        const compression = { enabled: isCompressible(file) };
+        let failed = null;
+        async function worker() {
+            while (pending.length > 0 && !failed) {
+                const index = pending.shift();
+                try {
+                    sent += await sendChunk(session, file, index, compression);
+                    onProgress(sent / file.size);
+                } catch (error) {
+                    failed = error;
+                }
+            }
+        }
+
+        const workers = [];
+        const parallel = Math.max(1, Math.min(window.SnapSendUpload.parallelChunks, pending.length));
+        for (let i = 0; i < parallel; i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+        if (failed) {
+            throw failed;
+        }
+
+        const response = await fetchWithRetry(`/api/uploads/${session.id}/complete`, {
+            method: 'POST'
+        });
+        const result = await readJson(response);
+        localStorage.removeItem(sessionKey(file, target));
+        return result;
+    }
+
+    // Small files go up in one streamed request
+    async function uploadWhole(file, target, onProgress, sha256) {
+        const endpoint = target === 'shared' ? '/upload-to-mobile/stream' : '/upload/stream';
+        const checksum = sha256 ? `&sha256=${sha256}` : '';
+        const headers = {
+            'Content-Type': 'application/octet-stream'
+        };
+        const compressed = isCompressible(file) ? await gzipBlob(file) : null;
+        if (compressed) {
+            headers['Content-Encoding'] = 'gzip';
+        }
+        const response = await fetchWithRetry(`${endpoint}?name=${encodeURIComponent(file.name)}${checksum}`, {
+            method: 'POST',
+            headers: headers,
+            body: compressed || file
+        });
+        const result = await readJson(response);
+        onProgress(1);
+        return result;
+    }
+
+    // Upload file to the "received" (mobile to desktop) or "shared" (desktop to mobile) area.
+    // onProgress is called with the fraction of the file sent so far.
+    async function uploadFile(file, target, onProgress = () => {}) {
+        let sha256 = null;
+        if (file.size > 0 && file.size <= HASH_MAX_SIZE) {
+            sha256 = await hashFile(file);
+            const linked = await linkStored(file, target, sha256);
+            if (linked) {
+                onProgress(1);
+                return linked;
+            }
+        }
+        if (file.size <= CHUNK_SIZE) {
+            return uploadWhole(file, target, onProgress, sha256);
+        }
+        return uploadChunked(file, target, onProgress, sha256);
+    }
+
+    // Send several files in one multipart request; returns [{name, size}]
+    async function uploadBatch(files, target) {
+        const endpoint = target === 'shared' ? '/upload-to-mobile/batch' : '/upload/batch';
+        const form = new FormData();
+        files.forEach(file => form.append('files', file, file.name));
+        const headers = {};
+        let body = form;
+        if (files.some(isCompressible)) {
+            // Serialize the form to gzip it as a whole, keeping its boundary
+            const multipart = new Response(form);
+            const compressed = await gzipBlob(await multipart.blob());
+            if (compressed) {
+                headers['Content-Type'] = multipart.headers.get('Content-Type');
+                headers['Content-Encoding'] = 'gzip';
+                body = compressed;
+            }
+        }
+        const response = await fetchWithRetry(endpoint, {
+            method: 'POST',
+            headers: headers,
+            body: body
+        });
+        const result = await readJson(response);
+        return result.files;
+    }
+
+    // Upload a selection of files to target. Files up to one chunk are grouped into batches (skipping the
+    // duplicate check, which would cost a request each); larger ones and lone files go through uploadFile.
+    // onProgress is called with the fraction of all bytes sent, onStatus with what is being sent now.
+    async function uploadFiles(files, target, onProgress = () => {}, onStatus = () => {}) {
+        files = Array.from(files);
+        const totalSize = files.reduce((sum, file) => sum + file.size, 0);
+        let doneSize = 0;
+        const reportProgress = size => onProgress(totalSize > 0 ? size / totalSize : 1);
+
+        const batches = [];
+        const singles = [];
+        let batch = [];
+        let batchSize = 0;
+        files.forEach(file => {
+            if (files.length === 1 || file.size > CHUNK_SIZE) {
+                singles.push(file);
+                return;
+            }
+            if (batch.length >= BATCH_MAX_FILES || (batch.length > 0 && batchSize + file.size > BATCH_MAX_SIZE)) {
+                batches.push(batch);
+                batch = [];
+                batchSize = 0;
+            }
+            batch.push(file);
+            batchSize += file.size;
+        });
+        if (batch.length > 1) {
+            batches.push(batch);
+        } else {
+            singles.push(...batch);
+        }
+
+        const results = [];
+        for (const group of batches) {
+            onStatus(`${group.length} files`);
+            results.push(...await uploadBatch(group, target));
+            doneSize += group.reduce((sum, file) => sum + file.size, 0);
+            reportProgress(doneSize);
+        }
+        for (const file of singles) {
+            onStatus(file.name);
+            results.push(await uploadFile(file, target, fraction => reportProgress(doneSize + fraction * file.size)));
+            doneSize += file.size;
+            reportProgress(doneSize);
+        }
+        return results;
+    }
+
+    window.SnapSendUpload = {
+        uploadFile: uploadFile,
+        uploadFiles: uploadFiles,
+        // Chunks sent at the same time
+        parallelChunks: 4,
+        // gzip compressible files before sending; costs more time than it saves on links faster than ~10 MB/s
+        compress: true
+    };
+})();